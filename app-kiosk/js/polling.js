@@ -1,11 +1,13 @@
 /**
  * POLLING.JS
- * Polling contínuo para obter status do EDGE durante DISPENSING
+ * Status do EDGE durante DISPENSING
+ * Usa o stream SSE (/edge/dispense/stream) e cai para polling se indisponível
  */
 
 const Polling = {
   active: false,
   intervalId: null,
+  eventSource: null,
   intervalMs: 300,
   config: null,
   isFetching: false, // Flag anti-race condition
@@ -34,6 +36,20 @@ const Polling = {
     }
 
     this.active = true;
+
+    // Preferência: stream SSE (sem carga de polling, latência menor)
+    if (this.startStream()) {
+      this.log('Recebendo status via stream SSE');
+      return;
+    }
+
+    this.startInterval();
+  },
+
+  /**
+   * Inicia polling por intervalo
+   */
+  startInterval() {
     this.log('Iniciando polling a cada', this.intervalMs, 'ms');
 
     // Faz primeira requisição imediatamente
@@ -45,6 +61,60 @@ const Polling = {
     }, this.intervalMs);
   },
 
+  /**
+   * Abre stream SSE do EDGE
+   * Retorna false se o stream não puder ser usado (mock ou sem EventSource)
+   */
+  startStream() {
+    if (!window.EventSource || !this.config || this.config.api.use_mock) {
+      return false;
+    }
+
+    try {
+      this.eventSource = new EventSource(`${this.config.api.edge_url}/edge/dispense/stream`);
+    } catch (error) {
+      this.log('Stream SSE indisponível:', error.message);
+      this.eventSource = null;
+      return false;
+    }
+
+    const onEvent = (event) => {
+      if (!window.StateMachineInstance || window.StateMachineInstance.getState() !== 'DISPENSING') {
+        this.stop();
+        return;
+      }
+      try {
+        this.handleStatus({ dispenser: JSON.parse(event.data) });
+      } catch (error) {
+        this.log('ERRO ao processar evento SSE:', error.message);
+      }
+    };
+
+    ['status', 'progress', 'result'].forEach((type) => {
+      this.eventSource.addEventListener(type, onEvent);
+    });
+
+    this.eventSource.onerror = () => {
+      this.log('Stream SSE falhou - voltando para polling');
+      this.closeStream();
+      if (this.active && !this.intervalId) {
+        this.startInterval();
+      }
+    };
+
+    return true;
+  },
+
+  /**
+   * Fecha stream SSE
+   */
+  closeStream() {
+    if (this.eventSource) {
+      this.eventSource.close();
+      this.eventSource = null;
+    }
+  },
+
   startMock(intervalMs = null) {
     this.start(intervalMs);
   },
@@ -60,6 +130,7 @@ const Polling = {
       clearInterval(this.intervalId);
       this.intervalId = null;
     }
+    this.closeStream();
 
     this.log('Polling parado');
   },
@@ -99,43 +170,7 @@ const Polling = {
         return;
       }
 
-      const status = result.data;
-      
-      // Atualiza o state data do StateMachine com os valores atuais
-      if (window.StateMachineInstance) {
-        const dispenserData = status.dispenser || status;
-        window.StateMachineInstance.updateStateData({
-          dispensing_status: dispenserData.status,
-          volume_dispensed: dispenserData.volume_dispensed_ml || dispenserData.ml_served || 0
-        });
-      }
-      
-      this.emitStatus(status);
-
-      // Reset erro se sucesso
-      this.errorCount = 0;
-
-      // Se a dispensa foi completada/erro, para o polling e transiciona
-      const dispenserData = status.dispenser || status;
-      const dispenserStatus = (dispenserData.status || status.state || '').toString().toUpperCase();
-      
-      if (dispenserStatus === 'COMPLETED' || dispenserStatus === 'FINISHED') {
-        const stateData = (window.StateMachineInstance && window.StateMachineInstance.getData()) || {};
-        const volFinal = dispenserData.volume_dispensed_ml ?? dispenserData.ml_served ?? stateData.ml_served ?? 0;
-        this.log(`✅ Dispensing ${dispenserStatus}! Volume: ${volFinal}ml`);
-        this.stop();
-        
-        // NÃO transiciona aqui - o main.js vai fazer isso ao processar o evento 'dispensingStatus'
-        // Apenas emite o evento para que o handler no main.js possa processar corretamente
-      } else if (dispenserStatus === 'INTERRUPTED' || dispenserStatus === 'ERROR') {
-        this.log(`⚠️ Dispensing ${dispenserStatus}! Error: ${dispenserData.error_message || dispenserData.error}`);
-        this.stop();
-        
-        // Volta para IDLE em caso de erro
-        if (window.StateMachineInstance) {
-          window.StateMachineInstance.setState('IDLE', { error: dispenserData.error_message || dispenserData.error });
-        }
-      }
+      this.handleStatus(result.data);
     } catch (error) {
       this.log('ERRO no fetchStatus:', error.message);
       this.emitError(error.message);
@@ -150,6 +185,56 @@ const Polling = {
     }
   },
 
+  /**
+   * Processa status do EDGE (polling ou stream SSE)
+   */
+  handleStatus(status) {
+    // O EDGE volta para IDLE assim que a dispensa termina; o resultado
+    // final da nossa venda fica em last_result
+    const current = status.dispenser || status;
+    const lastResult = current.last_result;
+    if (lastResult && window.APP && lastResult.sale_id === window.APP.lastSaleId
+        && !current.is_dispensing) {
+      status = { ...status, dispenser: lastResult };
+    }
+
+    // Atualiza o state data do StateMachine com os valores atuais
+    if (window.StateMachineInstance) {
+      const dispenserData = status.dispenser || status;
+      window.StateMachineInstance.updateStateData({
+        dispensing_status: dispenserData.status,
+        volume_dispensed: dispenserData.volume_dispensed_ml || dispenserData.ml_served || 0
+      });
+    }
+    
+    this.emitStatus(status);
+
+    // Reset erro se sucesso
+    this.errorCount = 0;
+
+    // Se a dispensa foi completada/erro, para o polling e transiciona
+    const dispenserData = status.dispenser || status;
+    const dispenserStatus = (dispenserData.status || status.state || '').toString().toUpperCase();
+    
+    if (dispenserStatus === 'COMPLETED' || dispenserStatus === 'FINISHED') {
+      const stateData = (window.StateMachineInstance && window.StateMachineInstance.getData()) || {};
+      const volFinal = dispenserData.volume_dispensed_ml ?? dispenserData.ml_served ?? stateData.ml_served ?? 0;
+      this.log(`✅ Dispensing ${dispenserStatus}! Volume: ${volFinal}ml`);
+      this.stop();
+      
+      // NÃO transiciona aqui - o main.js vai fazer isso ao processar o evento 'dispensingStatus'
+      // Apenas emite o evento para que o handler no main.js possa processar corretamente
+    } else if (dispenserStatus === 'INTERRUPTED' || dispenserStatus === 'ERROR') {
+      this.log(`⚠️ Dispensing ${dispenserStatus}! Error: ${dispenserData.error_message || dispenserData.error}`);
+      this.stop();
+      
+      // Volta para IDLE em caso de erro
+      if (window.StateMachineInstance) {
+        window.StateMachineInstance.setState('IDLE', { error: dispenserData.error_message || dispenserData.error });
+      }
+    }
+  },
+
   /**
    * Emite evento de status
    */
@@ -4,24 +4,40 @@ BierPass Beverage Dispenser Control
 
 Endpoints:
 - GET  /edge/health   - Health check
-- GET  /edge/status   - Detailed status
-- POST /edge/authorize - Authorize and dispense
-- POST /edge/cancel   - Cancel current dispense
+- GET  /edge/status   - Detailed status (?tap_id= for one tap)
+- POST /edge/authorize - Authorize and dispense on the token's tap
+- GET  /edge/dispense/stream - Live dispense events (SSE, ?tap_id= to filter)
+- GET  /edge/dispense/result/<sale_id> - Outcome of a finished dispense
+- POST /edge/cancel   - Cancel current dispense of a tap
 - POST /edge/sync     - Force sync with SaaS
+- GET  /edge/telemetry/<consumption_id> - Pulse trace of one pour (?format=binary for raw deltas)
+
+With config.controller.PROCESS the taps run in a separate controller
+process (controller.py) and this process only talks to it, so request
+load never delays a pump-off.
 """
 import atexit
+import json
+import queue
 import logging
 from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 
 from config import config
 from database import database
-from gpio_controller import gpio_controller
-from dispenser import dispenser, DispenseStatus
+from consumption_writer import consumption_writer
+from retention import retention_manager
+from dispenser import dispensers as local_dispensers
+from controller import controller_dispensers
 from token_validator import token_validator
 from sync_service import sync_service
 from payment_service import payment_service
+from status_snapshot import status_snapshot
+from telemetry import telemetry_store
+
+# GPIO and pours in the controller process, or in threads of this one
+dispensers = controller_dispensers if config.controller.PROCESS else local_dispensers
 
 
 # ==================== App Setup ====================
@@ -53,6 +69,14 @@ logging.basicConfig(
 logger = logging.getLogger('edge-server')
 
 
+# ==================== Helpers ====================
+
+def _requested_tap_id(data=None):
+    """tap_id from the JSON body or query string (None if absent)"""
+    tap_id = (data or {}).get('tap_id', request.args.get('tap_id'))
+    return int(tap_id) if tap_id not in (None, '') else None
+
+
 # ==================== Routes ====================
 
 @app.route('/edge/health', methods=['GET'])
@@ -68,15 +92,41 @@ def health():
 
 @app.route('/edge/status', methods=['GET'])
 def status():
-    """Detailed status including dispenser, sync, and GPIO"""
+    """
+    Detailed status including dispenser, sync, and GPIO
+    
+    Served from the in-memory status snapshot, which the dispenser,
+    sync service, GPIO controller and database keep current. No network
+    or SQL work happens here. The "version" field increments on every
+    change, so clients can skip unchanged responses.
+    
+    Every tap is under "taps" (and "gpio") keyed by tap_id; "dispenser"
+    is the default tap. With ?tap_id=N, "dispenser" and "gpio" hold
+    that tap only.
+    """
     from datetime import datetime, timezone
-    return jsonify({
-        "dispenser": dispenser.get_status(),
-        "sync": sync_service.get_status(),
-        "gpio": gpio_controller.get_status(),
-        "database": database.get_consumption_stats(),
-        "timestamp": datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
-    })
+    snapshot = status_snapshot.to_dict()
+    
+    try:
+        tap_id = _requested_tap_id()
+    except ValueError:
+        return jsonify({"error": "Invalid tap_id"}), 400
+    if tap_id is not None:
+        key = str(tap_id)
+        if key not in snapshot.get("taps", {}):
+            return jsonify({"error": f"Unknown tap {tap_id}"}), 404
+        snapshot["dispenser"] = snapshot["taps"][key]
+        snapshot["gpio"] = snapshot.get("gpio", {}).get(key, {})
+    snapshot["timestamp"] = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+    return jsonify(snapshot)
+
+
+def _run_dispense(dispenser, payload):
+    """Background pour; gives the token back if the pump never started"""
+    result = dispenser.dispense(payload)
+    if result.token_unused:
+        token_validator.mark_token_unused(payload.nonce)
+    return result
 
 
 @app.route('/edge/authorize', methods=['POST'])
@@ -130,27 +180,37 @@ def authorize():
                 "error": error
             }), 401
         
-        logger.info(f"Token validated for sale {payload.sale_id}, {payload.volume_ml}ml")
+        logger.info(f"Token validated for sale {payload.sale_id}, {payload.volume_ml}ml, tap {payload.tap_id}")
         
-        # Check if dispenser is busy
-        if dispenser.status == DispenseStatus.DISPENSING:
+        dispenser = dispensers.get(payload.tap_id)
+        if dispenser is None:
+            token_validator.mark_token_unused(payload.nonce)
             return jsonify({
                 "authorized": False,
-                "error": "Dispenser is busy"
+                "error": f"Unknown tap {payload.tap_id}"
+            }), 400
+        
+        # Only this tap has to be free; other taps may be pouring
+        if dispenser.is_busy:
+            token_validator.mark_token_unused(payload.nonce)
+            return jsonify({
+                "authorized": False,
+                "error": f"Tap {payload.tap_id} is busy"
             }), 409
         
         # Execute dispense in background thread (non-blocking)
         # This allows polling to read progress while dispensing is happening
         import threading
-        dispense_thread = threading.Thread(target=dispenser.dispense, args=(payload,), daemon=True)
+        dispense_thread = threading.Thread(target=_run_dispense, args=(dispenser, payload), daemon=True)
         dispense_thread.start()
         
-        logger.info(f"Dispense started in background for sale {payload.sale_id}, {payload.volume_ml}ml")
+        logger.info(f"Dispense started in background for sale {payload.sale_id}, {payload.volume_ml}ml, tap {payload.tap_id}")
         
         return jsonify({
             "authorized": True,
             "result": {
                 "status": "dispensing",
+                "tap_id": payload.tap_id,
                 "sale_id": payload.sale_id,
                 "volume_authorized_ml": payload.volume_ml,
                 "message": "Dispensing in progress..."
@@ -165,17 +225,104 @@ def authorize():
         }), 500
 
 
+@app.route('/edge/dispense/stream', methods=['GET'])
+def dispense_stream():
+    """
+    Live dispense events as Server-Sent Events
+    
+    Events:
+    - status:   dispenser state transitions (same shape as status.dispenser)
+    - progress: volume_dispensed_ml, percentage, flow_rate_ml_s
+    - result:   final DispenseResult (with its completion seq) when a pour ends
+    - watchdog: the pump watchdog forced the pump off (deadline_s, elapsed_s)
+    
+    Events carry tap_id. With ?tap_id=N only that tap's events are sent.
+    
+    A comment line is sent every 15s of silence to keep proxies and the
+    browser EventSource from timing out.
+    """
+    try:
+        tap_id = _requested_tap_id()
+    except ValueError:
+        return jsonify({"error": "Invalid tap_id"}), 400
+    if tap_id is not None and dispensers.get(tap_id) is None:
+        return jsonify({"error": f"Unknown tap {tap_id}"}), 404
+    
+    events = dispensers.events.subscribe(tap_id)
+    initial_statuses = [
+        d.get_status() for d in dispensers.all()
+        if tap_id is None or d.tap_id == tap_id
+    ]
+    
+    def generate():
+        try:
+            for initial_status in initial_statuses:
+                yield f"event: status\ndata: {json.dumps(initial_status)}\n\n"
+            while True:
+                try:
+                    event = events.get(timeout=15)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield event.to_sse()
+        finally:
+            dispensers.events.unsubscribe(events)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
+@app.route('/edge/dispense/result/<sale_id>', methods=['GET'])
+def dispense_result(sale_id):
+    """
+    Outcome of a finished dispense
+    
+    Taps return to idle as soon as a pour ends; the result stays here
+    (and as "last_result" in the tap status) for COMPLETION_TTL seconds.
+    404 while the sale is still pouring, unknown or expired.
+    """
+    completion = dispensers.completions.get(sale_id)
+    if completion is None:
+        return jsonify({"error": "Result not found"}), 404
+    return jsonify(completion.to_dict())
+
+
 @app.route('/edge/cancel', methods=['POST'])
 def cancel():
-    """Cancel current dispense operation"""
+    """
+    Cancel the current dispense of a tap
+    
+    Request (optional):
+    { "tap_id": 1 }  (default tap when omitted)
+    """
+    try:
+        tap_id = _requested_tap_id(request.get_json(silent=True))
+    except ValueError:
+        return jsonify({"success": False, "message": "Invalid tap_id"}), 400
+    
+    dispenser = dispensers.get(tap_id)
+    if dispenser is None:
+        return jsonify({
+            "success": False,
+            "message": f"Unknown tap {tap_id}"
+        }), 404
+    
     if dispenser.cancel():
         return jsonify({
             "success": True,
+            "tap_id": dispenser.tap_id,
             "message": "Dispense cancelled"
         })
     else:
         return jsonify({
             "success": False,
+            "tap_id": dispenser.tap_id,
             "message": "No active dispense to cancel"
         }), 400
 
@@ -197,6 +344,32 @@ def force_sync():
         }), 500
 
 
+@app.route('/edge/telemetry/<consumption_id>', methods=['GET'])
+def pulse_telemetry(consumption_id):
+    """
+    Pulse trace of one pour
+    
+    JSON by default (deltas in microseconds plus a summary). With
+    ?format=binary the stored little-endian samples are returned as-is;
+    X-Sample-Width gives the sample size in bytes (2 or 4).
+    """
+    trace = telemetry_store.get_trace(consumption_id, as_numpy=False)
+    if trace is None:
+        return jsonify({"error": "Trace not found"}), 404
+    
+    if request.args.get('format') == 'binary':
+        width, blob = telemetry_store.encode(trace)
+        return Response(blob, mimetype='application/octet-stream', headers={
+            "X-Sample-Width": str(width),
+            "X-Pulse-Count": str(trace.pulse_count),
+            "X-Tap-Id": str(trace.tap_id)
+        })
+    
+    dispenser = dispensers.get(trace.tap_id)
+    pulses_per_liter = dispenser.pulses_per_liter if dispenser else None
+    return jsonify(trace.to_dict(pulses_per_liter))
+
+
 @app.route('/edge/maintenance', methods=['POST'])
 def maintenance():
     """
@@ -225,7 +398,7 @@ def test_dispense():
     Test dispense without payment (development only)
     
     Request:
-    { "volume_ml": 100, "beverage_id": "optional" }
+    { "volume_ml": 100, "beverage_id": "optional", "tap_id": 1 }
     """
     if not config.server.DEBUG:
         return jsonify({"error": "Only available in debug mode"}), 403
@@ -233,13 +406,16 @@ def test_dispense():
     data = request.get_json() or {}
     volume_ml = data.get('volume_ml', 100)
     beverage_id = data.get('beverage_id', 'test-beverage')
+    dispenser = dispensers.get(data.get('tap_id'))
+    if dispenser is None:
+        return jsonify({"error": f"Unknown tap {data.get('tap_id')}"}), 404
     
     # Generate test token
     test_token = token_validator.generate_token(
         sale_id=f"TEST-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}",
         beverage_id=beverage_id,
         volume_ml=volume_ml,
-        tap_id=1
+        tap_id=dispenser.tap_id
     )
     
     # Validate and dispense
@@ -480,14 +656,26 @@ def startup():
     database.initialize()
     logger.info("✅ Database initialized")
     
-    # Initialize GPIO
-    gpio_controller.initialize()
-    logger.info("✅ GPIO initialized")
+    # Restore the HMAC key ring and replay protection from before the restart
+    token_validator.load_persisted_keys()
+    token_validator.load_used_tokens()
+    
+    # Start write-behind consumption writer
+    consumption_writer.start()
+    logger.info("✅ Consumption writer started")
+    
+    # Initialize GPIO of every tap
+    dispensers.initialize()
+    logger.info(f"✅ GPIO initialized ({len(dispensers.all())} taps)")
     
     # Start sync service
     sync_service.start()
     logger.info("✅ Sync service started")
     
+    # Start retention job (prunes, rolls up and archives old data)
+    retention_manager.start()
+    logger.info("✅ Retention manager started")
+    
     logger.info(f"✅ EDGE Server ready on {config.server.HOST}:{config.server.PORT}")
 
 
@@ -495,24 +683,35 @@ def shutdown():
     """Clean up on shutdown"""
     logger.info("🛑 Shutting down EDGE Server...")
     
+    # Stop retention job
+    retention_manager.stop()
+    logger.info("  Retention manager stopped")
+    
     # Stop sync service
     sync_service.stop()
     logger.info("  Sync service stopped")
     
-    # Clean up GPIO
-    gpio_controller.cleanup()
+    # Stop pours and clean up GPIO of every tap
+    dispensers.cleanup()
     logger.info("  GPIO cleaned up")
     
+    # Flush queued consumption records before closing the database
+    consumption_writer.stop()
+    logger.info("  Consumption writer flushed")
+    
+    # Close persistent database connections
+    database.close()
+    logger.info("  Database connections closed")
+    
     logger.info("👋 EDGE Server stopped")
 
 
-# Register shutdown handler
-atexit.register(shutdown)
-
-
 # ==================== Main ====================
 
 if __name__ == '__main__':
+    # Registered here, not at import: the controller process re-imports
+    # this module (spawn) and must not run the server's shutdown
+    atexit.register(shutdown)
     startup()
     
     app.run(
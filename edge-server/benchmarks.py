@@ -0,0 +1,257 @@
+"""
+Benchmarks for EDGE Server
+Micro-benchmarks for the hot paths of the edge (run on the target Pi)
+
+Usage:
+    python benchmarks.py db [--ops 2000]
+    python benchmarks.py writer [--ops 2000]
+    python benchmarks.py tokens [--ops 2000] [--live 10000 100000]
+    python benchmarks.py token-format [--ops 20000]
+"""
+import os
+import sys
+import time
+import uuid
+import sqlite3
+import heapq
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+
+from database import Database
+from token_validator import TokenValidator
+
+
+# ==================== Helpers ====================
+
+def _report(name: str, ops: int, elapsed: float):
+    """Print a single benchmark line"""
+    rate = ops / elapsed if elapsed > 0 else float("inf")
+    print(f"  {name:<32} {ops:>8} ops  {elapsed:8.3f}s  {rate:>12,.0f} ops/s")
+
+
+def _timed(fn, ops: int) -> float:
+    start = time.perf_counter()
+    for i in range(ops):
+        fn(i)
+    return time.perf_counter() - start
+
+
+# ==================== Database ====================
+
+class _ConnectPerCallDatabase(Database):
+    """Baseline: new rollback-journal connection for every call"""
+
+    @contextmanager
+    def get_connection(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    get_read_connection = get_connection
+
+
+def _run_db_workload(db: Database, ops: int):
+    started = datetime.utcnow()
+    finished = started + timedelta(seconds=5)
+    record_ids = []
+
+    def save(i):
+        record = db.save_consumption(
+            sale_id=f"bench-{uuid.uuid4()}",
+            token_id=None,
+            beverage_id="550e8400-e29b-41d4-a716-446655440001",
+            tap_id=1,
+            volume_authorized_ml=300,
+            volume_dispensed_ml=299.5,
+            started_at=started,
+            finished_at=finished,
+            pulse_count=135,
+            flow_rate_avg=60.0,
+        )
+        record_ids.append(record.id)
+
+    _report("save_consumption", ops, _timed(save, ops))
+    _report("get_consumption", ops, _timed(lambda i: db.get_consumption(record_ids[i]), ops))
+    _report("is_token_used", ops, _timed(lambda i: db.is_token_used(f"nonce-{i}"), ops))
+    stats_ops = max(1, ops // 10)
+    _report("get_consumption_stats", stats_ops, _timed(lambda i: db.get_consumption_stats(), stats_ops))
+
+
+def bench_db(ops: int):
+    """Compare connect-per-call (before) with persistent WAL connections (after)"""
+    for label, cls in (("before: connect per call", _ConnectPerCallDatabase),
+                       ("after: persistent WAL", Database)):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = cls(os.path.join(tmp, "bench.db"))
+            db.initialize()
+            print(f"\n{label}")
+            _run_db_workload(db, ops)
+            db.close()
+
+
+# ==================== Consumption Writer ====================
+
+def bench_writer(ops: int):
+    """Caller-side latency of save_consumption (inline) vs write-behind submit"""
+    import consumption_writer as writer_module
+    
+    started = datetime.utcnow()
+    finished = started + timedelta(seconds=5)
+    
+    def fields():
+        return dict(
+            sale_id=f"bench-{uuid.uuid4()}",
+            token_id=None,
+            beverage_id="550e8400-e29b-41d4-a716-446655440001",
+            tap_id=1,
+            volume_authorized_ml=300,
+            volume_dispensed_ml=299.5,
+            started_at=started,
+            finished_at=finished,
+            pulse_count=135,
+            flow_rate_avg=60.0,
+        )
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "bench.db"))
+        db.initialize()
+        
+        print("\nbefore: inline save_consumption")
+        _report("save_consumption", ops, _timed(lambda i: db.save_consumption(**fields()), ops))
+        
+        # Point the writer at the benchmark database
+        writer_module.database = db
+        writer = writer_module.ConsumptionWriter()
+        writer.start()
+        
+        print("\nafter: write-behind writer")
+        _report("submit (caller side)", ops,
+                _timed(lambda i: writer.submit(db.build_consumption(**fields())), ops))
+        start = time.perf_counter()
+        writer.wait_idle()
+        _report("drain to disk", ops, time.perf_counter() - start)
+        writer.stop()
+        print(f"  {writer.transactions} transactions for {writer.records_written} records")
+        db.close()
+
+
+# ==================== Token Validator ====================
+
+class _ScanCleanupValidator(TokenValidator):
+    """Baseline: full scan of the used-token cache on every validation"""
+    
+    def _cleanup_used_tokens(self):
+        with self._lock:
+            current_time = time.time()
+            expired = [nonce for nonce, expiry in self.used_tokens.items()
+                       if current_time > expiry]
+            for nonce in expired:
+                del self.used_tokens[nonce]
+
+
+def bench_tokens(ops: int, live_counts):
+    """validate_token latency with N live nonces: scan (before) vs expiry heap (after)"""
+    for live in live_counts:
+        print(f"\n{live:,} live nonces")
+        for label, cls in (("before: scan cleanup", _ScanCleanupValidator),
+                           ("after: expiry heap", TokenValidator)):
+            validator = cls(hmac_secret="bench-secret")
+            validator.persist_used_tokens = False  # in-memory path only
+            now = time.time()
+            
+            # Live nonces spread over the TTL window; a few expire during the run
+            for i in range(live):
+                expiry = now + (i % 300) + 1
+                validator.used_tokens[f"live-{i}"] = expiry
+                validator._expiry_heap.append((expiry, f"live-{i}"))
+            heapq.heapify(validator._expiry_heap)
+            
+            tokens = [
+                validator.generate_token(
+                    sale_id=f"bench-{i}",
+                    beverage_id="550e8400-e29b-41d4-a716-446655440001",
+                    volume_ml=300,
+                    tap_id=1
+                )
+                for i in range(ops)
+            ]
+            
+            def validate(i):
+                valid, _, error = validator.validate_token(tokens[i])
+                assert valid, error
+            
+            elapsed = _timed(validate, ops)
+            _report(label, ops, elapsed)
+            print(f"  {'':<32} {elapsed / ops * 1e6:>8.1f} µs per validation")
+
+
+def bench_token_format(ops: int):
+    """Encoded size and parse+verify time: JSON vs binary tokens"""
+    from config import config
+    
+    validator = TokenValidator(hmac_secret="bench-secret")
+    single_use = config.security.SINGLE_USE_TOKENS
+    config.security.SINGLE_USE_TOKENS = False  # measure parse + verify only
+    
+    sale_id = str(uuid.uuid4())
+    beverage_id = "550e8400-e29b-41d4-a716-446655440001"
+    
+    try:
+        for label, binary in (("before: base64 JSON", False), ("after: binary v1", True)):
+            token = validator.generate_token(sale_id, beverage_id, 500, 1, binary=binary)
+            
+            def validate(i):
+                valid, _, error = validator.validate_token(token)
+                assert valid, error
+            
+            print(f"\n{label}")
+            print(f"  {'encoded size':<32} {len(token):>8} chars")
+            elapsed = _timed(validate, ops)
+            _report("validate_token", ops, elapsed)
+            print(f"  {'':<32} {elapsed / ops * 1e6:>8.1f} µs per validation")
+    finally:
+        config.security.SINGLE_USE_TOKENS = single_use
+
+
+# ==================== Main ====================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EDGE Server benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    db_parser = sub.add_parser("db", help="SQLite connection management")
+    db_parser.add_argument("--ops", type=int, default=2000)
+
+    writer_parser = sub.add_parser("writer", help="Write-behind consumption writer")
+    writer_parser.add_argument("--ops", type=int, default=2000)
+    
+    tokens_parser = sub.add_parser("tokens", help="Token validation with many live nonces")
+    tokens_parser.add_argument("--ops", type=int, default=2000)
+    tokens_parser.add_argument("--live", type=int, nargs="+", default=[10000, 100000])
+    
+    format_parser = sub.add_parser("token-format", help="JSON vs binary token parse+verify")
+    format_parser.add_argument("--ops", type=int, default=20000)
+    
+    args = parser.parse_args(argv)
+
+    if args.bench == "db":
+        bench_db(args.ops)
+    elif args.bench == "writer":
+        bench_writer(args.ops)
+    elif args.bench == "tokens":
+        bench_tokens(args.ops, args.live)
+    elif args.bench == "token-format":
+        bench_token_format(args.ops)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""
+Rolling Bloom Filter for EDGE Server
+Fast negative lookups for recently used token nonces
+
+Two generations are kept: items are added to the current one and looked
+up in both. The current generation becomes the previous one every
+window_seconds, so anything added during the last window is always
+found, and older items age out without ever removing bits.
+"""
+import math
+import hashlib
+from threading import Lock
+from typing import Optional
+
+from clock import Clock, system_clock
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings (double hashing on blake2b)"""
+    
+    def __init__(self, capacity: int, error_rate: float):
+        capacity = max(1, capacity)
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+    
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+    
+    def add(self, item: str):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+    
+    def __contains__(self, item: str) -> bool:
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RollingBloomFilter:
+    """
+    Thread-safe two-generation Bloom filter
+    
+    may_contain() never returns False for an item added within the last
+    window_seconds; True may be a false positive and must be confirmed
+    against the authoritative store.
+    """
+    
+    def __init__(self, capacity: int, error_rate: float, window_seconds: float,
+                 clock: Optional[Clock] = None):
+        self.clock = clock or system_clock
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.window_seconds = window_seconds
+        self._lock = Lock()
+        self._current = BloomFilter(capacity, error_rate)
+        self._previous = BloomFilter(capacity, error_rate)
+        self._rotated_at = self.clock.monotonic()
+    
+    def _maybe_rotate(self):
+        """Start a new generation once the window has passed (lock held)"""
+        if (self.clock.monotonic() - self._rotated_at >= self.window_seconds
+                or self._current.count >= self.capacity):
+            self._previous = self._current
+            self._current = BloomFilter(self.capacity, self.error_rate)
+            self._rotated_at = self.clock.monotonic()
+    
+    def add(self, item: str):
+        with self._lock:
+            self._maybe_rotate()
+            self._current.add(item)
+    
+    def may_contain(self, item: str) -> bool:
+        with self._lock:
+            self._maybe_rotate()
+            return item in self._current or item in self._previous
+    
+    def clear(self):
+        with self._lock:
+            self._current = BloomFilter(self.capacity, self.error_rate)
+            self._previous = BloomFilter(self.capacity, self.error_rate)
+            self._rotated_at = self.clock.monotonic()
+    
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                "size_bits": self._current.size,
+                "hash_count": self._current.hash_count,
+                "current_items": self._current.count,
+                "previous_items": self._previous.count,
+                "window_seconds": self.window_seconds
+            }
@@ -0,0 +1,451 @@
+"""
+Flow Calibration for EDGE Server
+Fits pulses-per-liter per tap from measured pours and emptied kegs
+
+Observations (each one: a known volume and the pours that delivered it):
+- reference pours: an operator measures what one recorded pour really
+  delivered (`python calibration.py reference <consumption_id> <ml>`)
+- kegs: a keg of known volume emptied between two refills. The pulses
+  come from the local consumptions in that window. Windows are built
+  from the SaaS StockRefill records (`fit --refills`) or entered by hand
+  (`python calibration.py keg ...`)
+
+Pours are put in flow bands by their average pulse rate
+(pulse_count / duration_seconds), so every observation reads
+volume = sum(pulses in band b * ml_per_pulse[b]). ml_per_pulse is solved
+with a NumPy least squares on relative error. Without bands this is a
+single pulses-per-liter per tap.
+
+Fits are stored in the flow_calibration table. GPIOController picks them
+up between pours (get_flow_reading), so no restart is needed. NumPy is
+only needed to fit, not to apply a calibration.
+
+Usage:
+    python calibration.py reference <consumption_id> <measured_ml>
+    python calibration.py keg <tap_id> <since> <until> <volume_ml>
+    python calibration.py fit [--tap 1] [--bands 15,30] [--refills] [--save]
+    python calibration.py show
+    python calibration.py clear <tap_id>
+"""
+import sys
+import json
+import time
+import argparse
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Tuple
+
+from config import config
+from database import database
+
+# NumPy is optional at runtime (only the fit needs it)
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+@dataclass
+class TapCalibration:
+    """Fitted coefficients of one tap"""
+    tap_id: int
+    pulses_per_liter: float
+    # (upper pulse rate in pulses/s or None for the last band, pulses_per_liter)
+    bands: List[Tuple[Optional[float], float]] = field(default_factory=list)
+    observations: int = 0
+    rms_error_pct: Optional[float] = None
+    fitted_at: Optional[str] = None
+    
+    def pulses_per_liter_at(self, pulse_rate: float) -> float:
+        """Coefficient for a pour averaging pulse_rate pulses/s"""
+        for upper, pulses_per_liter in self.bands:
+            if upper is None or pulse_rate < upper:
+                return pulses_per_liter
+        return self.pulses_per_liter
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "tap_id": self.tap_id,
+            "pulses_per_liter": round(self.pulses_per_liter, 2),
+            "bands": [
+                {"max_pulse_rate": upper, "pulses_per_liter": round(ppl, 2)}
+                for upper, ppl in self.bands
+            ],
+            "observations": self.observations,
+            "rms_error_pct": self.rms_error_pct,
+            "fitted_at": self.fitted_at
+        }
+    
+    @classmethod
+    def from_row(cls, row: Dict[str, Any]) -> 'TapCalibration':
+        return cls(
+            tap_id=row["tap_id"],
+            pulses_per_liter=row["pulses_per_liter"],
+            bands=[(upper, ppl) for upper, ppl in json.loads(row["bands"] or "[]")],
+            observations=row["observations"],
+            rms_error_pct=row["rms_error_pct"],
+            fitted_at=row["fitted_at"]
+        )
+
+
+@dataclass
+class Observation:
+    """A known volume and the pours (pulse counts, durations) that delivered it"""
+    tap_id: int
+    kind: str                 # "pour" or "keg"
+    label: str
+    volume_ml: float
+    pulses: List[int]
+    durations: List[float]
+
+
+@dataclass
+class FitResult:
+    calibration: TapCalibration
+    nominal_pulses_per_liter: float
+    residuals: List[Dict[str, Any]]
+
+
+def nominal_pulses_per_liter(tap_id: int) -> float:
+    """Configured (uncalibrated) pulses_per_liter of a tap"""
+    tap = config.TAPS.get(tap_id, {})
+    return tap.get("pulses_per_liter") or config.gpio.PULSES_PER_LITER
+
+
+# ==================== Observations ====================
+
+def reference_observations(tap_id: Optional[int] = None) -> List[Observation]:
+    """Reference pours and hand-entered kegs from calibration_references"""
+    observations = []
+    for ref in database.get_calibration_references(tap_id):
+        if ref["kind"] == "pour":
+            observations.append(Observation(
+                tap_id=ref["tap_id"], kind="pour", label=f"pour {ref['consumption_id'][:8]}",
+                volume_ml=ref["volume_ml"],
+                pulses=[ref["pulse_count"]], durations=[ref["duration_seconds"]]
+            ))
+        elif ref["kind"] == "keg":
+            observation = _keg_observation(ref["tap_id"], ref["window_start"], ref["window_end"],
+                                           ref["volume_ml"], require_dry=False)
+            if observation:
+                observations.append(observation)
+    return observations
+
+
+def refill_observations(refills: List[Dict[str, Any]], tap_id: Optional[int] = None) -> List[Observation]:
+    """
+    Emptied kegs from SaaS StockRefill records
+    
+    Two consecutive full refills of a tap bound one keg. Its volume is the
+    first refill's stock_after_ml less KEG_RESIDUAL_ML. The window is used
+    only if the keg visibly ran dry (a no-flow / low-flow cutoff among its
+    last pours), since the SaaS stock level itself comes from pulse counts.
+    """
+    by_tap: Dict[int, List[Dict[str, Any]]] = {}
+    for refill in refills:
+        if tap_id is None or refill["tap_number"] == tap_id:
+            by_tap.setdefault(refill["tap_number"], []).append(refill)
+    
+    observations = []
+    for tap, tap_refills in by_tap.items():
+        tap_refills.sort(key=lambda r: r["refilled_at"])
+        for current, following in zip(tap_refills, tap_refills[1:]):
+            if current["refill_type"] != "full" or following["refill_type"] != "full":
+                continue
+            volume = (current["stock_after_ml"] or current["quantity_ml"]) - config.calibration.KEG_RESIDUAL_ML
+            observation = _keg_observation(tap, _local_time(current["refilled_at"]),
+                                           _local_time(following["refilled_at"]), volume, require_dry=True)
+            if observation:
+                observations.append(observation)
+    return observations
+
+
+def _local_time(value: str) -> str:
+    """SaaS datetime -> the naive UTC isoformat used by consumptions.started_at"""
+    return value.replace("Z", "").split("+")[0]
+
+
+def _keg_observation(tap_id: int, since: str, until: str, volume_ml: float,
+                     require_dry: bool) -> Optional[Observation]:
+    if volume_ml <= 0 or database.has_pruned_pours(tap_id, since):
+        return None
+    
+    samples = database.get_pour_samples(tap_id, since, until)
+    if not samples:
+        return None
+    if require_dry:
+        last = samples[-config.calibration.DRY_CUTOFF_POURS:]
+        if not any(s["cutoff_reason"] in ("no_flow", "low_flow") for s in last):
+            return None
+    
+    return Observation(
+        tap_id=tap_id, kind="keg", label=f"keg {since[:10]}..{until[:10]}",
+        volume_ml=volume_ml,
+        pulses=[s["pulse_count"] for s in samples],
+        durations=[s["duration_seconds"] for s in samples]
+    )
+
+
+# ==================== Fit ====================
+
+def fit_tap(tap_id: int, observations: List[Observation],
+            band_edges_ml_s: Optional[List[float]] = None) -> FitResult:
+    """
+    Least-squares pulses_per_liter (overall and per flow band) for one tap
+    
+    band_edges_ml_s are flow rates at the nominal coefficient; they are
+    stored as pulse rates. Bands without pours, or a band solution that is
+    rank-deficient or non-positive, fall back to the overall coefficient.
+    Raises ValueError if there is too little data or the fit is implausible.
+    """
+    if np is None:
+        raise RuntimeError("NumPy is required to fit a calibration (pip install numpy)")
+    
+    settings = config.calibration
+    observations = [o for o in observations if o.tap_id == tap_id]
+    if len(observations) < settings.MIN_OBSERVATIONS:
+        raise ValueError(f"Tap {tap_id}: {len(observations)} observations, "
+                         f"need {settings.MIN_OBSERVATIONS}")
+    
+    nominal = nominal_pulses_per_liter(tap_id)
+    edges = np.sort(np.asarray(band_edges_ml_s or [], dtype=float)) * nominal / 1000
+    n_bands = len(edges) + 1
+    
+    # Every pour of every observation, tagged with its observation row
+    rows = np.repeat(np.arange(len(observations)), [len(o.pulses) for o in observations])
+    pulses = np.concatenate([np.asarray(o.pulses, dtype=float) for o in observations])
+    durations = np.concatenate([np.asarray(o.durations, dtype=float) for o in observations])
+    rates = np.divide(pulses, durations, out=np.zeros_like(pulses), where=durations > 0)
+    
+    # A[i, b] = pulses of observation i in band b
+    A = np.zeros((len(observations), n_bands))
+    np.add.at(A, (rows, np.digitize(rates, edges)), pulses)
+    volumes = np.array([o.volume_ml for o in observations], dtype=float)
+    
+    # Relative error: divide each row by its volume (so a keg weighs like a pour)
+    weights = 1.0 / volumes
+    total = A.sum(axis=1)
+    ml_per_pulse, *_ = np.linalg.lstsq((total * weights)[:, None], volumes * weights, rcond=None)
+    overall = float(ml_per_pulse[0])
+    if overall <= 0:
+        raise ValueError(f"Tap {tap_id}: fit failed (non-positive coefficient)")
+    pulses_per_liter = 1000 / overall
+    
+    correction = pulses_per_liter / nominal - 1
+    if abs(correction) > settings.MAX_CORRECTION:
+        raise ValueError(f"Tap {tap_id}: fitted {pulses_per_liter:.1f} pulses/L is "
+                         f"{correction:+.0%} from nominal {nominal:.1f}")
+    
+    coefficients = np.full(n_bands, overall)
+    if n_bands > 1:
+        used = A.any(axis=0)
+        solution, _, rank, _ = np.linalg.lstsq(A[:, used] * weights[:, None], volumes * weights, rcond=None)
+        if rank == used.sum() and np.all(solution > 0):
+            coefficients[used] = solution
+    
+    predicted = A @ coefficients
+    errors_pct = (predicted - volumes) / volumes * 100
+    rms = float(np.sqrt(np.mean(errors_pct ** 2)))
+    
+    bands = []
+    if n_bands > 1:
+        uppers = [float(edge) for edge in edges] + [None]
+        bands = [(upper, 1000 / float(c)) for upper, c in zip(uppers, coefficients)]
+    
+    calibration = TapCalibration(
+        tap_id=tap_id,
+        pulses_per_liter=pulses_per_liter,
+        bands=bands,
+        observations=len(observations),
+        rms_error_pct=round(rms, 3),
+        fitted_at=datetime.utcnow().isoformat()
+    )
+    residuals = [
+        {
+            "label": o.label,
+            "kind": o.kind,
+            "pours": len(o.pulses),
+            "volume_ml": o.volume_ml,
+            "predicted_ml": round(float(p), 1),
+            "nominal_ml": round(float(t) * 1000 / nominal, 1),
+            "error_pct": round(float(e), 2)
+        }
+        for o, p, t, e in zip(observations, predicted, total, errors_pct)
+    ]
+    return FitResult(calibration, nominal, residuals)
+
+
+# ==================== Store ====================
+
+class CalibrationStore:
+    """
+    Cached view of flow_calibration for the GPIO controllers
+    
+    Rereads the table at most every RELOAD_SECONDS, so fits saved by the
+    CLI (another process) apply without a restart. Unchanged calibrations
+    keep their object, so callers can compare by identity.
+    """
+    
+    def __init__(self):
+        self.settings = config.calibration
+        self._lock = threading.Lock()
+        self._calibrations: Dict[int, TapCalibration] = {}
+        self._loaded_at: Optional[float] = None
+    
+    def get(self, tap_id: int) -> Optional[TapCalibration]:
+        now = time.monotonic()
+        if self._loaded_at is None or now - self._loaded_at >= self.settings.RELOAD_SECONDS:
+            self.reload()
+        return self._calibrations.get(tap_id)
+    
+    def reload(self):
+        try:
+            rows = database.get_flow_calibrations()
+        except Exception as e:
+            print(f"⚠️ Failed to load flow calibration: {e}")
+            rows = None
+        
+        with self._lock:
+            self._loaded_at = time.monotonic()
+            if rows is None:
+                return
+            calibrations = {}
+            for row in rows:
+                calibration = TapCalibration.from_row(row)
+                previous = self._calibrations.get(calibration.tap_id)
+                calibrations[calibration.tap_id] = previous if previous == calibration else calibration
+            self._calibrations = calibrations
+    
+    def save(self, calibration: TapCalibration):
+        database.save_flow_calibration(
+            calibration.tap_id,
+            calibration.pulses_per_liter,
+            json.dumps(calibration.bands),
+            calibration.observations,
+            calibration.rms_error_pct,
+            calibration.fitted_at
+        )
+        self.reload()
+    
+    def clear(self, tap_id: int) -> bool:
+        removed = database.delete_flow_calibration(tap_id)
+        self.reload()
+        return removed
+
+
+# Global calibration store instance
+calibration_store = CalibrationStore()
+
+
+# ==================== CLI ====================
+
+def _print_fit(result: FitResult):
+    calibration = result.calibration
+    print(f"\n📐 Tap {calibration.tap_id}: {calibration.pulses_per_liter:.2f} pulses/L "
+          f"(nominal {result.nominal_pulses_per_liter:.2f}, "
+          f"{calibration.pulses_per_liter / result.nominal_pulses_per_liter - 1:+.2%})")
+    for upper, ppl in calibration.bands:
+        limit = f"< {upper:.1f} pulses/s" if upper is not None else "rest"
+        print(f"  band {limit:<20} {ppl:.2f} pulses/L")
+    print(f"  {'observation':<28} {'pours':>5} {'actual':>9} {'nominal':>9} {'fitted':>9} {'error':>8}")
+    for r in result.residuals:
+        print(f"  {r['label']:<28} {r['pours']:>5} {r['volume_ml']:>9.1f} "
+              f"{r['nominal_ml']:>9.1f} {r['predicted_ml']:>9.1f} {r['error_pct']:>+7.2f}%")
+    print(f"  RMS error {calibration.rms_error_pct:.2f}% over {calibration.observations} observations")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EDGE flow-sensor calibration")
+    commands = parser.add_subparsers(dest="command", required=True)
+    
+    reference = commands.add_parser("reference", help="record a measured pour")
+    reference.add_argument("consumption_id")
+    reference.add_argument("measured_ml", type=float)
+    
+    keg = commands.add_parser("keg", help="record an emptied keg")
+    keg.add_argument("tap_id", type=int)
+    keg.add_argument("since", help="UTC ISO time the keg was connected")
+    keg.add_argument("until", help="UTC ISO time the keg was replaced")
+    keg.add_argument("volume_ml", type=float)
+    
+    fit = commands.add_parser("fit", help="fit taps and report residuals")
+    fit.add_argument("--tap", type=int, help="only this tap")
+    fit.add_argument("--bands", default="", help="flow band edges in ml/s, e.g. 15,30")
+    fit.add_argument("--refills", action="store_true", help="add kegs from SaaS refills")
+    fit.add_argument("--save", action="store_true", help="store the fit (applied on the next pour)")
+    
+    commands.add_parser("show", help="show stored calibrations")
+    
+    clear = commands.add_parser("clear", help="remove a tap's calibration")
+    clear.add_argument("tap_id", type=int)
+    
+    args = parser.parse_args(argv)
+    database.initialize()
+    
+    if args.command == "reference":
+        record = database.get_consumption(args.consumption_id)
+        if record is None:
+            print(f"❌ Consumption {args.consumption_id} not found")
+            return 1
+        database.add_calibration_reference(
+            record.tap_id, "pour", args.measured_ml, consumption_id=record.id,
+            pulse_count=record.pulse_count, duration_seconds=record.duration_seconds
+        )
+        print(f"✅ Reference pour on tap {record.tap_id}: {record.pulse_count} pulses = {args.measured_ml}ml")
+    
+    elif args.command == "keg":
+        database.add_calibration_reference(
+            args.tap_id, "keg", args.volume_ml,
+            window_start=_local_time(args.since), window_end=_local_time(args.until)
+        )
+        print(f"✅ Keg on tap {args.tap_id}: {args.volume_ml}ml from {args.since} to {args.until}")
+    
+    elif args.command == "fit":
+        observations = reference_observations(args.tap)
+        if args.refills:
+            from sync_service import sync_service
+            refills = sync_service.fetch_refills()
+            if refills is None:
+                print("⚠️ SaaS refills unavailable - fitting without them")
+            else:
+                observations += refill_observations(refills, args.tap)
+        
+        bands = [float(edge) for edge in args.bands.split(",") if edge.strip()]
+        taps = [args.tap] if args.tap is not None else sorted({o.tap_id for o in observations})
+        if not taps:
+            print("⚠️ No calibration observations recorded")
+            return 1
+        
+        failed = False
+        for tap_id in taps:
+            try:
+                result = fit_tap(tap_id, observations, bands)
+            except ValueError as e:
+                print(f"⚠️ {e}")
+                failed = True
+                continue
+            _print_fit(result)
+            if args.save:
+                calibration_store.save(result.calibration)
+                print(f"💾 Saved - tap {tap_id} uses it from its next pour")
+        return 1 if failed else 0
+    
+    elif args.command == "show":
+        calibration_store.reload()
+        for tap_id in sorted(config.TAPS):
+            calibration = calibration_store.get(tap_id)
+            if calibration is None:
+                print(f"Tap {tap_id}: nominal {nominal_pulses_per_liter(tap_id):.2f} pulses/L (not calibrated)")
+            else:
+                print(f"Tap {tap_id}: {json.dumps(calibration.to_dict())}")
+    
+    elif args.command == "clear":
+        if calibration_store.clear(args.tap_id):
+            print(f"🗑️ Tap {args.tap_id} back to nominal {nominal_pulses_per_liter(args.tap_id):.2f} pulses/L")
+    
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
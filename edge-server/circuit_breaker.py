@@ -0,0 +1,121 @@
+"""
+Circuit Breaker for EDGE Server
+Stops calling the SaaS while it is down and probes it back to health
+
+States:
+- CLOSED:    requests flow, consecutive failures are counted
+- OPEN:      requests are rejected until reset_timeout has passed
+- HALF_OPEN: a single trial request decides between CLOSED and OPEN
+"""
+import threading
+from enum import Enum
+from typing import Optional, Dict, Any
+
+from clock import Clock, system_clock
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the circuit is open"""
+    pass
+
+
+class CircuitBreaker:
+    """
+    Thread-safe circuit breaker
+
+    Callers ask allow_request() before a call and report the outcome with
+    record_success() / record_failure(). Outcomes of normal traffic and of
+    health probes are treated the same way.
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0,
+                 clock: Optional[Clock] = None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock or system_clock
+
+        self._lock = threading.Lock()
+        self._state = CircuitState.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self._last_change: float = self.clock.monotonic()
+
+    def _refresh_state(self):
+        """OPEN -> HALF_OPEN once reset_timeout has elapsed (lock held)"""
+        if (self._state == CircuitState.OPEN
+                and self.clock.monotonic() - self._opened_at >= self.reset_timeout):
+            self._set_state(CircuitState.HALF_OPEN)
+
+    def _set_state(self, state: CircuitState):
+        if state != self._state:
+            print(f"🔌 Circuit {self._state.value} -> {state.value}")
+            self._state = state
+            self._last_change = self.clock.monotonic()
+        if state == CircuitState.OPEN:
+            self._opened_at = self.clock.monotonic()
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> CircuitState:
+        with self._lock:
+            self._refresh_state()
+            return self._state
+
+    def is_open(self) -> bool:
+        """True while calls would be rejected (no side effects)"""
+        return self.state == CircuitState.OPEN
+
+    def allow_request(self) -> bool:
+        """
+        Ask permission for a call
+
+        In HALF_OPEN only one trial call is let through at a time.
+        """
+        with self._lock:
+            self._refresh_state()
+
+            if self._state == CircuitState.CLOSED:
+                return True
+
+            if self._state == CircuitState.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+
+            return False
+
+    def record_success(self):
+        """Report a successful call"""
+        with self._lock:
+            self._consecutive_failures = 0
+            self._set_state(CircuitState.CLOSED)
+
+    def record_failure(self):
+        """Report a failed call (connection error, timeout, 5xx)"""
+        with self._lock:
+            self._consecutive_failures += 1
+
+            if (self._state == CircuitState.HALF_OPEN
+                    or self._consecutive_failures >= self.failure_threshold):
+                self._set_state(CircuitState.OPEN)
+
+    def get_status(self) -> Dict[str, Any]:
+        """Get breaker status summary"""
+        with self._lock:
+            self._refresh_state()
+            retry_in = None
+            if self._state == CircuitState.OPEN:
+                retry_in = max(0.0, self.reset_timeout - (self.clock.monotonic() - self._opened_at))
+
+            return {
+                "state": self._state.value,
+                "consecutive_failures": self._consecutive_failures,
+                "retry_in_seconds": round(retry_in, 1) if retry_in is not None else None,
+                "state_age_seconds": round(self.clock.monotonic() - self._last_change, 1)
+            }
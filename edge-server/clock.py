@@ -0,0 +1,104 @@
+"""
+Clock for EDGE Server
+Injectable time source for the dispenser, GPIO, sync service and token checks
+
+Clock is real time. VirtualClock only moves when its owner sleeps or
+waits, and runs scheduled callbacks (e.g. simulated flow-sensor pulses)
+at their exact virtual time, so a 30 s pour takes microseconds and
+every run with the same inputs has the same timing.
+"""
+import time
+import heapq
+import itertools
+import threading
+from typing import Callable, List, Optional, Tuple
+
+
+class Clock:
+    """Real time (time.monotonic, time.time, blocking sleep/wait)"""
+    
+    def monotonic(self) -> float:
+        return time.monotonic()
+    
+    def time(self) -> float:
+        """Wall-clock unix seconds"""
+        return time.time()
+    
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            time.sleep(seconds)
+    
+    def wait(self, event: threading.Event, timeout: Optional[float] = None) -> bool:
+        """Event.wait() measured on this clock"""
+        return event.wait(timeout)
+
+
+class VirtualClock(Clock):
+    """
+    Simulated time driven by the thread that uses it
+    
+    sleep() and wait() advance the clock immediately, running every
+    callback scheduled up to the new time in order. wait() returns as
+    soon as a callback sets the event, with the clock at that callback's
+    time. A VirtualClock must be driven from a single thread.
+    """
+    
+    def __init__(self, start: float = 0.0, epoch: Optional[float] = None):
+        self._now = start
+        self._epoch = time.time() if epoch is None else epoch  # time() at monotonic 0
+        self._timers: List[Tuple[float, int, Callable[[], None]]] = []
+        self._seq = itertools.count()
+    
+    def monotonic(self) -> float:
+        return self._now
+    
+    def time(self) -> float:
+        return self._epoch + self._now
+    
+    def call_at(self, when: float, callback: Callable[[], None]):
+        """Run callback once the clock reaches `when` (monotonic seconds)"""
+        heapq.heappush(self._timers, (max(when, self._now), next(self._seq), callback))
+    
+    def call_later(self, delay: float, callback: Callable[[], None]):
+        self.call_at(self._now + delay, callback)
+    
+    def advance(self, seconds: float, until: Optional[threading.Event] = None) -> bool:
+        """
+        Move the clock forward, running due callbacks
+        
+        Stops early when `until` gets set. Returns whether it is set.
+        """
+        target = self._now + max(seconds, 0.0)
+        while self._timers and self._timers[0][0] <= target:
+            if until is not None and until.is_set():
+                return True
+            when, _, callback = heapq.heappop(self._timers)
+            self._now = when
+            callback()
+        
+        if until is not None and until.is_set():
+            return True
+        self._now = target
+        return False
+    
+    def sleep(self, seconds: float):
+        self.advance(seconds)
+    
+    def wait(self, event: threading.Event, timeout: Optional[float] = None) -> bool:
+        if event.is_set():
+            return True
+        if timeout is not None:
+            return self.advance(timeout, until=event)
+        
+        # No timeout: run callbacks until one sets the event or none are left
+        while self._timers and not event.is_set():
+            self.advance(self._timers[0][0] - self._now, until=event)
+        return event.is_set()
+    
+    @property
+    def pending_timers(self) -> int:
+        return len(self._timers)
+
+
+# Global real-time clock (default for every component)
+system_clock = Clock()
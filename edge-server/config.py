@@ -4,6 +4,7 @@ Raspberry Pi GPIO settings, HMAC secrets, and SaaS connection
 """
 import os
 from dataclasses import dataclass
+from typing import Tuple
 
 
 @dataclass
@@ -29,6 +30,22 @@ class GPIOConfig:
     
     # Minimum flow rate threshold (ml/s) - detects empty keg
     MIN_FLOW_RATE: float = 5.0
+    
+    # Rolling flow estimate over the last N pulse timestamps
+    FLOW_WINDOW_PULSES: int = 16
+    
+    # Falling-flow detection (stops the pour before the empty-keg timeout)
+    STALL_INTERVALS: float = 8.0  # no pulse for this many mean intervals = flow stopped
+    MIN_STALL_TIME: float = 0.5   # seconds, lower bound of that stall limit
+    LOW_FLOW_GRACE: float = 1.0   # seconds below MIN_FLOW_RATE before stopping
+    
+    # Pump watchdog: forces the pump off this many seconds after the longest
+    # pour the supervisor allows (priming + volume at MIN_FLOW_RATE, capped
+    # at MAX_DISPENSE_TIME), in case the dispense loop itself is stuck
+    WATCHDOG_GRACE: float = 5.0
+    
+    # Finished-dispense outcomes stay readable by sale_id for this long (seconds)
+    COMPLETION_TTL: float = 120.0
 
 
 @dataclass
@@ -49,6 +66,13 @@ class SecurityConfig:
     
     # Used tokens cache TTL (seconds)
     USED_TOKENS_TTL: int = 300
+    
+    # Persist used nonces in SQLite so replay protection survives restarts
+    PERSIST_USED_TOKENS: bool = True
+    
+    # Rolling Bloom filter in front of the persisted nonces
+    NONCE_BLOOM_CAPACITY: int = 50000  # nonces per TTL window
+    NONCE_BLOOM_ERROR_RATE: float = 0.001
 
 
 @dataclass
@@ -76,6 +100,34 @@ class SaaSConfig:
     
     # Retry attempts for failed syncs
     MAX_RETRIES: int = 3
+    
+    # Records per POST /api/v1/consumptions/batch (SaaS accepts up to 200)
+    SYNC_BATCH_SIZE: int = 50
+    
+    # Batches uploaded per sync run (drains an offline backlog faster)
+    MAX_BATCHES_PER_SYNC: int = 10
+    
+    # After a 404/405 from the batch route, upload per record for this
+    # many seconds, then try the batch route again
+    BATCH_REPROBE_INTERVAL: int = 600
+    
+    # Pooled keep-alive HTTP client
+    HTTP_POOL_SIZE: int = 4
+    HTTP_RETRIES: int = 2  # connection errors and 502/503/504
+    HTTP_RETRY_BACKOFF: float = 0.5  # seconds, exponential
+    
+    # Concurrent upload workers (1 = sequential)
+    SYNC_WORKERS: int = int(os.getenv("EDGE_SYNC_WORKERS", "1"))
+    
+    # Background reachability probe (only when there was no real traffic)
+    PROBE_INTERVAL: int = 10
+    
+    # Circuit breaker around SaaS calls
+    BREAKER_FAILURE_THRESHOLD: int = 3
+    BREAKER_RESET_TIMEOUT: int = 30  # seconds open before a trial call
+    
+    # Refresh the HMAC key ring from the SaaS every N seconds
+    KEY_REFRESH_INTERVAL: int = 300
 
 
 @dataclass
@@ -84,8 +136,123 @@ class DatabaseConfig:
     # Database file path
     DB_PATH: str = os.getenv("EDGE_DB_PATH", "edge_data.db")
     
-    # Maximum offline records before forcing sync
-    MAX_OFFLINE_RECORDS: int = 100
+    # SQLite tuning (applied to every persistent connection)
+    JOURNAL_MODE: str = "WAL"
+    SYNCHRONOUS: str = "NORMAL"
+    MMAP_SIZE: int = 64 * 1024 * 1024  # bytes
+    CACHE_SIZE_KB: int = 8192
+    BUSY_TIMEOUT_MS: int = 5000
+    
+    # Write-behind consumption writer (group commit)
+    WRITER_BATCH_SIZE: int = 32     # max records per transaction
+    WRITER_LINGER_MS: int = 5       # wait for more records before committing
+    WRITER_QUEUE_SIZE: int = 1000
+    
+    # Append-only journal of queued records (<DB_PATH>.pending), written by
+    # the writer thread and replayed at start, so a failed or interrupted
+    # group commit does not lose a pour
+    WRITER_JOURNAL: bool = True
+    WRITER_JOURNAL_FSYNC: bool = False  # fsync each group append (survives power loss, one SD flush per group)
+    
+    # Seconds between retries of records whose commit hit a transient error
+    WRITER_RETRY_SECONDS: float = 5.0
+
+
+@dataclass
+class RetentionConfig:
+    """Retention, rollup and archival of old local data"""
+    # Run the retention job every N seconds (off the hot path)
+    INTERVAL_SECONDS: int = int(os.getenv("EDGE_RETENTION_INTERVAL", str(6 * 3600)))
+    
+    # Synced consumptions older than this are rolled up and pruned
+    SYNCED_MAX_AGE_DAYS: int = 30
+    
+    # Never keep more than this many synced consumptions (newest kept);
+    # the only cap on local rows, unsynced ones are never pruned
+    SYNCED_MAX_ROWS: int = 20000
+    
+    # sync_log rows older than this are pruned
+    SYNC_LOG_MAX_AGE_DAYS: int = 14
+    
+    # Rows handled per transaction
+    BATCH_SIZE: int = 500
+    
+    # Compressed NDJSON segments of pruned rows ("" disables archiving)
+    ARCHIVE_DIR: str = os.getenv("EDGE_ARCHIVE_DIR", "archive")
+    ARCHIVE_MAX_AGE_DAYS: int = 180
+    
+    # Incremental VACUUM: pages released per run once the freelist passes the threshold
+    VACUUM_MIN_FREE_PAGES: int = 256
+    VACUUM_MAX_PAGES: int = 2048
+
+
+@dataclass
+class TelemetryConfig:
+    """Per-dispense pulse traces (see telemetry.py)"""
+    # Capture each pour's pulse inter-arrival times
+    ENABLED: bool = os.getenv("EDGE_PULSE_TRACES", "true").lower() == "true"
+    
+    # Pulses kept per pour (later pulses are counted but not traced)
+    MAX_PULSES_PER_TRACE: int = 20000
+    
+    # Newest traces kept by the retention job
+    MAX_TRACES: int = 5000
+
+
+@dataclass
+class CalibrationConfig:
+    """Flow-sensor calibration fitting (see calibration.py)"""
+    # How often the GPIO controllers check for a new fit (seconds)
+    RELOAD_SECONDS: float = 30.0
+    
+    # Observations needed before a tap is fitted
+    MIN_OBSERVATIONS: int = 3
+    
+    # Reject fits further than this from the nominal pulses_per_liter (fraction)
+    MAX_CORRECTION: float = 0.25
+    
+    # Beer assumed left in a keg when it is replaced after running dry (ml)
+    KEG_RESIDUAL_ML: float = 0.0
+    
+    # A refill window counts as an emptied keg only if one of its last N
+    # pours was stopped by the no-flow / low-flow check
+    DRY_CUTOFF_POURS: int = 3
+
+
+@dataclass
+class OvershootConfig:
+    """Adaptive early cutoff from learned post-cutoff flow (see overshoot.py)"""
+    # Stop early by the learned overrun
+    ENABLED: bool = os.getenv("EDGE_OVERSHOOT_COMPENSATION", "true").lower() == "true"
+    
+    # EWMA weight of the newest pour
+    ALPHA: float = 0.2
+    
+    # Flow band edges at cutoff (ml/s)
+    BANDS_ML_S: Tuple[float, ...] = (10.0, 20.0, 30.0, 40.0)
+    
+    # Pours a band needs before it compensates
+    MIN_SAMPLES: int = 3
+    
+    # Never stop earlier than this fraction of the target
+    MAX_LEAD: float = 0.2
+
+
+@dataclass
+class ControllerConfig:
+    """Dispenser control loop in its own process (see controller.py)"""
+    # Run GPIO and dispensers in a controller process apart from Flask
+    # (EDGE_CONTROLLER_PROCESS=false keeps them in threads of the Flask process)
+    PROCESS: bool = os.getenv("EDGE_CONTROLLER_PROCESS", "true").lower() == "true"
+    
+    # Seconds to wait for the controller process to come up
+    START_TIMEOUT: float = 30.0
+    
+    # Seconds to wait for a cancel to be acknowledged
+    COMMAND_TIMEOUT: float = 2.0
+    
+    # Seconds pours get to finish at shutdown before the process is killed
+    STOP_TIMEOUT: float = 15.0
 
 
 @dataclass
@@ -132,10 +299,17 @@ class Config:
     security = SecurityConfig()
     saas = SaaSConfig()
     database = DatabaseConfig()
+    retention = RetentionConfig()
+    telemetry = TelemetryConfig()
+    calibration = CalibrationConfig()
+    overshoot = OvershootConfig()
+    controller = ControllerConfig()
     server = ServerConfig()
     mercadopago = MercadoPagoConfig()
     
-    # Tap configuration (maps tap_id to beverage)
+    # Tap configuration (maps tap_id to beverage and GPIO pins)
+    # Each tap gets its own pump, flow sensor and dispenser, so taps pour
+    # in parallel. Optional "pulses_per_liter" overrides config.gpio.
     # In production, this would be fetched from SaaS
     TAPS = {
         1: {
@@ -147,6 +321,10 @@ class Config:
         # Add more taps as needed
         # 2: {"beverage_id": "...", "name": "IPA", "gpio_pump": 18, "gpio_sensor": 28}
     }
+    
+    # Tap used when a request does not name one (and mirrored in the
+    # "dispenser" status section for single-tap clients)
+    DEFAULT_TAP_ID: int = 1
 
 
 # Global config instance
@@ -0,0 +1,315 @@
+"""
+Write-behind Consumption Writer for EDGE Server
+Persists consumption records off the dispense path
+
+The dispenser hands a fully built record to submit() and gets a Future
+back immediately. A single writer thread drains the queue and
+group-commits several records per transaction, so tap turnaround is
+never bounded by SD-card fsync latency. The Future resolves with the
+stored record once its transaction has committed (or with the error).
+
+Rows that belong to a pour (dispense metrics, pulse trace, overshoot
+estimate) are handed over with its record as side writes and go into
+the same transaction.
+
+Durability: before each group commit the writer thread appends the
+group's records to an append-only journal (<DB_PATH>.pending) with one
+write, so the dispense thread never waits on the SD card. Records whose
+commit hits a transient error (database locked, I/O) stay in the
+journal and are retried; the journal is emptied once nothing in it is
+outstanding, and replayed by start().
+"""
+import os
+import json
+import time
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Sequence, Set, Tuple
+
+from config import config
+from database import database, ConsumptionRecord
+
+
+_STOP = object()
+
+
+class ConsumptionWriter:
+    """
+    Single-thread write-behind queue for consumption records
+    
+    Each group is journaled before its commit and stays there until it
+    commits; stop() flushes the queue before shutdown and wait_idle()
+    blocks until everything submitted so far has been handled.
+    """
+    
+    def __init__(self):
+        self.batch_size = config.database.WRITER_BATCH_SIZE
+        self.linger = config.database.WRITER_LINGER_MS / 1000
+        self.journal_enabled = config.database.WRITER_JOURNAL
+        self.journal_fsync = config.database.WRITER_JOURNAL_FSYNC
+        self.retry_interval = config.database.WRITER_RETRY_SECONDS
+        
+        self._queue: "queue.Queue" = queue.Queue(maxsize=config.database.WRITER_QUEUE_SIZE)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        
+        # Journal file and the ids of its records not committed yet
+        self._journal = None
+        self._journal_lock = threading.Lock()
+        self._journal_unsettled: Set[str] = set()
+        
+        # Items whose commit failed transiently (writer thread only)
+        self._retry: List[tuple] = []
+        self._retry_at = 0.0
+        
+        # Stats
+        self.records_written = 0
+        self.transactions = 0
+        self.write_errors = 0
+    
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+    
+    def start(self):
+        """Start the writer thread"""
+        with self._start_lock:
+            if self.is_running:
+                return
+            if self.journal_enabled and self._journal is None:
+                self._open_journal()
+            self._thread = threading.Thread(target=self._writer_loop, name="consumption-writer", daemon=True)
+            self._thread.start()
+        print("💾 Consumption writer started")
+    
+    def stop(self, timeout: float = 10):
+        """Flush pending records and stop the writer thread"""
+        if not self.is_running:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout=timeout)
+        self._thread = None
+        with self._journal_lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+        print("🛑 Consumption writer stopped")
+    
+    def submit(self, record: ConsumptionRecord,
+               side_writes: Sequence[Callable[[], None]] = ()) -> Future:
+        """
+        Queue a record for persistence
+        
+        side_writes run inside the record's transaction, each under its
+        own savepoint, so a failing side row is skipped without losing
+        the consumption.
+        
+        Returns a Future resolved with the stored ConsumptionRecord once
+        its transaction commits (a transient failure keeps it pending
+        while the record is retried).
+        """
+        if not self.is_running:
+            self.start()
+        
+        future: Future = Future()
+        self._queue.put((record, future, tuple(side_writes)))
+        return future
+    
+    def wait_idle(self, timeout: float = None) -> bool:
+        """Block until every record submitted so far is committed or waiting for a retry"""
+        marker: Future = Future()
+        self._queue.put((None, marker, ()))
+        try:
+            marker.result(timeout=timeout)
+            return True
+        except Exception:
+            return False
+    
+    def get_status(self) -> dict:
+        """Get writer status summary"""
+        return {
+            "running": self.is_running,
+            "queued": self._queue.qsize(),
+            "journaled": len(self._journal_unsettled),
+            "retrying": len(self._retry),
+            "records_written": self.records_written,
+            "transactions": self.transactions,
+            "write_errors": self.write_errors
+        }
+    
+    def _collect(self, first) -> Tuple[List[tuple], bool]:
+        """Gather up to batch_size items, lingering briefly for more"""
+        items = [first]
+        stop = False
+        while len(items) < self.batch_size:
+            try:
+                item = self._queue.get(timeout=self.linger)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stop = True
+                break
+            items.append(item)
+        return items, stop
+    
+    def _writer_loop(self):
+        """Drain the queue, one transaction per group"""
+        while True:
+            try:
+                first = self._queue.get(timeout=self.retry_interval if self._retry else None)
+            except queue.Empty:
+                self._write([])  # retry due
+                continue
+            if first is _STOP:
+                self._write([], retry_now=True)
+                return
+            
+            items, stop = self._collect(first)
+            self._write(items)
+            
+            if stop:
+                # Flush whatever arrived before the stop marker
+                leftovers = []
+                while True:
+                    try:
+                        leftovers.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                self._write([item for item in leftovers if item is not _STOP], retry_now=True)
+                return
+    
+    def _write(self, items: List[tuple], retry_now: bool = False):
+        """
+        Commit a group; on failure retry record by record so one bad row fails alone
+        
+        Records that fail with a transient error (sqlite3.OperationalError:
+        locked, busy, I/O) stay journaled and go back on the retry list;
+        any other error fails the record's future.
+        """
+        fresh = [item for item in items if item[0] is not None]
+        self._append_journal([item[0] for item in fresh])
+        
+        pending = fresh
+        if self._retry and (retry_now or time.monotonic() >= self._retry_at):
+            pending = self._retry + fresh
+            self._retry = []
+        
+        if pending:
+            settled = []
+            try:
+                stored = self._commit(pending)
+                for (_, future, _), row in zip(pending, stored):
+                    future.set_result(row)
+                settled = [item[0].id for item in pending]
+                self.records_written += len(pending)
+            except Exception as e:
+                print(f"⚠️ Group commit of {len(pending)} consumptions failed ({e}) - retrying one by one")
+                for item in pending:
+                    try:
+                        item[1].set_result(self._commit([item])[0])
+                        self.records_written += 1
+                    except sqlite3.OperationalError as single_error:
+                        print(f"⚠️ Consumption {item[0].id} kept for retry: {single_error}")
+                        self._retry.append(item)
+                        continue
+                    except Exception as single_error:
+                        self.write_errors += 1
+                        item[1].set_exception(single_error)
+                    settled.append(item[0].id)
+                if self._retry:
+                    self._retry_at = time.monotonic() + self.retry_interval
+            
+            self._settle_journal(settled)
+            database.publish_stats()
+        
+        # Flush markers from wait_idle()
+        for record, future, _ in items:
+            if record is None:
+                future.set_result(None)
+    
+    def _commit(self, items: List[tuple]) -> List[ConsumptionRecord]:
+        """One transaction: the records, then their side writes"""
+        with database.get_connection() as conn:
+            stored = database.insert_consumptions([item[0] for item in items])
+            for record, _, side_writes in items:
+                for side_write in side_writes:
+                    conn.execute("SAVEPOINT side_write")
+                    try:
+                        side_write()
+                        conn.execute("RELEASE SAVEPOINT side_write")
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO SAVEPOINT side_write")
+                        conn.execute("RELEASE SAVEPOINT side_write")
+                        print(f"⚠️ Side write for consumption {record.id} failed: {e}")
+        self.transactions += 1
+        return stored
+    
+    # ==================== Journal ====================
+    
+    def _open_journal(self):
+        """Replay records left by a crash, then open the journal for appending"""
+        path = f"{database.db_path}.pending"
+        records = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as journal:
+                for line in journal:
+                    try:
+                        record = ConsumptionRecord(**json.loads(line))
+                    except (ValueError, TypeError):
+                        continue  # torn last line
+                    records[record.id] = record
+        
+        mode = "w"
+        if records:
+            try:
+                stored = database.existing_consumption_ids(list(records))
+                missing = [record for record in records.values() if record.id not in stored]
+                if missing:
+                    database.insert_consumptions(missing)
+                    database.publish_stats()
+                print(f"♻️ Journal: {len(missing)} consumption(s) recovered")
+            except Exception as e:
+                # Keep the journal and let the writer thread retry them
+                print(f"❌ Journal replay failed, will retry: {e}")
+                mode = "a"
+                self._retry = [(record, Future(), ()) for record in records.values()]
+                self._journal_unsettled.update(records)
+                self._retry_at = time.monotonic() + self.retry_interval
+        
+        self._journal = open(path, mode, encoding="utf-8")
+    
+    def _append_journal(self, records: List[ConsumptionRecord]):
+        """One write (and optional fsync) for a group, on the writer thread"""
+        if not records:
+            return
+        with self._journal_lock:
+            if self._journal is None:
+                return
+            try:
+                self._journal.write("".join(json.dumps(record.to_dict()) + "\n" for record in records))
+                self._journal.flush()
+                if self.journal_fsync:
+                    os.fsync(self._journal.fileno())
+            except OSError as e:
+                print(f"⚠️ Journal append failed: {e}")
+                return
+            self._journal_unsettled.update(record.id for record in records)
+    
+    def _settle_journal(self, handled_ids: List[str]):
+        """Forget records that were committed or failed for good; empty the journal when none is left"""
+        if not handled_ids:
+            return
+        with self._journal_lock:
+            self._journal_unsettled.difference_update(handled_ids)
+            if self._journal is not None and not self._journal_unsettled:
+                try:
+                    self._journal.seek(0)
+                    self._journal.truncate()
+                except OSError as e:
+                    print(f"⚠️ Journal truncate failed: {e}")
+
+
+# Global writer instance
+consumption_writer = ConsumptionWriter()
@@ -0,0 +1,591 @@
+"""
+Controller Process for EDGE Server
+Runs the GPIO controllers and dispensers apart from the Flask process
+
+The pump control loop, the pulse cutoff and the consumption writer live
+in a child process, so HTTP requests, JSON parsing and payment calls in
+the Flask process cannot delay a pump-off or hold the dispenser lock.
+
+- Commands (dispense, cancel, stop) go to the child over a
+  multiprocessing queue; replies, dispense events and the gpio, database
+  and watchdog status sections come back over a second one.
+- Live tap state is also written to a fixed-layout shared memory block,
+  one slot per tap, under a seqlock: the child is the only writer and
+  never waits for readers, readers retry on a torn read.
+
+RemoteDispenserRegistry has the interface of DispenserRegistry, so
+app.py uses either one (config.controller.PROCESS, on by default;
+EDGE_CONTROLLER_PROCESS=false keeps the taps in the Flask process).
+"""
+import os
+import time
+import zlib
+import queue
+import signal
+import struct
+import threading
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import Optional, Dict, Any, List
+
+from config import config
+from database import database
+from consumption_writer import consumption_writer
+from status_snapshot import status_snapshot
+from token_validator import TokenPayload
+from dispenser import (
+    DispenseStatus, DispenseResult, DispenseEventBus, CompletionLog, CompletionRecord
+)
+
+
+# Status codes stored in the block (index into DispenseStatus)
+_STATUSES: List[DispenseStatus] = list(DispenseStatus)
+_STATUS_CODES = {status: code for code, status in enumerate(_STATUSES)}
+_BUSY = (DispenseStatus.VALIDATING, DispenseStatus.DISPENSING)
+
+
+class StatusBlock:
+    """
+    Per-tap live status in shared memory
+    
+    Layout: a 64-byte header (magic, layout version, slot count) and one
+    128-byte slot per tap: seq (u32), crc32 of the body (u32) and the body.
+    
+    The writer makes seq odd, writes the body and crc, then makes seq
+    even again. A reader takes the body only if seq was even and the same
+    before and after the copy and the crc matches, so it never sees a
+    half-written slot (the crc also covers CPUs that reorder the stores).
+    """
+    MAGIC = b"BPST"
+    LAYOUT_VERSION = 1
+    HEADER = struct.Struct("<4sHH")
+    HEADER_SIZE = 64
+    SEQ = struct.Struct("<I")
+    CRC = struct.Struct("<I")
+    BODY_OFFSET = 8
+    # tap_id, status, volume_ml, duration_s, flow_ml_s, pulses_per_liter,
+    # updated_at, completion seq, current sale_id
+    BODY = struct.Struct("<IB3xdddddQ64s")
+    SLOT_SIZE = 128
+    
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        self.shm = shm
+        self.owner = owner
+        magic, version, self.slots = self.HEADER.unpack_from(shm.buf, 0)
+        if magic != self.MAGIC or version != self.LAYOUT_VERSION:
+            raise ValueError(f"Not a status block: {shm.name}")
+    
+    @property
+    def name(self) -> str:
+        return self.shm.name
+    
+    @classmethod
+    def create(cls, slots: int) -> "StatusBlock":
+        shm = shared_memory.SharedMemory(create=True, size=cls.HEADER_SIZE + slots * cls.SLOT_SIZE)
+        shm.buf[:shm.size] = bytes(shm.size)
+        cls.HEADER.pack_into(shm.buf, 0, cls.MAGIC, cls.LAYOUT_VERSION, slots)
+        return cls(shm, owner=True)
+    
+    @classmethod
+    def attach(cls, name: str) -> "StatusBlock":
+        # Spawned children share the parent's resource tracker, so the
+        # segment stays registered once and is unlinked by its owner
+        return cls(shared_memory.SharedMemory(name=name), owner=False)
+    
+    def _offset(self, slot: int) -> int:
+        if not 0 <= slot < self.slots:
+            raise IndexError(f"Slot {slot} out of range")
+        return self.HEADER_SIZE + slot * self.SLOT_SIZE
+    
+    def write(self, slot: int, tap_id: int, status: DispenseStatus, volume_ml: float,
+              duration_s: float, flow_ml_s: float, pulses_per_liter: float,
+              completion_seq: int, sale_id: Optional[str]):
+        """Publish one tap's state (single writer: the controller process)"""
+        buf = self.shm.buf
+        offset = self._offset(slot)
+        seq = self.SEQ.unpack_from(buf, offset)[0]
+        self.SEQ.pack_into(buf, offset, (seq + 1) & 0xFFFFFFFF)
+        
+        body = self.BODY.pack(
+            tap_id, _STATUS_CODES[status], volume_ml, duration_s, flow_ml_s,
+            pulses_per_liter, time.time(), completion_seq,
+            (sale_id or "").encode()[:64]
+        )
+        start = offset + self.BODY_OFFSET
+        buf[start:start + len(body)] = body
+        self.CRC.pack_into(buf, offset + 4, zlib.crc32(body))
+        self.SEQ.pack_into(buf, offset, (seq + 2) & 0xFFFFFFFF)
+    
+    def read(self, slot: int, retries: int = 100) -> Optional[Dict[str, Any]]:
+        """Consistent copy of a slot, or None if never written (or still torn after retries)"""
+        buf = self.shm.buf
+        offset = self._offset(slot)
+        start = offset + self.BODY_OFFSET
+        
+        for _ in range(retries):
+            before = self.SEQ.unpack_from(buf, offset)[0]
+            if before == 0:
+                return None
+            if before & 1:
+                time.sleep(0)
+                continue
+            crc = self.CRC.unpack_from(buf, offset + 4)[0]
+            body = bytes(buf[start:start + self.BODY.size])
+            if self.SEQ.unpack_from(buf, offset)[0] == before and zlib.crc32(body) == crc:
+                break
+        else:
+            return None
+        
+        (tap_id, status, volume_ml, duration_s, flow_ml_s, pulses_per_liter,
+         updated_at, completion_seq, sale_id) = self.BODY.unpack(body)
+        return {
+            "seq": before,
+            "tap_id": tap_id,
+            "status": _STATUSES[status],
+            "volume_dispensed_ml": volume_ml,
+            "duration_seconds": duration_s,
+            "flow_rate_ml_s": flow_ml_s,
+            "pulses_per_liter": pulses_per_liter,
+            "updated_at": updated_at,
+            "completion_seq": completion_seq,
+            "current_sale_id": sale_id.rstrip(b"\0").decode() or None
+        }
+    
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+# ==================== Controller process ====================
+
+class _ControllerWorker:
+    """Child side: runs commands against the local dispensers and publishes their state"""
+    
+    def __init__(self, registry, block: StatusBlock, slots: Dict[int, int], replies):
+        self.registry = registry
+        self.block = block
+        self.slots = slots
+        self.replies = replies
+        self._events = registry.events.subscribe(max_events=1024)
+        self._stopping = threading.Event()
+        self._pours: List[threading.Thread] = []
+        self._started_at: Dict[int, float] = {}
+        self._completion_seq: Dict[int, int] = {}
+        self._snapshot_version = -1
+    
+    def run(self, commands):
+        # Initial slots are written before the forwarder starts: one writer at a time
+        ready = {d.tap_id: self._write_slot(d.tap_id, d.get_status()) for d in self.registry.all()}
+        forwarder = threading.Thread(target=self._forward_loop, name="controller-events", daemon=True)
+        forwarder.start()
+        self.replies.put(("ready", ready))
+        
+        parent = multiprocessing.parent_process()
+        while True:
+            try:
+                command = commands.get(timeout=1.0)
+            except queue.Empty:
+                if parent is not None and not parent.is_alive():
+                    print("⚠️ Controller: parent process gone, stopping")
+                    break
+                continue
+            
+            name = command[0]
+            if name == "stop":
+                break
+            elif name == "dispense":
+                _, request_id, payload = command
+                pour = threading.Thread(target=self._dispense, args=(request_id, payload),
+                                        name=f"pour-{payload.tap_id}", daemon=True)
+                self._pours = [t for t in self._pours if t.is_alive()] + [pour]
+                pour.start()
+            elif name == "cancel":
+                _, request_id, tap_id = command
+                dispenser = self.registry.get(tap_id)
+                self.replies.put(("reply", request_id, bool(dispenser and dispenser.cancel())))
+        
+        self._shutdown(forwarder)
+    
+    def _dispense(self, request_id: int, payload: TokenPayload):
+        dispenser = self.registry.get(payload.tap_id)
+        try:
+            if dispenser is None:
+                raise ValueError(f"Unknown tap {payload.tap_id}")
+            result = dispenser.dispense(payload).to_dict()
+        except Exception as e:
+            print(f"❌ Controller dispense error: {e}")
+            result = DispenseResult(
+                success=False, status=DispenseStatus.ERROR, sale_id=payload.sale_id,
+                volume_authorized_ml=payload.volume_ml, volume_dispensed_ml=0,
+                duration_seconds=0, pulse_count=0, error_message=str(e), tap_id=payload.tap_id
+            ).to_dict()
+        self.replies.put(("reply", request_id, result))
+    
+    def _forward_loop(self):
+        """Bus events -> status block slots and the parent"""
+        while not self._stopping.is_set():
+            try:
+                event = self._events.get(timeout=0.5)
+            except queue.Empty:
+                self._send_sections()
+                continue
+            
+            tap_id = event.data.get("tap_id")
+            if tap_id in self.slots:
+                if event.type == "result":
+                    self._completion_seq[tap_id] = event.data.get("seq", 0)
+                else:
+                    self._write_slot(tap_id, event.data)
+            self.replies.put(("event", tap_id, event.type, event.data))
+            self._send_sections()
+    
+    def _write_slot(self, tap_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
+        status = DispenseStatus(data["status"])
+        now = time.monotonic()
+        if status == DispenseStatus.DISPENSING:
+            self._started_at.setdefault(tap_id, now)
+        else:
+            self._started_at.pop(tap_id, None)
+        duration = data.get("duration_seconds")
+        if duration is None:
+            duration = now - self._started_at.get(tap_id, now)
+        
+        if data.get("last_result"):
+            self._completion_seq[tap_id] = data["last_result"]["seq"]
+        
+        dispenser = self.registry.get(tap_id)
+        self.block.write(
+            self.slots[tap_id], tap_id, status,
+            volume_ml=data.get("volume_dispensed_ml") or 0.0,
+            duration_s=duration,
+            flow_ml_s=data.get("flow_rate_ml_s") or 0.0,
+            pulses_per_liter=dispenser.pulses_per_liter,
+            completion_seq=self._completion_seq.get(tap_id, 0),
+            sale_id=data.get("current_sale_id")
+        )
+        return data
+    
+    def _send_sections(self):
+        """Forward the gpio, database and watchdog sections when this process changed them"""
+        version = status_snapshot.version
+        if version == self._snapshot_version:
+            return
+        self._snapshot_version = version
+        self.replies.put(("sections", {
+            "gpio": status_snapshot.get_section("gpio"),
+            "database": status_snapshot.get_section("database"),
+            "watchdog": status_snapshot.get_section("watchdog")
+        }))
+    
+    def _shutdown(self, forwarder: threading.Thread):
+        # Cancel pours and wait for them to queue their consumption records
+        for dispenser in self.registry.all():
+            dispenser.cancel()
+        deadline = time.monotonic() + config.controller.STOP_TIMEOUT
+        for pour in self._pours:
+            pour.join(timeout=max(0.0, deadline - time.monotonic()))
+        
+        self.registry.cleanup()
+        consumption_writer.stop()
+        self._stopping.set()
+        forwarder.join(timeout=2)
+        self._send_sections()
+        database.close()
+        self.block.close()
+
+
+def _controller_main(commands, replies, block_name: str, slots: Dict[int, int]):
+    """Entry point of the controller process"""
+    # Ctrl+C reaches the whole process group; the parent stops us in order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    
+    from dispenser import dispensers
+    
+    block = StatusBlock.attach(block_name)
+    database.initialize()
+    consumption_writer.start()
+    dispensers.initialize()
+    print(f"✅ Controller process {os.getpid()} running {len(dispensers.all())} taps")
+    
+    _ControllerWorker(dispensers, block, slots, replies).run(commands)
+    print("👋 Controller process stopped")
+
+
+# ==================== Flask process side ====================
+
+class RemoteDispenser:
+    """Proxy of a Dispenser in the controller process (same interface as app.py uses it)"""
+    
+    def __init__(self, registry: "RemoteDispenserRegistry", tap_id: int, slot: int):
+        self.registry = registry
+        self.tap_id = tap_id
+        self.slot = slot
+        self._status: Dict[str, Any] = {"tap_id": tap_id, "status": DispenseStatus.IDLE.value}
+        self._pending = 0  # dispense calls sent but not answered yet
+        self._lock = threading.Lock()
+    
+    def _live(self) -> Optional[Dict[str, Any]]:
+        block = self.registry.block
+        return block.read(self.slot) if block else None
+    
+    @property
+    def is_busy(self) -> bool:
+        if self._pending:
+            return True
+        live = self._live()
+        return bool(live and live["status"] in _BUSY)
+    
+    @property
+    def pulses_per_liter(self) -> float:
+        live = self._live()
+        if live and live["pulses_per_liter"]:
+            return live["pulses_per_liter"]
+        return config.TAPS.get(self.tap_id, {}).get("pulses_per_liter") or config.gpio.PULSES_PER_LITER
+    
+    def get_status(self) -> Dict[str, Any]:
+        """Last full status from the controller, with the live fields from the block"""
+        with self._lock:
+            status = dict(self._status)
+        live = self._live()
+        if live:
+            status.update({
+                "status": live["status"].value,
+                "is_dispensing": live["status"] == DispenseStatus.DISPENSING,
+                "current_sale_id": live["current_sale_id"],
+                "volume_dispensed_ml": round(live["volume_dispensed_ml"], 1),
+                "duration_seconds": round(live["duration_seconds"], 2),
+                "flow_rate_ml_s": round(live["flow_rate_ml_s"], 1)
+            })
+        return status
+    
+    def set_status(self, status: Dict[str, Any]):
+        with self._lock:
+            self._status = dict(status)
+    
+    def publish_status(self):
+        """Mirror of Dispenser.publish_status() for the Flask-side snapshot"""
+        status = self.get_status()
+        status_snapshot.merge("taps", **{str(self.tap_id): status})
+        if self.tap_id == config.DEFAULT_TAP_ID:
+            status_snapshot.update("dispenser", status)
+    
+    def dispense(self, payload: TokenPayload) -> DispenseResult:
+        """Run a pour in the controller process and wait for its result"""
+        with self._lock:
+            self._pending += 1
+        try:
+            reply = self.registry.call("dispense", payload)
+        except Exception as e:
+            reply = DispenseResult(
+                success=False, status=DispenseStatus.ERROR, sale_id=payload.sale_id,
+                volume_authorized_ml=payload.volume_ml, volume_dispensed_ml=0,
+                duration_seconds=0, pulse_count=0, error_message=str(e), tap_id=self.tap_id
+            ).to_dict()
+        finally:
+            with self._lock:
+                self._pending -= 1
+        return DispenseResult.from_dict(reply)
+    
+    def cancel(self) -> bool:
+        try:
+            return bool(self.registry.call("cancel", self.tap_id, timeout=config.controller.COMMAND_TIMEOUT))
+        except Exception as e:
+            print(f"⚠️ Cancel failed on tap {self.tap_id}: {e}")
+            return False
+
+
+class _PendingCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[str] = None
+
+
+class RemoteDispenserRegistry:
+    """
+    DispenserRegistry whose dispensers run in the controller process
+    
+    Starts the process in initialize() and restarts it if it dies (a
+    fresh GPIO init switches the pumps off). Calls in flight when it
+    dies fail with an error result.
+    """
+    
+    def __init__(self):
+        self.events = DispenseEventBus()
+        self.completions = CompletionLog()
+        self.slots = {tap_id: slot for slot, tap_id in enumerate(sorted(config.TAPS))}
+        self._dispensers: Dict[int, RemoteDispenser] = {
+            tap_id: RemoteDispenser(self, tap_id, slot) for tap_id, slot in self.slots.items()
+        }
+        self.block: Optional[StatusBlock] = None
+        self._context = multiprocessing.get_context("spawn")
+        self._process = None
+        self._commands = None
+        self._replies = None
+        self._pending: Dict[int, _PendingCall] = {}
+        self._pending_lock = threading.Lock()
+        self._request_ids = itertools.count(1)
+        self._ready = threading.Event()
+        self._stopping = False
+        self._pump: Optional[threading.Thread] = None
+        self.restarts = 0
+    
+    def get(self, tap_id: Optional[int] = None) -> Optional[RemoteDispenser]:
+        """Dispenser of tap_id (default tap when None), or None if unknown"""
+        if tap_id is None:
+            tap_id = config.DEFAULT_TAP_ID
+        return self._dispensers.get(int(tap_id))
+    
+    def all(self) -> List[RemoteDispenser]:
+        return list(self._dispensers.values())
+    
+    def initialize(self):
+        """Start the controller process and wait until its taps are initialized"""
+        if self.block is None:
+            self.block = StatusBlock.create(len(self.slots))
+        self._stopping = False
+        self._start_process()
+        self._pump = threading.Thread(target=self._pump_loop, name="controller-replies", daemon=True)
+        self._pump.start()
+        if not self._ready.wait(config.controller.START_TIMEOUT):
+            raise RuntimeError("Controller process did not start")
+    
+    def _start_process(self):
+        self._ready.clear()
+        self._commands = self._context.Queue()
+        self._replies = self._context.Queue()
+        self._process = self._context.Process(
+            target=_controller_main,
+            args=(self._commands, self._replies, self.block.name, self.slots),
+            name="edge-controller",
+            daemon=True
+        )
+        self._process.start()
+    
+    def call(self, command: str, argument: Any, timeout: Optional[float] = None) -> Any:
+        """Send a command to the controller process and wait for its reply"""
+        if not self._ready.is_set():
+            raise RuntimeError("Controller process not running")
+        request_id = next(self._request_ids)
+        pending = _PendingCall()
+        with self._pending_lock:
+            self._pending[request_id] = pending
+        try:
+            self._commands.put((command, request_id, argument))
+            if not pending.done.wait(timeout):
+                raise TimeoutError(f"Controller did not answer {command}")
+        finally:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+        if pending.error:
+            raise RuntimeError(pending.error)
+        return pending.result
+    
+    def _pump_loop(self):
+        """Replies and events from the controller process; restarts it if it dies"""
+        while True:
+            try:
+                message = self._replies.get(timeout=0.5)
+            except queue.Empty:
+                if self._process.is_alive():
+                    continue
+                if self._stopping:
+                    return
+                print(f"❌ Controller process exited ({self._process.exitcode}), restarting")
+                self._fail_pending("Controller process stopped")
+                self.restarts += 1
+                self._start_process()
+                continue
+            except (EOFError, OSError):
+                if self._stopping:
+                    return
+                continue
+            
+            try:
+                self._handle(message)
+            except Exception as e:
+                print(f"⚠️ Controller message error: {e}")
+    
+    def _handle(self, message):
+        kind = message[0]
+        if kind == "event":
+            _, tap_id, event_type, data = message
+            dispenser = self._dispensers.get(tap_id)
+            if dispenser:
+                if event_type == "status":
+                    dispenser.set_status(data)
+                elif event_type == "result":
+                    self.completions.put(CompletionRecord(
+                        seq=data["seq"],
+                        tap_id=tap_id,
+                        sale_id=data["sale_id"],
+                        result={k: v for k, v in data.items() if k != "seq"},
+                        expires_at=self.completions.clock.monotonic() + self.completions.ttl
+                    ))
+                dispenser.publish_status()
+            self.events.emit(tap_id, event_type, data)
+        elif kind == "reply":
+            _, request_id, result = message
+            with self._pending_lock:
+                pending = self._pending.get(request_id)
+            if pending:
+                pending.result = result
+                pending.done.set()
+        elif kind == "sections":
+            sections = message[1]
+            status_snapshot.update("gpio", sections["gpio"])
+            if sections["database"]:
+                status_snapshot.update("database", sections["database"])
+                status_snapshot.merge("sync", records=sections["database"])
+            if sections["watchdog"]:
+                status_snapshot.update("watchdog", sections["watchdog"])
+        elif kind == "ready":
+            for tap_id, status in message[1].items():
+                dispenser = self._dispensers.get(tap_id)
+                if dispenser:
+                    dispenser.set_status(status)
+                    dispenser.publish_status()
+            self._ready.set()
+    
+    def _fail_pending(self, error: str):
+        with self._pending_lock:
+            pending = list(self._pending.values())
+        for call in pending:
+            call.error = error
+            call.done.set()
+    
+    def cleanup(self):
+        """Stop pours, the controller process and free the status block"""
+        if self._process is None:
+            return
+        self._stopping = True
+        try:
+            self._commands.put(("stop",))
+        except Exception:
+            pass
+        self._process.join(timeout=config.controller.STOP_TIMEOUT + 5)
+        if self._process.is_alive():
+            print("⚠️ Controller process did not stop, terminating")
+            self._process.terminate()
+            self._process.join(timeout=5)
+        if self._pump:
+            self._pump.join(timeout=2)
+        self._fail_pending("Controller process stopped")
+        self._ready.clear()
+        self._process = None
+        if self.block:
+            self.block.close()
+            self.block = None
+    
+    def get_status(self) -> Dict[str, Any]:
+        """Status of every tap, keyed by tap_id"""
+        return {str(tap_id): d.get_status() for tap_id, d in self._dispensers.items()}
+
+
+# Global controller-backed registry (started by app.py when config.controller.PROCESS)
+controller_dispensers = RemoteDispenserRegistry()
@@ -6,6 +6,8 @@ import sqlite3
 import json
 import time
 import uuid
+import threading
+from pathlib import Path
 from datetime import datetime
 from typing import List, Optional, Dict, Any
 from dataclasses import dataclass, asdict
@@ -13,6 +15,21 @@ from enum import Enum
 from contextlib import contextmanager
 
 from config import config
+from status_snapshot import status_snapshot
+
+
+# RETURNING needs SQLite 3.35+; older builds insert and keep the built record
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+_INSERT_CONSUMPTION_SQL = '''
+    INSERT INTO consumptions (
+        id, sale_id, token_id, beverage_id, tap_id,
+        volume_authorized_ml, volume_dispensed_ml,
+        started_at, finished_at, duration_seconds,
+        pulse_count, flow_rate_avg, status,
+        sync_status, sync_attempts, error_message, created_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
 
 
 class SyncStatus(Enum):
@@ -70,6 +87,76 @@ class ConsumptionRecord:
         )
 
 
+class ConnectionManager:
+    """
+    Keeps one open SQLite connection per thread
+    
+    Connections are configured once (WAL journal, synchronous=NORMAL,
+    mmap, cache size, busy timeout) and reused for the lifetime of the
+    thread. Connections of threads that have exited are closed lazily,
+    the next time a new thread opens its connection.
+    """
+    
+    def __init__(self, db_path: str, read_only: bool = False):
+        self.db_path = db_path
+        self.read_only = read_only
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: Dict[int, tuple] = {}  # thread ident -> (thread, conn)
+    
+    def _connect(self) -> sqlite3.Connection:
+        db_config = config.database
+        timeout = db_config.BUSY_TIMEOUT_MS / 1000
+        
+        if self.read_only:
+            uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, timeout=timeout, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_path, timeout=timeout, check_same_thread=False)
+            # Only takes effect on a brand-new file (before WAL writes the
+            # header); existing databases: python retention.py --convert-vacuum
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute(f"PRAGMA journal_mode={db_config.JOURNAL_MODE}")
+        
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA synchronous={db_config.SYNCHRONOUS}")
+        conn.execute(f"PRAGMA mmap_size={int(db_config.MMAP_SIZE)}")
+        conn.execute(f"PRAGMA cache_size={-int(db_config.CACHE_SIZE_KB)}")
+        conn.execute(f"PRAGMA busy_timeout={int(db_config.BUSY_TIMEOUT_MS)}")
+        return conn
+    
+    def connection(self) -> sqlite3.Connection:
+        """Get the connection owned by the current thread"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        
+        conn = self._connect()
+        self._local.conn = conn
+        
+        current = threading.current_thread()
+        with self._lock:
+            # Close connections left behind by finished threads
+            for ident, (thread, old_conn) in list(self._connections.items()):
+                if not thread.is_alive():
+                    old_conn.close()
+                    del self._connections[ident]
+            self._connections[current.ident] = (current, conn)
+        
+        return conn
+    
+    def close_all(self):
+        """Close every connection (shutdown)"""
+        with self._lock:
+            for _, conn in self._connections.values():
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self._connections.clear()
+        self._local = threading.local()
+
+
 class Database:
     """
     SQLite database for local storage
@@ -79,20 +166,53 @@ class Database:
     def __init__(self, db_path: str = None):
         self.db_path = db_path or config.database.DB_PATH
         self._initialized = False
+        self._writer = ConnectionManager(self.db_path)
+        self._reader = ConnectionManager(self.db_path, read_only=True)
+        self._tx_local = threading.local()
     
     @contextmanager
     def get_connection(self):
-        """Context manager for database connections"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        """
+        Context manager for read-write access
+        
+        Uses the current thread's persistent connection. Nested calls
+        share the outer transaction, which commits (or rolls back) when
+        the outermost block exits.
+        """
+        conn = self._writer.connection()
+        depth = getattr(self._tx_local, "depth", 0)
+        self._tx_local.depth = depth + 1
         try:
             yield conn
-            conn.commit()
+            if depth == 0:
+                conn.commit()
         except Exception:
-            conn.rollback()
+            if depth == 0:
+                conn.rollback()
             raise
         finally:
-            conn.close()
+            self._tx_local.depth = depth
+    
+    @contextmanager
+    def get_read_connection(self):
+        """
+        Context manager for read-only access (status/analytics queries)
+        
+        Uses a separate read-only connection per thread. With WAL it
+        never blocks on, nor is blocked by, the writers.
+        """
+        conn = self._reader.connection()
+        try:
+            yield conn
+        finally:
+            # End any implicit read transaction so the next query sees new commits
+            if conn.in_transaction:
+                conn.rollback()
+    
+    def close(self):
+        """Close all persistent connections"""
+        self._writer.close_all()
+        self._reader.close_all()
     
     def initialize(self):
         """Create database tables if they don't exist"""
@@ -150,18 +270,274 @@ class Database:
                 )
             ''')
             
+            # Daily per-tap summaries of consumptions pruned by retention
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS consumption_daily_rollups (
+                    day TEXT NOT NULL,
+                    tap_id INTEGER NOT NULL,
+                    records INTEGER NOT NULL DEFAULT 0,
+                    completed INTEGER NOT NULL DEFAULT 0,
+                    interrupted INTEGER NOT NULL DEFAULT 0,
+                    errors INTEGER NOT NULL DEFAULT 0,
+                    volume_authorized_ml REAL NOT NULL DEFAULT 0,
+                    volume_dispensed_ml REAL NOT NULL DEFAULT 0,
+                    duration_seconds REAL NOT NULL DEFAULT 0,
+                    pulse_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, tap_id)
+                )
+            ''')
+            
+            # Per-pour cutoff measurements (side table, never synced)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS dispense_metrics (
+                    consumption_id TEXT PRIMARY KEY,
+                    tap_id INTEGER NOT NULL,
+                    cutoff_reason TEXT NOT NULL,
+                    target_ml REAL NOT NULL,
+                    target_pulses INTEGER NOT NULL,
+                    cutoff_pulses INTEGER,
+                    final_pulses INTEGER NOT NULL,
+                    overshoot_ml REAL NOT NULL,
+                    trailing_ml REAL,
+                    cutoff_latency_ms REAL,
+                    settle_ms REAL,
+                    created_at TEXT NOT NULL
+                )
+            ''')
+            
+            # Per-pour pulse inter-arrival times, delta-encoded (see telemetry.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS pulse_traces (
+                    consumption_id TEXT PRIMARY KEY,
+                    tap_id INTEGER NOT NULL,
+                    pulse_count INTEGER NOT NULL,
+                    sample_width INTEGER NOT NULL,
+                    deltas BLOB NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            ''')
+            
+            # Pumps forced off by the pump watchdog (see pump_watchdog.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS watchdog_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tap_id INTEGER NOT NULL,
+                    sale_id TEXT,
+                    deadline_s REAL NOT NULL,
+                    elapsed_s REAL NOT NULL,
+                    pulse_count INTEGER,
+                    fired_at TEXT NOT NULL
+                )
+            ''')
+            
+            # Learned post-cutoff overrun per tap and flow band (see overshoot.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS overshoot_model (
+                    tap_id INTEGER NOT NULL,
+                    band INTEGER NOT NULL,
+                    trailing_pulses REAL NOT NULL,
+                    samples INTEGER NOT NULL,
+                    updated_at TEXT,
+                    PRIMARY KEY (tap_id, band)
+                )
+            ''')
+            
+            # Operator calibration inputs: measured reference pours and emptied kegs
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS calibration_references (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tap_id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    volume_ml REAL NOT NULL,
+                    consumption_id TEXT,
+                    pulse_count INTEGER,
+                    duration_seconds REAL,
+                    window_start TEXT,
+                    window_end TEXT,
+                    created_at TEXT NOT NULL
+                )
+            ''')
+            
+            # Fitted pulses-per-liter per tap (see calibration.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS flow_calibration (
+                    tap_id INTEGER PRIMARY KEY,
+                    pulses_per_liter REAL NOT NULL,
+                    bands TEXT NOT NULL,
+                    observations INTEGER NOT NULL,
+                    rms_error_pct REAL,
+                    fitted_at TEXT NOT NULL
+                )
+            ''')
+            
+            # HMAC key ring synced from the SaaS (kid -> secret, validity window)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS hmac_keys (
+                    kid INTEGER PRIMARY KEY,
+                    secret TEXT NOT NULL,
+                    valid_from REAL,
+                    valid_until REAL,
+                    is_current INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            
+            # Consumption counters (single row, kept current by triggers so
+            # stats are O(1) regardless of how much history is stored)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS consumption_counters (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    total_records INTEGER NOT NULL DEFAULT 0,
+                    pending_sync INTEGER NOT NULL DEFAULT 0,
+                    synced INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    total_volume_ml REAL NOT NULL DEFAULT 0
+                )
+            ''')
+            
+            # The triggers run inside the statement that fires them, so the
+            # counters commit or roll back together with the consumption write
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_counters_insert
+                AFTER INSERT ON consumptions
+                BEGIN
+                    UPDATE consumption_counters SET
+                        total_records = total_records + 1,
+                        pending_sync = pending_sync + (NEW.sync_status = 'pending'),
+                        synced = synced + (NEW.sync_status = 'synced'),
+                        failed = failed + (NEW.sync_status = 'failed'),
+                        total_volume_ml = total_volume_ml + NEW.volume_dispensed_ml
+                    WHERE id = 1;
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_counters_update
+                AFTER UPDATE OF sync_status, volume_dispensed_ml ON consumptions
+                WHEN OLD.sync_status IS NOT NEW.sync_status
+                  OR OLD.volume_dispensed_ml IS NOT NEW.volume_dispensed_ml
+                BEGIN
+                    UPDATE consumption_counters SET
+                        pending_sync = pending_sync - (OLD.sync_status = 'pending') + (NEW.sync_status = 'pending'),
+                        synced = synced - (OLD.sync_status = 'synced') + (NEW.sync_status = 'synced'),
+                        failed = failed - (OLD.sync_status = 'failed') + (NEW.sync_status = 'failed'),
+                        total_volume_ml = total_volume_ml - OLD.volume_dispensed_ml + NEW.volume_dispensed_ml
+                    WHERE id = 1;
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_counters_delete
+                AFTER DELETE ON consumptions
+                BEGIN
+                    UPDATE consumption_counters SET
+                        total_records = total_records - 1,
+                        pending_sync = pending_sync - (OLD.sync_status = 'pending'),
+                        synced = synced - (OLD.sync_status = 'synced'),
+                        failed = failed - (OLD.sync_status = 'failed'),
+                        total_volume_ml = total_volume_ml - OLD.volume_dispensed_ml
+                    WHERE id = 1;
+                END
+            ''')
+            
             # Create indexes
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_sync_status ON consumptions(sync_status)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_created_at ON consumptions(created_at)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_token_expires ON used_tokens(expires_at)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sync_status_created ON consumptions(sync_status, created_at)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sync_log_attempted ON sync_log(attempted_at)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sync_log_consumption ON sync_log(consumption_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_dispense_metrics_tap ON dispense_metrics(tap_id, created_at)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_pulse_traces_created ON pulse_traces(created_at)')
+            
+            # Databases created before the counters existed start from a full recount
+            cursor.execute('SELECT 1 FROM consumption_counters WHERE id = 1')
+            if cursor.fetchone() is None:
+                cursor.execute('INSERT INTO consumption_counters (id) VALUES (1)')
+                self._rebuild_counters(cursor)
             
             conn.commit()
         
         self._initialized = True
         print(f"✅ Database initialized: {self.db_path}")
+        self.publish_stats()
     
     # ==================== Consumption Methods ====================
     
+    def build_consumption(self,
+                          sale_id: str,
+                          token_id: str,
+                          beverage_id: str,
+                          tap_id: int,
+                          volume_authorized_ml: int,
+                          volume_dispensed_ml: float,
+                          started_at: datetime,
+                          finished_at: datetime,
+                          pulse_count: int,
+                          flow_rate_avg: float,
+                          status: str = "completed",
+                          error_message: str = None) -> ConsumptionRecord:
+        """Build a new (not yet stored) consumption record with its final id"""
+        return ConsumptionRecord(
+            id=str(uuid.uuid4()),
+            sale_id=sale_id,
+            token_id=token_id,
+            beverage_id=beverage_id,
+            tap_id=tap_id,
+            volume_authorized_ml=volume_authorized_ml,
+            volume_dispensed_ml=volume_dispensed_ml,
+            started_at=started_at.isoformat(),
+            finished_at=finished_at.isoformat(),
+            duration_seconds=(finished_at - started_at).total_seconds(),
+            pulse_count=pulse_count,
+            flow_rate_avg=flow_rate_avg,
+            status=status,
+            sync_status=SyncStatus.PENDING.value,
+            sync_attempts=0,
+            last_sync_attempt=None,
+            error_message=error_message,
+            created_at=datetime.utcnow().isoformat()
+        )
+    
+    def insert_consumptions(self, records: List[ConsumptionRecord]) -> List[ConsumptionRecord]:
+        """
+        Insert records in a single transaction (group commit)
+        
+        Uses INSERT ... RETURNING so the stored rows come back without a
+        second query. Any failure rolls back the whole group.
+        
+        Returns the stored records, in the same order
+        """
+        stored = []
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            for record in records:
+                params = (
+                    record.id, record.sale_id, record.token_id, record.beverage_id, record.tap_id,
+                    record.volume_authorized_ml, record.volume_dispensed_ml,
+                    record.started_at, record.finished_at, record.duration_seconds,
+                    record.pulse_count, record.flow_rate_avg, record.status,
+                    record.sync_status, record.sync_attempts, record.error_message, record.created_at
+                )
+                if _HAS_RETURNING:
+                    cursor.execute(_INSERT_CONSUMPTION_SQL + ' RETURNING *', params)
+                    stored.append(ConsumptionRecord.from_row(tuple(cursor.fetchone())))
+                else:
+                    cursor.execute(_INSERT_CONSUMPTION_SQL, params)
+                    stored.append(record)
+        
+        return stored
+    
+    def existing_consumption_ids(self, ids: List[str]) -> set:
+        """Which of ids are already stored"""
+        found = set()
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(f'SELECT id FROM consumptions WHERE id IN ({placeholders})', chunk)
+                found.update(row[0] for row in cursor.fetchall())
+        return found
+    
     def save_consumption(self, 
                          sale_id: str,
                          token_id: str,
@@ -175,35 +551,28 @@ class Database:
                          flow_rate_avg: float,
                          status: str = "completed",
                          error_message: str = None) -> ConsumptionRecord:
-        """Save a new consumption record"""
-        
-        record_id = str(uuid.uuid4())
-        now = datetime.utcnow().isoformat()
-        duration = (finished_at - started_at).total_seconds()
-        
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO consumptions (
-                    id, sale_id, token_id, beverage_id, tap_id,
-                    volume_authorized_ml, volume_dispensed_ml,
-                    started_at, finished_at, duration_seconds,
-                    pulse_count, flow_rate_avg, status,
-                    sync_status, sync_attempts, error_message, created_at
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                record_id, sale_id, token_id, beverage_id, tap_id,
-                volume_authorized_ml, volume_dispensed_ml,
-                started_at.isoformat(), finished_at.isoformat(), duration,
-                pulse_count, flow_rate_avg, status,
-                SyncStatus.PENDING.value, 0, error_message, now
-            ))
-        
-        return self.get_consumption(record_id)
+        """Save a new consumption record (synchronous; see consumption_writer)"""
+        record = self.build_consumption(
+            sale_id=sale_id,
+            token_id=token_id,
+            beverage_id=beverage_id,
+            tap_id=tap_id,
+            volume_authorized_ml=volume_authorized_ml,
+            volume_dispensed_ml=volume_dispensed_ml,
+            started_at=started_at,
+            finished_at=finished_at,
+            pulse_count=pulse_count,
+            flow_rate_avg=flow_rate_avg,
+            status=status,
+            error_message=error_message
+        )
+        stored = self.insert_consumptions([record])[0]
+        self.publish_stats()
+        return stored
     
     def get_consumption(self, record_id: str) -> Optional[ConsumptionRecord]:
         """Get consumption by ID"""
-        with self.get_connection() as conn:
+        with self.get_read_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM consumptions WHERE id = ?', (record_id,))
             row = cursor.fetchone()
@@ -211,7 +580,7 @@ class Database:
     
     def get_pending_consumptions(self, limit: int = 50) -> List[ConsumptionRecord]:
         """Get consumptions pending sync"""
-        with self.get_connection() as conn:
+        with self.get_read_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT * FROM consumptions 
@@ -224,7 +593,7 @@ class Database:
     
     def get_failed_consumptions(self, max_attempts: int = 5) -> List[ConsumptionRecord]:
         """Get failed consumptions that haven't exceeded retry limit"""
-        with self.get_connection() as conn:
+        with self.get_read_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT * FROM consumptions 
@@ -237,81 +606,587 @@ class Database:
     
     def mark_synced(self, record_id: str, response_code: int = 200, response_body: str = None):
         """Mark consumption as synced"""
+        self.apply_sync_outcomes([(record_id, True, response_code, response_body)])
+    
+    def mark_sync_failed(self, record_id: str, error_message: str, response_code: int = None):
+        """Mark consumption sync as failed"""
+        self.apply_sync_outcomes([(record_id, False, response_code, error_message)])
+    
+    def apply_sync_outcomes(self, outcomes: List[tuple]):
+        """
+        Apply many sync results in a single transaction
+        
+        Args:
+            outcomes: (record_id, success, response_code, message) tuples.
+                      message is stored as response_body on success and
+                      as error_message on failure.
+        """
+        if not outcomes:
+            return
+        
         now = datetime.utcnow().isoformat()
+        synced = [outcome for outcome in outcomes if outcome[1]]
+        failed = [outcome for outcome in outcomes if not outcome[1]]
         
         with self.get_connection() as conn:
             cursor = conn.cursor()
             
-            # Update consumption
-            cursor.execute('''
-                UPDATE consumptions 
-                SET sync_status = ?, sync_attempts = sync_attempts + 1, last_sync_attempt = ?
-                WHERE id = ?
-            ''', (SyncStatus.SYNCED.value, now, record_id))
+            if synced:
+                cursor.executemany('''
+                    UPDATE consumptions 
+                    SET sync_status = ?, sync_attempts = sync_attempts + 1, last_sync_attempt = ?
+                    WHERE id = ?
+                ''', [(SyncStatus.SYNCED.value, now, record_id) for record_id, _, _, _ in synced])
+                
+                cursor.executemany('''
+                    INSERT INTO sync_log (consumption_id, attempted_at, success, response_code, response_body)
+                    VALUES (?, ?, 1, ?, ?)
+                ''', [(record_id, now, code, message) for record_id, _, code, message in synced])
             
-            # Log sync attempt
+            if failed:
+                cursor.executemany('''
+                    UPDATE consumptions 
+                    SET sync_status = ?, sync_attempts = sync_attempts + 1, 
+                        last_sync_attempt = ?, error_message = ?
+                    WHERE id = ?
+                ''', [(SyncStatus.FAILED.value, now, message, record_id)
+                      for record_id, _, _, message in failed])
+                
+                cursor.executemany('''
+                    INSERT INTO sync_log (consumption_id, attempted_at, success, response_code, error_message)
+                    VALUES (?, ?, 0, ?, ?)
+                ''', [(record_id, now, code, message) for record_id, _, code, message in failed])
+        
+        self.publish_stats()
+    
+    def count_pending(self) -> int:
+        """Number of records waiting for their first sync"""
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*) FROM consumptions WHERE sync_status = ?',
+                           (SyncStatus.PENDING.value,))
+            return cursor.fetchone()[0]
+    
+    def count_retryable(self, max_attempts: int = 5) -> int:
+        """Number of failed records still under the retry limit"""
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO sync_log (consumption_id, attempted_at, success, response_code, response_body)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (record_id, now, 1, response_code, response_body))
+                SELECT COUNT(*) FROM consumptions 
+                WHERE sync_status = ? AND sync_attempts < ?
+            ''', (SyncStatus.FAILED.value, max_attempts))
+            return cursor.fetchone()[0]
     
-    def mark_sync_failed(self, record_id: str, error_message: str, response_code: int = None):
-        """Mark consumption sync as failed"""
-        now = datetime.utcnow().isoformat()
+    def get_consumption_stats(self) -> Dict[str, Any]:
+        """Get consumption statistics (O(1), read from consumption_counters)"""
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT total_records, pending_sync, synced, failed, total_volume_ml
+                FROM consumption_counters WHERE id = 1
+            ''')
+            row = cursor.fetchone()
+        
+        if row is None:
+            return {
+                "total_records": 0,
+                "pending_sync": 0,
+                "synced": 0,
+                "failed": 0,
+                "total_volume_ml": 0
+            }
+        
+        return {
+            "total_records": row[0],
+            "pending_sync": row[1],
+            "synced": row[2],
+            "failed": row[3],
+            "total_volume_ml": row[4]
+        }
+    
+    def _count_consumptions(self, cursor) -> Dict[str, Any]:
+        """Recompute the counters with a full scan of consumptions"""
+        cursor.execute('''
+            SELECT
+                COUNT(*),
+                COALESCE(SUM(sync_status = ?), 0),
+                COALESCE(SUM(sync_status = ?), 0),
+                COALESCE(SUM(sync_status = ?), 0),
+                COALESCE(SUM(volume_dispensed_ml), 0)
+            FROM consumptions
+        ''', (SyncStatus.PENDING.value, SyncStatus.SYNCED.value, SyncStatus.FAILED.value))
+        row = cursor.fetchone()
+        return {
+            "total_records": row[0],
+            "pending_sync": row[1],
+            "synced": row[2],
+            "failed": row[3],
+            "total_volume_ml": row[4]
+        }
+    
+    def _rebuild_counters(self, cursor) -> Dict[str, Any]:
+        """Overwrite the counters with a fresh recount"""
+        actual = self._count_consumptions(cursor)
+        cursor.execute('''
+            UPDATE consumption_counters
+            SET total_records = ?, pending_sync = ?, synced = ?, failed = ?, total_volume_ml = ?
+            WHERE id = 1
+        ''', (actual["total_records"], actual["pending_sync"], actual["synced"],
+              actual["failed"], actual["total_volume_ml"]))
+        return actual
+    
+    def check_counters(self, repair: bool = True) -> Dict[str, Any]:
+        """
+        Consistency check: recompute the counters from scratch
         
+        Compares the maintained counters with a full recount and, if
+        repair is set, overwrites them with the recount.
+        
+        Returns dict with: consistent, stored, actual
+        """
         with self.get_connection() as conn:
             cursor = conn.cursor()
+            if not conn.in_transaction:
+                # Hold the write lock so no consumption lands between the reads
+                cursor.execute('BEGIN IMMEDIATE')
             
-            # Update consumption
             cursor.execute('''
-                UPDATE consumptions 
-                SET sync_status = ?, sync_attempts = sync_attempts + 1, 
-                    last_sync_attempt = ?, error_message = ?
-                WHERE id = ?
-            ''', (SyncStatus.FAILED.value, now, error_message, record_id))
+                SELECT total_records, pending_sync, synced, failed, total_volume_ml
+                FROM consumption_counters WHERE id = 1
+            ''')
+            row = cursor.fetchone() or (0, 0, 0, 0, 0)
+            stored = {
+                "total_records": row[0],
+                "pending_sync": row[1],
+                "synced": row[2],
+                "failed": row[3],
+                "total_volume_ml": row[4]
+            }
+            actual = self._count_consumptions(cursor)
             
-            # Log sync attempt
+            consistent = all(
+                stored[key] == actual[key] for key in ("total_records", "pending_sync", "synced", "failed")
+            ) and abs(stored["total_volume_ml"] - actual["total_volume_ml"]) < 0.01
+            
+            if not consistent and repair:
+                self._rebuild_counters(cursor)
+                print(f"🔧 Consumption counters repaired: {stored} -> {actual}")
+        
+        if not consistent and repair:
+            self.publish_stats()
+        
+        return {"consistent": consistent, "stored": stored, "actual": actual}
+    
+    def publish_stats(self):
+        """
+        Publish consumption stats to the status snapshot
+        Called after every write so GET /edge/status never queries SQLite
+        """
+        try:
+            stats = self.get_consumption_stats()
+        except sqlite3.Error as e:
+            print(f"⚠️ Failed to refresh consumption stats: {e}")
+            return
+        
+        status_snapshot.update("database", stats)
+        status_snapshot.merge("sync", records=stats)
+    
+    # ==================== Dispense Metrics Methods ====================
+    
+    def save_dispense_metrics(self, metrics: Dict[str, Any]):
+        """Store the cutoff measurements of one pour"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO dispense_metrics (
+                    consumption_id, tap_id, cutoff_reason, target_ml, target_pulses,
+                    cutoff_pulses, final_pulses, overshoot_ml, trailing_ml,
+                    cutoff_latency_ms, settle_ms, created_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                metrics["consumption_id"], metrics["tap_id"], metrics["cutoff_reason"],
+                metrics["target_ml"], metrics["target_pulses"], metrics.get("cutoff_pulses"),
+                metrics["final_pulses"], metrics["overshoot_ml"], metrics.get("trailing_ml"),
+                metrics.get("cutoff_latency_ms"), metrics.get("settle_ms"),
+                datetime.utcnow().isoformat()
+            ))
+    
+    def get_overshoot_stats(self, tap_id: int, limit: int = 100) -> Dict[str, Any]:
+        """Overshoot of the tap's last `limit` pours that were cut off at the target"""
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT COUNT(*), AVG(overshoot_ml), MIN(overshoot_ml), MAX(overshoot_ml),
+                       AVG(cutoff_latency_ms), MAX(cutoff_latency_ms), AVG(settle_ms)
+                FROM (
+                    SELECT * FROM dispense_metrics
+                    WHERE tap_id = ? AND cutoff_reason = 'target'
+                    ORDER BY created_at DESC
+                    LIMIT ?
+                )
+            ''', (tap_id, limit))
+            row = cursor.fetchone()
+        
+        return {
+            "tap_id": tap_id,
+            "pours": row[0],
+            "overshoot_ml_avg": row[1],
+            "overshoot_ml_min": row[2],
+            "overshoot_ml_max": row[3],
+            "cutoff_latency_ms_avg": row[4],
+            "cutoff_latency_ms_max": row[5],
+            "settle_ms_avg": row[6]
+        }
+    
+    # ==================== Watchdog Event Methods ====================
+    
+    def save_watchdog_event(self, event: Dict[str, Any]):
+        """Store one pump forced off by the watchdog"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO watchdog_events (tap_id, sale_id, deadline_s, elapsed_s, pulse_count, fired_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (event["tap_id"], event.get("sale_id"), event["deadline_s"], event["elapsed_s"],
+                  event.get("pulse_count"), event["fired_at"]))
+    
+    def get_watchdog_events(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Newest watchdog events first"""
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM watchdog_events ORDER BY id DESC LIMIT ?', (limit,))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    # ==================== Overshoot Model Methods ====================
+    
+    def save_overshoot_estimate(self, tap_id: int, band: int, trailing_pulses: float,
+                                samples: int, updated_at: str):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO sync_log (consumption_id, attempted_at, success, response_code, error_message)
+                INSERT OR REPLACE INTO overshoot_model (tap_id, band, trailing_pulses, samples, updated_at)
                 VALUES (?, ?, ?, ?, ?)
-            ''', (record_id, now, 0, response_code, error_message))
+            ''', (tap_id, band, trailing_pulses, samples, updated_at))
     
-    def get_consumption_stats(self) -> Dict[str, Any]:
-        """Get consumption statistics"""
+    def get_overshoot_estimates(self) -> List[Dict[str, Any]]:
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT tap_id, band, trailing_pulses, samples, updated_at FROM overshoot_model')
+            return [dict(row) for row in cursor.fetchall()]
+    
+    # ==================== Pulse Trace Methods ====================
+    
+    def save_pulse_trace(self, consumption_id: str, tap_id: int, pulse_count: int,
+                         sample_width: int, deltas: bytes):
+        """Store one pour's encoded pulse trace"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO pulse_traces (
+                    consumption_id, tap_id, pulse_count, sample_width, deltas, created_at
+                ) VALUES (?, ?, ?, ?, ?, ?)
+            ''', (consumption_id, tap_id, pulse_count, sample_width, sqlite3.Binary(deltas),
+                  datetime.utcnow().isoformat()))
+    
+    def get_pulse_trace(self, consumption_id: str) -> Optional[Dict[str, Any]]:
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM pulse_traces WHERE consumption_id = ?', (consumption_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    
+    def prune_pulse_traces(self, keep_rows: int) -> int:
+        """Delete all but the newest keep_rows traces"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM pulse_traces WHERE consumption_id IN (
+                    SELECT consumption_id FROM pulse_traces
+                    ORDER BY created_at DESC
+                    LIMIT -1 OFFSET ?
+                )
+            ''', (max(keep_rows, 0),))
+            return cursor.rowcount
+    
+    # ==================== Calibration Methods ====================
+    
+    def add_calibration_reference(self, tap_id: int, kind: str, volume_ml: float,
+                                  consumption_id: str = None, pulse_count: int = None,
+                                  duration_seconds: float = None, window_start: str = None,
+                                  window_end: str = None) -> int:
+        """Store a reference pour ("pour") or an emptied keg window ("keg")"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO calibration_references (
+                    tap_id, kind, volume_ml, consumption_id, pulse_count,
+                    duration_seconds, window_start, window_end, created_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (tap_id, kind, volume_ml, consumption_id, pulse_count, duration_seconds,
+                  window_start, window_end, datetime.utcnow().isoformat()))
+            return cursor.lastrowid
+    
+    def get_calibration_references(self, tap_id: int = None) -> List[Dict[str, Any]]:
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            if tap_id is None:
+                cursor.execute('SELECT * FROM calibration_references ORDER BY id')
+            else:
+                cursor.execute('SELECT * FROM calibration_references WHERE tap_id = ? ORDER BY id', (tap_id,))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def get_pour_samples(self, tap_id: int, since: str, until: str) -> List[Dict[str, Any]]:
+        """Pulse count, duration and cutoff reason of a tap's pours in [since, until)"""
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT c.id, c.started_at, c.pulse_count, c.duration_seconds, m.cutoff_reason
+                FROM consumptions c
+                LEFT JOIN dispense_metrics m ON m.consumption_id = c.id
+                WHERE c.tap_id = ? AND c.started_at >= ? AND c.started_at < ?
+                ORDER BY c.started_at
+            ''', (tap_id, since, until))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def has_pruned_pours(self, tap_id: int, since: str) -> bool:
+        """Whether some of a tap's pours since `since` were already rolled up and deleted"""
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT 1 FROM consumption_daily_rollups WHERE tap_id = ? AND day >= ? LIMIT 1',
+                (tap_id, since[:10])
+            )
+            return cursor.fetchone() is not None
+    
+    def save_flow_calibration(self, tap_id: int, pulses_per_liter: float, bands: str,
+                              observations: int, rms_error_pct: Optional[float], fitted_at: str):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO flow_calibration (
+                    tap_id, pulses_per_liter, bands, observations, rms_error_pct, fitted_at
+                ) VALUES (?, ?, ?, ?, ?, ?)
+            ''', (tap_id, pulses_per_liter, bands, observations, rms_error_pct, fitted_at))
+    
+    def get_flow_calibrations(self) -> List[Dict[str, Any]]:
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM flow_calibration ORDER BY tap_id')
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def delete_flow_calibration(self, tap_id: int) -> bool:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM flow_calibration WHERE tap_id = ?', (tap_id,))
+            return cursor.rowcount > 0
+    
+    # ==================== Key Ring Methods ====================
+    
+    def save_hmac_keys(self, keys: List[Dict[str, Any]], current_kid: Optional[int] = None):
+        """Replace the stored key ring (times in unix seconds)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM hmac_keys')
+            cursor.executemany('''
+                INSERT INTO hmac_keys (kid, secret, valid_from, valid_until, is_current)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(key["kid"], key["secret"], key.get("valid_from"), key.get("valid_until"),
+                   int(key["kid"] == current_kid)) for key in keys])
+    
+    def get_hmac_keys(self) -> tuple:
+        """Stored key ring as (keys, current_kid)"""
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT kid, secret, valid_from, valid_until, is_current FROM hmac_keys ORDER BY kid')
+            rows = cursor.fetchall()
+        
+        keys = [{"kid": row[0], "secret": row[1], "valid_from": row[2], "valid_until": row[3]} for row in rows]
+        current_kid = next((row[0] for row in rows if row[4]), None)
+        return keys, current_kid
+    
+    # ==================== Retention Methods ====================
+    
+    def get_prunable_consumptions(self, cutoff: str, keep_rows: int, limit: int) -> List[Dict[str, Any]]:
+        """
+        Oldest synced consumptions that fall outside the retention window
+        
+        A record is prunable when it is synced and either older than
+        cutoff or beyond the newest keep_rows synced records. Pending and
+        failed records are never returned.
+        """
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM consumptions
+                WHERE sync_status = ?
+                  AND (created_at < ? OR created_at < (
+                        SELECT created_at FROM consumptions
+                        WHERE sync_status = ?
+                        ORDER BY created_at DESC
+                        LIMIT 1 OFFSET ?))
+                ORDER BY created_at ASC
+                LIMIT ?
+            ''', (SyncStatus.SYNCED.value, cutoff, SyncStatus.SYNCED.value, max(keep_rows - 1, 0), limit))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def get_sync_log_for(self, consumption_ids: List[str]) -> List[Dict[str, Any]]:
+        """sync_log rows of the given consumptions"""
+        if not consumption_ids:
+            return []
+        placeholders = ",".join("?" * len(consumption_ids))
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT * FROM sync_log WHERE consumption_id IN ({placeholders}) ORDER BY id
+            ''', tuple(consumption_ids))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def prune_consumptions(self, consumption_ids: List[str]) -> int:
+        """
+        Roll up and delete synced consumptions in one transaction
+        
+        The records are added to consumption_daily_rollups (by started_at
+        day and tap), then their sync_log, dispense_metrics and
+        pulse_traces rows and the records themselves are deleted.
+        Returns the number of consumptions removed.
+        """
+        if not consumption_ids:
+            return 0
+        
+        placeholders = ",".join("?" * len(consumption_ids))
+        params = (*consumption_ids, SyncStatus.SYNCED.value)
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                INSERT INTO consumption_daily_rollups (
+                    day, tap_id, records, completed, interrupted, errors,
+                    volume_authorized_ml, volume_dispensed_ml, duration_seconds, pulse_count
+                )
+                SELECT substr(started_at, 1, 10), tap_id, COUNT(*),
+                       SUM(status = 'completed'), SUM(status = 'interrupted'), SUM(status = 'error'),
+                       SUM(volume_authorized_ml), SUM(volume_dispensed_ml),
+                       SUM(duration_seconds), SUM(pulse_count)
+                FROM consumptions
+                WHERE id IN ({placeholders}) AND sync_status = ?
+                GROUP BY substr(started_at, 1, 10), tap_id
+                ON CONFLICT (day, tap_id) DO UPDATE SET
+                    records = records + excluded.records,
+                    completed = completed + excluded.completed,
+                    interrupted = interrupted + excluded.interrupted,
+                    errors = errors + excluded.errors,
+                    volume_authorized_ml = volume_authorized_ml + excluded.volume_authorized_ml,
+                    volume_dispensed_ml = volume_dispensed_ml + excluded.volume_dispensed_ml,
+                    duration_seconds = duration_seconds + excluded.duration_seconds,
+                    pulse_count = pulse_count + excluded.pulse_count
+            ''', params)
             
-            cursor.execute('SELECT COUNT(*) FROM consumptions')
-            total = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM consumptions WHERE sync_status = ?', 
-                          (SyncStatus.PENDING.value,))
-            pending = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM consumptions WHERE sync_status = ?', 
-                          (SyncStatus.SYNCED.value,))
-            synced = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM consumptions WHERE sync_status = ?', 
-                          (SyncStatus.FAILED.value,))
-            failed = cursor.fetchone()[0]
+            cursor.execute(f'''
+                DELETE FROM sync_log WHERE consumption_id IN (
+                    SELECT id FROM consumptions WHERE id IN ({placeholders}) AND sync_status = ?
+                )
+            ''', params)
             
-            cursor.execute('SELECT SUM(volume_dispensed_ml) FROM consumptions')
-            total_volume = cursor.fetchone()[0] or 0
+            for side_table in ("dispense_metrics", "pulse_traces"):
+                cursor.execute(f'''
+                    DELETE FROM {side_table} WHERE consumption_id IN (
+                        SELECT id FROM consumptions WHERE id IN ({placeholders}) AND sync_status = ?
+                    )
+                ''', params)
             
-            return {
-                "total_records": total,
-                "pending_sync": pending,
-                "synced": synced,
-                "failed": failed,
-                "total_volume_ml": total_volume
-            }
+            cursor.execute(f'''
+                DELETE FROM consumptions WHERE id IN ({placeholders}) AND sync_status = ?
+            ''', params)
+            removed = cursor.rowcount
+        
+        self.publish_stats()
+        return removed
+    
+    def get_expired_sync_log(self, cutoff: str, limit: int) -> List[Dict[str, Any]]:
+        """Oldest sync_log rows attempted before cutoff"""
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM sync_log WHERE attempted_at < ? ORDER BY attempted_at ASC LIMIT ?
+            ''', (cutoff, limit))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def delete_sync_log(self, log_ids: List[int]) -> int:
+        """Delete sync_log rows by id"""
+        if not log_ids:
+            return 0
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('DELETE FROM sync_log WHERE id = ?', [(log_id,) for log_id in log_ids])
+            return len(log_ids)
+    
+    def get_daily_rollups(self, since_day: str = None) -> List[Dict[str, Any]]:
+        """Daily per-tap summaries of pruned consumptions"""
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM consumption_daily_rollups
+                WHERE day >= ?
+                ORDER BY day, tap_id
+            ''', (since_day or "",))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def vacuum_step(self, min_free_pages: int, max_pages: int) -> Dict[str, Any]:
+        """
+        Return free pages to the filesystem
+        
+        Releases at most max_pages once the freelist holds min_free_pages
+        or more. Databases created before auto_vacuum=INCREMENTAL are left
+        alone (mode "needs_conversion"): converting them takes a full
+        VACUUM, see convert_incremental_vacuum().
+        """
+        conn = self._writer.connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('PRAGMA auto_vacuum')
+        if cursor.fetchone()[0] != 2:
+            return {"mode": "needs_conversion", "freed_pages": 0}
+        
+        cursor.execute('PRAGMA freelist_count')
+        free_pages = cursor.fetchone()[0]
+        if free_pages < min_free_pages:
+            return {"mode": "skipped", "freed_pages": 0}
+        
+        cursor.execute(f'PRAGMA incremental_vacuum({int(max_pages)})')
+        cursor.fetchall()
+        cursor.execute('PRAGMA freelist_count')
+        freed = free_pages - cursor.fetchone()[0]
+        
+        # Shrink the WAL file as well
+        cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        cursor.fetchall()
+        return {"mode": "incremental", "freed_pages": freed}
+    
+    def convert_incremental_vacuum(self) -> bool:
+        """
+        One-time full VACUUM to auto_vacuum=INCREMENTAL
+        
+        Rewrites the whole file while holding the write lock, far longer
+        than busy_timeout on a large database, so it is only run from the
+        maintenance CLI with the server stopped (python retention.py
+        --convert-vacuum). Returns False if already incremental.
+        """
+        conn = self._writer.connection()
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA auto_vacuum')
+        if cursor.fetchone()[0] == 2:
+            return False
+        
+        print("🧹 Converting database to incremental auto_vacuum (full VACUUM)...")
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+        return True
     
     # ==================== Token Methods ====================
     
     def is_token_used(self, nonce: str) -> bool:
         """Check if token nonce has been used"""
-        with self.get_connection() as conn:
+        with self.get_read_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT 1 FROM used_tokens WHERE nonce = ?', (nonce,))
             return cursor.fetchone() is not None
@@ -328,8 +1203,39 @@ class Database:
                 VALUES (?, ?, ?)
             ''', (nonce, now.isoformat(), expires.isoformat()))
     
-    def cleanup_expired_tokens(self):
-        """Remove expired token entries"""
+    def claim_token(self, nonce: str, ttl_seconds: int = 300) -> bool:
+        """
+        Atomically mark a nonce as used
+        
+        Returns False if the nonce was already claimed (replay). The
+        INSERT OR IGNORE is the authoritative single-use check.
+        """
+        now = datetime.utcnow()
+        expires = datetime.utcfromtimestamp(time.time() + ttl_seconds)
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR IGNORE INTO used_tokens (nonce, used_at, expires_at)
+                VALUES (?, ?, ?)
+            ''', (nonce, now.isoformat(), expires.isoformat()))
+            return cursor.rowcount == 1
+    
+    def release_token(self, nonce: str):
+        """Forget a claimed nonce (rollback when a dispense never started)"""
+        with self.get_connection() as conn:
+            conn.execute('DELETE FROM used_tokens WHERE nonce = ?', (nonce,))
+    
+    def get_active_token_nonces(self) -> List[str]:
+        """Nonces that have not expired yet (to rebuild in-memory filters)"""
+        now = datetime.utcnow().isoformat()
+        with self.get_read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT nonce FROM used_tokens WHERE expires_at >= ?', (now,))
+            return [row[0] for row in cursor.fetchall()]
+    
+    def cleanup_expired_tokens(self) -> int:
+        """Remove expired token entries (returns the number removed)"""
         now = datetime.utcnow().isoformat()
         
         with self.get_connection() as conn:
@@ -338,6 +1244,8 @@ class Database:
             deleted = cursor.rowcount
             if deleted > 0:
                 print(f"🧹 Cleaned up {deleted} expired tokens")
+        
+        return deleted
 
 
 # Global database instance
@@ -380,6 +1288,10 @@ if __name__ == "__main__":
     stats = db.get_consumption_stats()
     print(f"Stats: {stats}")
     
+    # Counters consistency check
+    check = db.check_counters(repair=False)
+    print(f"Counters consistent: {check['consistent']}")
+    
     # Test token usage
     test_nonce = "test-nonce-123"
     print(f"\nToken used (before): {db.is_token_used(test_nonce)}")
@@ -1,18 +1,47 @@
 """
 Dispenser Logic for EDGE Server
 Handles the complete dispensing flow with safety controls
+
+One Dispenser per tap (own GPIO controller, lock and state machine),
+held by the DispenserRegistry, so several taps can pour at once.
+
+On real hardware the volume cutoff happens in the flow-sensor interrupt
+(GPIOController.arm_cutoff); the dispense loop is only a slower
+supervisor for progress, cancel, timeout and empty-keg checks. Each pour
+stores its measured overshoot in dispense_metrics, and the post-cutoff
+pulses train the OvershootModel that makes the next cutoff fire early.
+The PumpWatchdog holds a hard deadline for every pour, so the pump goes
+off even if this loop is stuck.
+
+A tap goes back to IDLE as soon as the pump is off and the consumption
+is queued. The outcome stays readable in the CompletionLog (by sale_id,
+and as "last_result" in the tap status) for COMPLETION_TTL seconds.
+
+All timing goes through an injectable Clock, so simulator.py can run
+pours on a VirtualClock.
 """
-import time
+import json
+import math
+import queue
+import sqlite3
 import threading
+from collections import OrderedDict
 from datetime import datetime
-from typing import Optional, Callable, Dict, Any
+from typing import Optional, Callable, Dict, Any, List
 from dataclasses import dataclass
+from functools import partial
 from enum import Enum
 
 from config import config
-from gpio_controller import gpio_controller, FlowReading, MOCK_GPIO
+from clock import Clock, system_clock
+from gpio_controller import GPIOController, gpio_controllers, FlowReading
 from database import database, ConsumptionRecord
+from consumption_writer import consumption_writer
 from token_validator import TokenPayload
+from status_snapshot import status_snapshot
+from telemetry import telemetry_store
+from overshoot import overshoot_model, OverrunEstimate
+from pump_watchdog import pump_watchdog, WatchdogHandle
 
 
 class DispenseStatus(Enum):
@@ -36,10 +65,14 @@ class DispenseResult:
     pulse_count: int
     error_message: Optional[str] = None
     consumption_record: Optional[ConsumptionRecord] = None
+    tap_id: Optional[int] = None
+    record_id: Optional[str] = None  # when rebuilt from to_dict() (controller process)
+    token_unused: bool = False  # the pump never started, so the token may be used again
     
     def to_dict(self) -> Dict[str, Any]:
         return {
             "success": self.success,
+            "tap_id": self.tap_id,
             "status": self.status.value,
             "sale_id": self.sale_id,
             "volume_authorized_ml": self.volume_authorized_ml,
@@ -47,13 +80,173 @@ class DispenseResult:
             "duration_seconds": round(self.duration_seconds, 2),
             "pulse_count": self.pulse_count,
             "error_message": self.error_message,
-            "record_id": self.consumption_record.id if self.consumption_record else None
+            "record_id": self.consumption_record.id if self.consumption_record else self.record_id,
+            "token_unused": self.token_unused
         }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "DispenseResult":
+        """Inverse of to_dict() (without the consumption record itself)"""
+        return cls(
+            success=data["success"],
+            status=DispenseStatus(data["status"]),
+            sale_id=data["sale_id"],
+            volume_authorized_ml=data["volume_authorized_ml"],
+            volume_dispensed_ml=data["volume_dispensed_ml"],
+            duration_seconds=data["duration_seconds"],
+            pulse_count=data["pulse_count"],
+            error_message=data.get("error_message"),
+            tap_id=data.get("tap_id"),
+            record_id=data.get("record_id"),
+            token_unused=data.get("token_unused", False)
+        )
+
+
+@dataclass
+class DispenseEvent:
+    """Event delivered to dispense stream subscribers"""
+    id: int
+    type: str  # status, progress, result, watchdog
+    data: Dict[str, Any]
+    
+    def to_sse(self) -> str:
+        """Format as a Server-Sent Events message"""
+        return f"id: {self.id}\nevent: {self.type}\ndata: {json.dumps(self.data)}\n\n"
+
+
+class DispenseEventBus:
+    """
+    Fan-out of dispense events from every tap
+    
+    One queue per subscriber, optionally filtered to a single tap. Event
+    ids are global, so a stream that follows several taps stays ordered.
+    """
+    
+    def __init__(self):
+        self._subscribers: Dict[queue.Queue, Optional[int]] = {}
+        self._lock = threading.Lock()
+        self._event_seq = 0
+    
+    def subscribe(self, tap_id: Optional[int] = None, max_events: int = 256) -> queue.Queue:
+        """
+        Register a subscriber for dispense events
+        
+        Returns a queue that receives DispenseEvent objects (status
+        transitions, progress and the final result) of tap_id, or of all
+        taps when tap_id is None. Slow subscribers lose their oldest
+        events instead of blocking the dispense loop.
+        """
+        events: queue.Queue = queue.Queue(maxsize=max_events)
+        with self._lock:
+            self._subscribers[events] = tap_id
+        return events
+    
+    def unsubscribe(self, events: queue.Queue):
+        """Remove a subscriber registered with subscribe()"""
+        with self._lock:
+            self._subscribers.pop(events, None)
+    
+    def emit(self, tap_id: int, event_type: str, data: Dict[str, Any]):
+        """Deliver an event to every matching subscriber without blocking"""
+        with self._lock:
+            subscribers = [
+                events for events, tap_filter in self._subscribers.items()
+                if tap_filter is None or tap_filter == tap_id
+            ]
+            if not subscribers:
+                return
+            self._event_seq += 1
+            event = DispenseEvent(id=self._event_seq, type=event_type, data=data)
+        
+        for events in subscribers:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                # Drop the oldest event to make room for the newest one
+                try:
+                    events.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    events.put_nowait(event)
+                except queue.Full:
+                    pass
+
+
+@dataclass
+class CompletionRecord:
+    """Outcome of a finished dispense"""
+    seq: int
+    tap_id: int
+    sale_id: str
+    result: Dict[str, Any]
+    expires_at: float  # clock.monotonic()
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {"seq": self.seq, **self.result}
+
+
+class CompletionLog:
+    """
+    Recent dispense outcomes by sale_id
+    
+    Sequence numbers increase across every tap, so a client can tell a
+    new outcome from one it has already seen. Records expire after ttl
+    seconds and at most max_records are kept.
+    """
+    
+    def __init__(self, ttl: Optional[float] = None, max_records: int = 256,
+                 clock: Optional[Clock] = None):
+        self.ttl = ttl if ttl is not None else config.gpio.COMPLETION_TTL
+        self.max_records = max_records
+        self.clock = clock or system_clock
+        self._records: "OrderedDict[str, CompletionRecord]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._seq = 0
+    
+    def record(self, result: "DispenseResult") -> CompletionRecord:
+        now = self.clock.monotonic()
+        with self._lock:
+            self._seq += 1
+            completion = CompletionRecord(
+                seq=self._seq,
+                tap_id=result.tap_id,
+                sale_id=result.sale_id,
+                result=result.to_dict(),
+                expires_at=now + self.ttl
+            )
+            self._records.pop(result.sale_id, None)
+            self._records[result.sale_id] = completion
+            self._expire_locked(now)
+        return completion
+    
+    def put(self, completion: CompletionRecord):
+        """Store a record made elsewhere (the controller process), keeping its seq"""
+        with self._lock:
+            self._seq = max(self._seq, completion.seq)
+            self._records.pop(completion.sale_id, None)
+            self._records[completion.sale_id] = completion
+            self._expire_locked(self.clock.monotonic())
+    
+    def get(self, sale_id: str) -> Optional[CompletionRecord]:
+        """Outcome of sale_id, or None if unknown or expired"""
+        now = self.clock.monotonic()
+        with self._lock:
+            self._expire_locked(now)
+            return self._records.get(sale_id)
+    
+    def _expire_locked(self, now: float):
+        # Oldest first: records are appended in completion order with the same ttl
+        while self._records:
+            sale_id, completion = next(iter(self._records.items()))
+            if completion.expires_at > now and len(self._records) <= self.max_records:
+                break
+            del self._records[sale_id]
 
 
 class Dispenser:
     """
-    Controls the beverage dispensing process
+    Controls the beverage dispensing process of one tap
     
     Features:
     - Volume-based dispensing with flow sensor feedback
@@ -63,23 +256,55 @@ class Dispenser:
     - Local storage of consumption records
     """
     
-    def __init__(self):
+    def __init__(self, tap_id: int, gpio: GPIOController, events: DispenseEventBus,
+                 clock: Optional[Clock] = None, writer=None,
+                 completions: Optional[CompletionLog] = None):
+        self.tap_id = tap_id
+        self.gpio = gpio
+        self.events = events
+        self.clock = clock or system_clock
+        self.writer = writer or consumption_writer
+        self.completions = completions or CompletionLog(clock=self.clock)
+        self._last_completion: Optional[CompletionRecord] = None
+        self.metrics_sink: Callable[[Dict[str, Any]], None] = database.save_dispense_metrics
+        self.trace_sink: Callable[[str, int, Any], None] = telemetry_store.save_trace
+        self.token_claim: Callable[[str, int], bool] = database.claim_token
+        self.overshoot = overshoot_model
+        self.watchdog = pump_watchdog
+        self._watchdog: Optional[WatchdogHandle] = None
         self.status = DispenseStatus.IDLE
         self.current_payload: Optional[TokenPayload] = None
         self._cancel_requested = False
         self._lock = threading.Lock()
         self._progress_callback: Optional[Callable[[float, float], None]] = None
         
+        # Set by the pulse cutoff and by cancel() to wake the supervisor early
+        self._wake = threading.Event()
+        
         # Safety parameters
         self.max_dispense_time = config.gpio.MAX_DISPENSE_TIME
         self.min_flow_rate = config.gpio.MIN_FLOW_RATE
-        self.flow_check_interval = 0.5  # Check flow every 0.5s
+        self.flow_check_interval = 0.5  # Supervisor period (cutoff itself is pulse-driven)
         self.empty_keg_timeout = 3.0  # Seconds without flow before declaring empty
+        self.watchdog_grace = config.gpio.WATCHDOG_GRACE
+        
+        # Falling-flow detection from the rolling pulse statistics
+        self.stall_intervals = config.gpio.STALL_INTERVALS
+        self.min_stall_time = config.gpio.MIN_STALL_TIME
+        self.low_flow_grace = config.gpio.LOW_FLOW_GRACE
+        self.low_flow_min_pulses = 4  # need a few intervals before judging the rate
+        self._low_flow_since: Optional[float] = None
+        
+        # After pump off, wait for trailing pulses to measure overshoot
+        self.settle_quiet_time = 0.25  # no pulse for this long = settled
+        self.settle_timeout = 1.5
         
         # MOCK mode simulation data (para não interferir com GPIO real)
         self._mock_volume_ml = 0.0
         self._mock_start_time = None
         self._mock_target_ml = 0.0
+        
+        self.publish_status()
     
     def set_progress_callback(self, callback: Callable[[float, float], None]):
         """
@@ -88,40 +313,106 @@ class Dispenser:
         """
         self._progress_callback = callback
     
+    def _emit_event(self, event_type: str, data: Dict[str, Any]):
+        """Deliver an event of this tap to stream subscribers"""
+        self.events.emit(self.tap_id, event_type, data)
+    
+    def _report_progress(self, volume_ml: float, percent: float, flow_rate_ml_s: float):
+        """Publish a progress step to the snapshot, callback and subscribers"""
+        self.publish_status(notify=False)
+        
+        if self._progress_callback:
+            self._progress_callback(volume_ml, percent)
+        
+        self._emit_event("progress", {
+            "tap_id": self.tap_id,
+            "status": DispenseStatus.DISPENSING.value,
+            "current_sale_id": self.current_payload.sale_id if self.current_payload else None,
+            "volume_dispensed_ml": round(volume_ml, 1),
+            "percentage": round(percent, 1),
+            "flow_rate_ml_s": round(flow_rate_ml_s, 1)
+        })
+    
     def get_status(self) -> Dict[str, Any]:
         """Get current dispenser status"""
         with self._lock:
             result = {
+                "tap_id": self.tap_id,
                 "status": self.status.value,
                 "is_dispensing": self.status == DispenseStatus.DISPENSING,
-                "current_sale_id": self.current_payload.sale_id if self.current_payload else None
+                "current_sale_id": self.current_payload.sale_id if self.current_payload else None,
+                "last_result": self._last_result_locked(),
+                "overshoot": self.overshoot.get_status(self.tap_id, self.gpio.pulses_per_liter)
             }
             
             # Em modo MOCK durante dispensa apenas, usar dados simulados
             # Se não está DISPENSING, reseta os dados simulados para não acumular
-            if MOCK_GPIO and self.status == DispenseStatus.DISPENSING:
+            if not self.gpio.pulse_driven and self.status == DispenseStatus.DISPENSING:
                 # Usar dados simulados durante dispensa ativa
                 result.update({
                     "volume_dispensed_ml": round(self._mock_volume_ml, 1),
-                    "duration_seconds": round(time.time() - self._mock_start_time, 2) if self._mock_start_time else 0.0,
+                    "duration_seconds": round(self.clock.monotonic() - self._mock_start_time, 2) if self._mock_start_time else 0.0,
                     "flow_rate_ml_s": 20.0  # Simulação de 20ml/s
                 })
-            else:
-                # Usar dados reais do GPIO (ou dados zerados se não dispensando)
-                reading = gpio_controller.get_flow_reading()
+            elif self.is_busy:
+                # Usar dados reais do GPIO durante a dispensa
+                reading = self.gpio.get_flow_reading()
                 result.update({
                     "volume_dispensed_ml": round(reading.volume_ml, 1),
                     "duration_seconds": round(reading.duration_seconds, 2),
-                    "flow_rate_ml_s": round(reading.flow_rate_ml_s, 1)
+                    "flow_rate_ml_s": round(reading.window_flow_ml_s, 1)
+                })
+            else:
+                # Ocioso: o resultado da última dispensa está em last_result
+                result.update({
+                    "volume_dispensed_ml": 0.0,
+                    "duration_seconds": 0.0,
+                    "flow_rate_ml_s": 0.0
                 })
             
             return result
     
+    def _last_result_locked(self) -> Optional[Dict[str, Any]]:
+        completion = self._last_completion
+        if completion is None or completion.expires_at <= self.clock.monotonic():
+            return None
+        return completion.to_dict()
+    
+    @property
+    def is_busy(self) -> bool:
+        """True while a dispense holds this tap"""
+        return self.status in (DispenseStatus.VALIDATING, DispenseStatus.DISPENSING)
+    
+    @property
+    def pulses_per_liter(self) -> float:
+        return self.gpio.pulses_per_liter
+    
+    def publish_status(self, notify: bool = True):
+        """
+        Publish dispenser and GPIO state to the status snapshot
+        Called on every state transition and progress step
+        
+        The tap's status goes to taps.<tap_id>; the default tap is also
+        mirrored to the "dispenser" section for single-tap clients.
+        
+        Args:
+            notify: Also send a "status" event to stream subscribers
+        """
+        status = self.get_status()
+        status_snapshot.merge("taps", **{str(self.tap_id): status})
+        if self.tap_id == config.DEFAULT_TAP_ID:
+            status_snapshot.update("dispenser", status)
+        self.gpio.publish_status()
+        
+        if notify:
+            self._emit_event("status", status)
+    
     def cancel(self) -> bool:
         """Request cancellation of current dispense"""
         with self._lock:
             if self.status == DispenseStatus.DISPENSING:
                 self._cancel_requested = True
+                self._wake.set()
                 return True
             return False
     
@@ -137,7 +428,7 @@ class Dispenser:
         """
         # Check if already dispensing
         with self._lock:
-            if self.status == DispenseStatus.DISPENSING:
+            if self.is_busy:
                 return DispenseResult(
                     success=False,
                     status=DispenseStatus.ERROR,
@@ -146,42 +437,82 @@ class Dispenser:
                     volume_dispensed_ml=0,
                     duration_seconds=0,
                     pulse_count=0,
-                    error_message="Another dispense operation in progress"
+                    error_message="Another dispense operation in progress",
+                    tap_id=self.tap_id,
+                    token_unused=True
                 )
             
             self.status = DispenseStatus.VALIDATING
             self.current_payload = payload
             self._cancel_requested = False
         
-        started_at = datetime.utcnow()
+        # Persistent single-use claim, before anything can reach the pump
+        if not self._claim_token(payload):
+            with self._lock:
+                self.status = DispenseStatus.IDLE
+                self.current_payload = None
+            self.publish_status()
+            return DispenseResult(
+                success=False,
+                status=DispenseStatus.ERROR,
+                sale_id=payload.sale_id,
+                volume_authorized_ml=payload.volume_ml,
+                volume_dispensed_ml=0,
+                duration_seconds=0,
+                pulse_count=0,
+                error_message="Token already used",
+                tap_id=self.tap_id
+            )
+        
+        self.publish_status()
+        
+        started_at = datetime.utcfromtimestamp(self.clock.time())
         error_message = None
         final_status = DispenseStatus.COMPLETED
+        cutoff_reason = "target"
+        pump_started = False
+        
+        # Reset counters - CRUCIAL para não acumular pulsos entre dispensas
+        self.gpio.reset_pulse_count()
+        self.gpio.refresh_calibration()
+        # Base-coefficient target, for the lead table (the cutoff applies the flow band)
+        target_pulses = max(1, math.ceil(payload.volume_ml * self.gpio.current_pulses_per_liter() / 1000))
         
         try:
             # Initialize GPIO
-            gpio_controller.initialize()
+            self.gpio.initialize()
             
-            # Reset counters - CRUCIAL para não acumular de dispensas anteriores
-            print(f"🔄 Resetting GPIO counters (pulse_count before: {gpio_controller.get_pulse_count()})")
-            gpio_controller.reset_pulse_count()
-            print(f"🔄 Reset complete (pulse_count after: {gpio_controller.get_pulse_count()})")
+            # Arm the interrupt cutoff before the first pulse can arrive
+            if self.gpio.pulse_driven:
+                self._wake.clear()
+                self.gpio.arm_cutoff(payload.volume_ml, self._wake.set,
+                                     leads=self.overshoot.lead_table(self.tap_id, target_pulses))
+                if telemetry_store.enabled:
+                    self.gpio.start_trace()
             
             # Start pump
             with self._lock:
                 self.status = DispenseStatus.DISPENSING
             
-            if not gpio_controller.pump_on():
+            # Hard deadline on the watchdog thread, in case this loop gets stuck
+            self._watchdog = self.watchdog.arm(self.gpio, self._watchdog_timeout(payload.volume_ml),
+                                               sale_id=payload.sale_id, on_fire=self._on_watchdog)
+            
+            if not self.gpio.pump_on():
                 raise Exception("Failed to start pump")
+            pump_started = True
             
-            print(f"🍺 Dispensing {payload.volume_ml}ml for sale {payload.sale_id}")
+            self.publish_status()
+            
+            print(f"🍺 Dispensing {payload.volume_ml}ml for sale {payload.sale_id} on tap {self.tap_id}")
             
             # Em modo MOCK, simular dispensa rápida (sem depender de GPIO real)
-            if MOCK_GPIO:
+            if not self.gpio.pulse_driven:
                 print(f"📌 MOCK MODE: Simulating dispensing for {payload.volume_ml}ml...")
                 # Resetar dados simulados
                 with self._lock:
                     self._mock_volume_ml = 0.0
-                    self._mock_start_time = time.time()
+                    self._mock_start_time = self.clock.monotonic()
                     self._mock_target_ml = payload.volume_ml
                 
                 # Simular tempo de dispensa: 20ml/s (mais lento para polling conseguir ler o progresso)
@@ -194,13 +525,20 @@ class Dispenser:
 
                 last_percent_printed = -1
                 for ml in range(1, total_ml + 1):
+                    if self._watchdog.fired:
+                        final_status = DispenseStatus.INTERRUPTED
+                        error_message = f"Watchdog stopped the pump after {self._watchdog.timeout_s:.0f}s"
+                        cutoff_reason = "watchdog"
+                        break
+                    
                     if self._cancel_requested:
                         print("⚠️ Dispense cancelled by user")
                         final_status = DispenseStatus.INTERRUPTED
                         error_message = "Cancelled by user"
+                        cutoff_reason = "cancelled"
                         break
 
-                    time.sleep(step_duration)
+                    self.clock.sleep(step_duration)
 
                     # Atualizar progresso simulado (sem mexer no GPIO)
                     simulated_ml = float(ml)
@@ -209,8 +547,7 @@ class Dispenser:
                     with self._lock:
                         self._mock_volume_ml = simulated_ml
 
-                    if self._progress_callback:
-                        self._progress_callback(simulated_ml, percent)
+                    self._report_progress(simulated_ml, percent, 20.0)
 
                     # Logar apenas quando o percentual inteiro aumenta para evitar spam
                     percent_int = int(percent)
@@ -221,34 +558,43 @@ class Dispenser:
                 if final_status == DispenseStatus.COMPLETED:
                     print(f"✅ Mock dispensing complete: {payload.volume_ml}ml")
             else:
-                # Hardware real: Dispensing loop com monitoramento de pulsos
+                # Hardware real: the interrupt switches the pump off on the
+                # target pulse; this supervisory loop only reports progress
+                # and checks cancel, timeout and flow
                 target_ml = payload.volume_ml
-                last_flow_time = time.time()
-                last_pulse_count = 0
-                dispense_start = time.time()
+                dispense_start = self.clock.monotonic()
+                self._low_flow_since = None
                 
                 while True:
-                    time.sleep(self.flow_check_interval)
+                    self.clock.wait(self._wake, self.flow_check_interval)
                     
-                    reading = gpio_controller.get_flow_reading()
+                    reading = self.gpio.get_flow_reading()
                     current_ml = reading.volume_ml
-                    elapsed = time.time() - dispense_start
+                    now = self.clock.monotonic()
+                    elapsed = now - dispense_start
                     
-                    # Progress callback
-                    if self._progress_callback:
-                        percent = min(100, (current_ml / target_ml) * 100)
-                        self._progress_callback(current_ml, percent)
+                    # Progress callback and stream subscribers
+                    percent = min(100, (current_ml / target_ml) * 100)
+                    self._report_progress(current_ml, percent, reading.window_flow_ml_s)
                     
-                    # Check if target reached
-                    if current_ml >= target_ml:
+                    # Check if the interrupt cut the pump off at the target
+                    if self.gpio.get_cutoff_state().fired:
                         print(f"✅ Target volume reached: {current_ml:.1f}ml")
                         break
                     
+                    # Check if the watchdog had to switch the pump off
+                    if self._watchdog.fired:
+                        final_status = DispenseStatus.INTERRUPTED
+                        error_message = f"Watchdog stopped the pump after {self._watchdog.timeout_s:.0f}s"
+                        cutoff_reason = "watchdog"
+                        break
+                    
                     # Check for cancellation
                     if self._cancel_requested:
                         print("⚠️ Dispense cancelled by user")
                         final_status = DispenseStatus.INTERRUPTED
                         error_message = "Cancelled by user"
+                        cutoff_reason = "cancelled"
                         break
                     
                     # Check timeout
@@ -256,49 +602,61 @@ class Dispenser:
                         print(f"⚠️ Safety timeout after {elapsed:.1f}s")
                         final_status = DispenseStatus.INTERRUPTED
                         error_message = f"Safety timeout ({self.max_dispense_time}s)"
+                        cutoff_reason = "timeout"
                         break
                     
-                    # Check flow rate (empty keg detection)
-                    if reading.pulse_count > last_pulse_count:
-                        last_flow_time = time.time()
-                        last_pulse_count = reading.pulse_count
-                    elif time.time() - last_flow_time > self.empty_keg_timeout:
-                        # No flow for too long
-                        print(f"⚠️ No flow detected - possible empty keg")
+                    # Check flow rate (empty keg, foaming)
+                    flow_fault = self._check_flow(now, elapsed)
+                    if flow_fault:
+                        print(f"⚠️ {flow_fault}")
                         final_status = DispenseStatus.INTERRUPTED
-                        error_message = "No flow detected - check keg"
+                        error_message = flow_fault
+                        cutoff_reason = "no_flow" if flow_fault.startswith("No flow") else "low_flow"
                         break
             
         except Exception as e:
             final_status = DispenseStatus.ERROR
             error_message = str(e)
+            cutoff_reason = "error"
             print(f"❌ Dispense error: {e}")
         
         finally:
-            # Always stop pump
-            gpio_controller.pump_off()
+            # Always stop pump (a no-op on the pin if the interrupt already did)
+            self.gpio.disarm_cutoff()
+            self.gpio.pump_off()
+            self.watchdog.disarm(self._watchdog)
+        
+        metrics = None
+        trace = None
+        learned = None
+        if self.gpio.pulse_driven:
+            # Count the pulses that still arrive after pump off
+            self._wait_for_settle()
+            metrics = self._build_metrics(payload, cutoff_reason)
+            trace = self.gpio.take_trace()
+            learned = self._learn_overshoot(cutoff_reason)
         
         # Get final reading
-        finished_at = datetime.utcnow()
+        finished_at = datetime.utcfromtimestamp(self.clock.time())
         
         # Em modo MOCK, usar dados simulados em vez de GPIO
-        if MOCK_GPIO:
+        if not self.gpio.pulse_driven:
             # Simular leitura final baseada nos dados simulados
             final_volume_ml = self._mock_volume_ml if final_status == DispenseStatus.COMPLETED else self._mock_volume_ml
-            final_duration = time.time() - self._mock_start_time if self._mock_start_time else 0
+            final_duration = self.clock.monotonic() - self._mock_start_time if self._mock_start_time else 0
             final_pulse_count = int(final_volume_ml * (400 / 1000))  # Simular pulsos equivalentes
             final_flow_rate = final_volume_ml / final_duration if final_duration > 0 else 0
         else:
             # Hardware real
-            final_reading = gpio_controller.get_flow_reading()
+            final_reading = self.gpio.get_flow_reading()
             final_volume_ml = final_reading.volume_ml
             final_duration = final_reading.duration_seconds
             final_pulse_count = final_reading.pulse_count
             final_flow_rate = final_reading.flow_rate_ml_s
         
-        # Save to local database
+        # Hand the record to the write-behind writer (commits off this thread)
         try:
-            record = database.save_consumption(
+            record = database.build_consumption(
                 sale_id=payload.sale_id,
                 token_id=payload.token_raw,  # Token HMAC usado na autorização
                 beverage_id=payload.beverage_id,
@@ -312,33 +670,22 @@ class Dispenser:
                 status=final_status.value,
                 error_message=error_message
             )
-            print(f"💾 Saved consumption record: {record.id}")
+            # The pour's side rows commit in the same transaction as its record
+            side_writes = []
+            if metrics:
+                metrics["consumption_id"] = record.id
+                side_writes.append(partial(self.metrics_sink, metrics))
+            if trace is not None:
+                side_writes.append(partial(self.trace_sink, record.id, self.tap_id, trace))
+            if learned is not None:
+                side_writes.append(partial(self.overshoot.save, learned))
+            future = self.writer.submit(record, side_writes)
+            future.add_done_callback(self._on_consumption_saved)
+            print(f"💾 Queued consumption record: {record.id}")
         except Exception as e:
-            print(f"❌ Failed to save consumption: {e}")
+            print(f"❌ Failed to queue consumption: {e}")
             record = None
         
-        # Update status to COMPLETED (not IDLE yet)
-        # This allows polling to detect the completion
-        with self._lock:
-            self.status = final_status  # Keep COMPLETED/INTERRUPTED/ERROR status
-            self.current_payload = None
-            # Reset mock timestamp para não retornar dados antigos ao polling
-            self._mock_start_time = None
-            self._mock_volume_ml = 0.0
-        
-        # Resetar pulse_count IMEDIATAMENTE para não acumular na próxima dispensa
-        print(f"🔄 Resetting GPIO counters after dispense (pulse_count before: {gpio_controller.get_pulse_count()})")
-        gpio_controller.reset_pulse_count()
-        print(f"🔄 Reset complete (pulse_count after: {gpio_controller.get_pulse_count()})")
-        
-        print(f"📊 Dispense complete: {final_volume_ml:.1f}ml in {(datetime.utcnow() - started_at).total_seconds():.1f}s, status={final_status.value}")
-        
-        # Wait 3 seconds for polling to detect completion, then reset to IDLE
-        time.sleep(3)
-        with self._lock:
-            self.status = DispenseStatus.IDLE
-            self._mock_start_time = None
-            self._mock_volume_ml = 0.0
         success = final_status == DispenseStatus.COMPLETED
         
         result = DispenseResult(
@@ -350,16 +697,198 @@ class Dispenser:
             duration_seconds=(finished_at - started_at).total_seconds(),
             pulse_count=final_pulse_count,
             error_message=error_message,
-            consumption_record=record
+            consumption_record=record,
+            tap_id=self.tap_id,
+            token_unused=not pump_started
         )
         
-        print(f"📊 Dispense complete: {result.volume_dispensed_ml:.1f}ml in {result.duration_seconds:.1f}s")
+        # Keep the outcome for pollers and free the tap right away
+        completion = self.completions.record(result)
+        with self._lock:
+            self.status = DispenseStatus.IDLE
+            self.current_payload = None
+            self._last_completion = completion
+            # Reset mock timestamp para não retornar dados antigos ao polling
+            self._mock_start_time = None
+            self._mock_volume_ml = 0.0
+        
+        # Terminal event for stream subscribers (carries the final volume),
+        # sent before the status event that shows the tap idle again
+        self._emit_event("result", completion.to_dict())
+        self.publish_status()
+        
+        print(f"📊 Dispense complete: {final_volume_ml:.1f}ml in {result.duration_seconds:.1f}s, status={final_status.value}")
         
         return result
 
+    
+    def _claim_token(self, payload: TokenPayload) -> bool:
+        """
+        Write the token nonce to used_tokens as the pour starts
+        
+        The INSERT OR IGNORE is the authoritative single-use check (the
+        validator only screens with memory and the Bloom filter). False
+        means the nonce was already claimed, e.g. before a restart.
+        """
+        if not (config.security.SINGLE_USE_TOKENS and config.security.PERSIST_USED_TOKENS):
+            return True
+        
+        try:
+            return self.token_claim(payload.nonce, config.security.USED_TOKENS_TTL)
+        except sqlite3.Error as e:
+            print(f"⚠️ Used-token store unavailable, single-use enforced in memory only: {e}")
+            return True
+    
+    def _check_flow(self, now: float, elapsed: float) -> Optional[str]:
+        """
+        Error message if the flow stopped or fell below MIN_FLOW_RATE
+        
+        Before the first pulse the empty_keg_timeout applies (line
+        priming). After that a stall is declared once no pulse arrived
+        for STALL_INTERVALS mean intervals, and a low rate once the
+        rolling rate stays under MIN_FLOW_RATE for LOW_FLOW_GRACE seconds.
+        """
+        stats = self.gpio.get_flow_stats()
+        
+        if stats.pulses == 0:
+            return "No flow detected - check keg" if elapsed > self.empty_keg_timeout else None
+        
+        stall_limit = self.empty_keg_timeout
+        if stats.interval_mean_s:
+            stall_limit = min(stall_limit, max(self.min_stall_time, self.stall_intervals * stats.interval_mean_s))
+        if stats.seconds_since_pulse > stall_limit:
+            return "No flow detected - check keg"
+        
+        if stats.pulses >= self.low_flow_min_pulses and stats.current_flow_ml_s < self.min_flow_rate:
+            if self._low_flow_since is None:
+                self._low_flow_since = now
+            elif now - self._low_flow_since >= self.low_flow_grace:
+                print(f"⚠️ Flow at {stats.current_flow_ml_s:.1f}ml/s for {now - self._low_flow_since:.1f}s")
+                return "Low flow detected - check keg"
+        else:
+            self._low_flow_since = None
+        return None
+    
+    def _watchdog_timeout(self, volume_ml: float) -> float:
+        """Longest pour the supervisor allows (priming + volume at MIN_FLOW_RATE), plus grace"""
+        longest = self.empty_keg_timeout + volume_ml / self.min_flow_rate
+        return min(self.max_dispense_time, longest) + self.watchdog_grace
+    
+    def _on_watchdog(self, event: Dict[str, Any]):
+        """Watchdog callback - the pump is already off; tell subscribers and wake the loop"""
+        self._emit_event("watchdog", event)
+        self._wake.set()
+    
+    def _wait_for_settle(self):
+        """Wait until no pulse arrived for settle_quiet_time (at most settle_timeout)"""
+        deadline = self.clock.monotonic() + self.settle_timeout
+        while True:
+            now = self.clock.monotonic()
+            last_pulse_at = self.gpio.get_cutoff_state().last_pulse_at
+            if last_pulse_at is None or now - last_pulse_at >= self.settle_quiet_time or now >= deadline:
+                return
+            self.clock.sleep(min(self.settle_quiet_time, deadline - now))
+    
+    def _build_metrics(self, payload: TokenPayload, cutoff_reason: str) -> Dict[str, Any]:
+        """
+        Overshoot of the pour that just ended (pulses after the cutoff)
+        
+        Target and ml per pulse use the pour's band coefficient, like the
+        volume reading does.
+        """
+        cutoff = self.gpio.get_cutoff_state()
+        final_pulses = self.gpio.get_pulse_count()
+        cutoff_pulses = cutoff.cutoff_pulses if cutoff.fired else None
+        pulses_per_liter = self.gpio.current_pulses_per_liter()
+        if cutoff.fired:
+            target_pulses = cutoff.target_pulses
+        else:
+            target_pulses = max(1, math.ceil(payload.volume_ml * pulses_per_liter / 1000))
+        ml_per_pulse = 1000 / pulses_per_liter
+        
+        metrics = {
+            "tap_id": self.tap_id,
+            "cutoff_reason": cutoff_reason,
+            "target_ml": payload.volume_ml,
+            "target_pulses": target_pulses,
+            "cutoff_pulses": cutoff_pulses,
+            "final_pulses": final_pulses,
+            "overshoot_ml": (final_pulses - target_pulses) * ml_per_pulse,
+            "trailing_ml": (final_pulses - cutoff_pulses) * ml_per_pulse if cutoff_pulses is not None else None,
+            "cutoff_latency_ms": cutoff.cutoff_latency_s * 1000 if cutoff.cutoff_latency_s is not None else None,
+            "settle_ms": (cutoff.last_pulse_at - cutoff.cutoff_at) * 1000
+                         if cutoff.fired and cutoff.last_pulse_at and cutoff.last_pulse_at > cutoff.cutoff_at else 0.0
+        }
+        if cutoff.fired:
+            print(f"📏 Cutoff on pulse {cutoff_pulses}/{target_pulses} (lead {cutoff.lead_pulses}), "
+                  f"overshoot {metrics['overshoot_ml']:.1f}ml")
+        return metrics
+    
+    def _learn_overshoot(self, cutoff_reason: str) -> Optional[OverrunEstimate]:
+        """Update the overrun estimate from a pour cut off at its target"""
+        cutoff = self.gpio.get_cutoff_state()
+        if cutoff_reason != "target" or not cutoff.fired or cutoff.cutoff_flow_ml_s is None:
+            return None
+        trailing = self.gpio.get_pulse_count() - cutoff.cutoff_pulses
+        return self.overshoot.observe(self.tap_id, cutoff.cutoff_flow_ml_s, trailing)
+    
+    @staticmethod
+    def _on_consumption_saved(future):
+        """Writer callback - runs on the writer thread after commit"""
+        error = future.exception()
+        if error is not None:
+            print(f"❌ Failed to save consumption: {error}")
+        else:
+            print(f"💾 Saved consumption record: {future.result().id}")
+
+
+
+class DispenserRegistry:
+    """
+    One Dispenser per tap in config.TAPS, sharing a single event bus
+    and completion log
+    
+    Taps are independent: a pour on one tap never blocks another.
+    """
+    
+    def __init__(self):
+        self.events = DispenseEventBus()
+        self.completions = CompletionLog()
+        self._dispensers: Dict[int, Dispenser] = {
+            tap_id: Dispenser(tap_id, gpio, self.events, completions=self.completions)
+            for tap_id, gpio in gpio_controllers.items()
+        }
+    
+    def get(self, tap_id: Optional[int] = None) -> Optional[Dispenser]:
+        """Dispenser of tap_id (default tap when None), or None if unknown"""
+        if tap_id is None:
+            tap_id = config.DEFAULT_TAP_ID
+        return self._dispensers.get(int(tap_id))
+    
+    def all(self) -> List[Dispenser]:
+        return list(self._dispensers.values())
+    
+    def initialize(self):
+        """Initialize the GPIO of every tap, load the learned overshoot model and publish the watchdog"""
+        overshoot_model.load()
+        pump_watchdog.publish_status()
+        for dispenser in self._dispensers.values():
+            dispenser.gpio.initialize()
+            dispenser.publish_status()
+    
+    def cleanup(self):
+        """Stop pours and release the GPIO of every tap"""
+        for dispenser in self._dispensers.values():
+            dispenser.cancel()
+            dispenser.gpio.cleanup()
+    
+    def get_status(self) -> Dict[str, Any]:
+        """Status of every tap, keyed by tap_id"""
+        return {str(tap_id): d.get_status() for tap_id, d in self._dispensers.items()}
+
 
-# Global dispenser instance
-dispenser = Dispenser()
+# Global dispenser registry (one dispenser per tap)
+dispensers = DispenserRegistry()
 
 
 # Testing
@@ -385,6 +914,7 @@ if __name__ == "__main__":
         exit(1)
     
     print("\n--- Testing Dispenser ---")
+    dispenser = dispensers.get(payload.tap_id)
     print(f"Authorized: {payload.volume_ml}ml")
     
     # Set progress callback
@@ -403,4 +933,4 @@ if __name__ == "__main__":
     print(f"\nDatabase stats: {stats}")
     
     # Cleanup
-    gpio_controller.cleanup()
+    dispensers.cleanup()
@@ -0,0 +1,109 @@
+"""
+Flow Estimator for EDGE Server
+Rolling flow-rate statistics from flow-sensor pulse timestamps
+
+Pulse times go into a preallocated array('d') ring buffer of the last
+`window` pulses. The interval sum comes straight from the oldest and
+newest timestamps, and the sum of squared intervals is kept as a running
+total, so every statistic is O(1) per pulse and per read. The running
+total is recomputed from the buffer each time the ring wraps, so float
+drift cannot build up.
+"""
+from array import array
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class FlowStats:
+    """Flow statistics at a given time (rates in ml/s, times in seconds)"""
+    pulses: int                          # pulses seen since reset
+    instant_flow_ml_s: float             # from the last inter-pulse interval
+    window_flow_ml_s: float              # over the last `window` pulses
+    current_flow_ml_s: float             # window rate, decayed while no pulses arrive
+    interval_mean_s: Optional[float]
+    interval_variance_s2: Optional[float]
+    seconds_since_pulse: Optional[float]
+
+
+class FlowEstimator:
+    """
+    Ring buffer of pulse timestamps with O(1) flow statistics
+    
+    Not thread-safe; GPIOController calls it under its own lock.
+    """
+    
+    def __init__(self, ml_per_pulse: float, window: int = 16):
+        self.ml_per_pulse = ml_per_pulse
+        self.window = max(2, window)
+        self._times = array('d', bytes(8 * self.window))
+        self._intervals = array('d', bytes(8 * self.window))
+        self.reset()
+    
+    def reset(self):
+        self._count = 0        # pulses since reset
+        self._head = 0         # next slot to write
+        self._sum_sq = 0.0     # sum of squared intervals in the window
+    
+    def add_pulse(self, timestamp: float):
+        """Record one pulse (timestamps must be non-decreasing)"""
+        window = self.window
+        head = self._head
+        
+        if self._count:
+            interval = timestamp - self._times[(head - 1) % window]
+            # Overwriting the oldest timestamp invalidates the interval that started at it
+            if self._count >= window:
+                self._sum_sq -= self._intervals[(head + 1) % window] ** 2
+            self._intervals[head] = interval
+            self._sum_sq += interval * interval
+        
+        self._times[head] = timestamp
+        self._count += 1
+        self._head = (head + 1) % window
+        
+        if self._head == 0:
+            self._recompute_sum_sq()
+    
+    def _recompute_sum_sq(self):
+        n = self._interval_count()
+        if n == 0:
+            self._sum_sq = 0.0
+            return
+        # Valid intervals are the n slots before head
+        self._sum_sq = sum(self._intervals[(self._head - 1 - i) % self.window] ** 2 for i in range(n))
+    
+    def _interval_count(self) -> int:
+        return min(self._count, self.window) - 1 if self._count else 0
+    
+    def stats(self, now: float) -> FlowStats:
+        """Statistics as of `now` (same clock as the pulse timestamps)"""
+        n = self._interval_count()
+        if self._count == 0:
+            return FlowStats(0, 0.0, 0.0, 0.0, None, None, None)
+        
+        newest = self._times[(self._head - 1) % self.window]
+        since_pulse = max(0.0, now - newest)
+        if n == 0:
+            return FlowStats(self._count, 0.0, 0.0, 0.0, None, None, since_pulse)
+        
+        oldest = self._times[(self._head - 1 - n) % self.window]
+        span = newest - oldest
+        mean = span / n
+        variance = max(0.0, self._sum_sq / n - mean * mean)
+        last_interval = self._intervals[(self._head - 1) % self.window]
+        
+        instant = self.ml_per_pulse / last_interval if last_interval > 0 else 0.0
+        windowed = n * self.ml_per_pulse / span if span > 0 else 0.0
+        # While the next pulse is overdue, the rate can be at most one pulse per elapsed time
+        current = min(windowed, self.ml_per_pulse / since_pulse) if since_pulse > mean else windowed
+        
+        return FlowStats(
+            pulses=self._count,
+            instant_flow_ml_s=instant,
+            window_flow_ml_s=windowed,
+            current_flow_ml_s=current,
+            interval_mean_s=mean,
+            interval_variance_s2=variance,
+            seconds_since_pulse=since_pulse
+        )
@@ -4,15 +4,27 @@ Handles pump control and flow sensor reading
 
 On Raspberry Pi: Uses RPi.GPIO
 On other systems: Uses mock GPIO for development
+With a flow simulator attached (simulator.py): pulses come from the
+simulator on the controller's clock instead of real or mock hardware
+
+Volume cutoff is pulse-driven: the dispenser arms a target pulse count
+and the flow-sensor interrupt switches the pump off on that exact pulse,
+instead of a polling loop noticing it up to one poll interval late.
 """
+import math
 import time
 import threading
+from array import array
 from datetime import datetime
-from typing import Optional, Callable
+from typing import Optional, Callable, Dict, List, Tuple
 from dataclasses import dataclass
 from enum import Enum
 
 from config import config
+from clock import Clock, system_clock
+from flow_estimator import FlowEstimator, FlowStats
+from calibration import calibration_store, TapCalibration
+from status_snapshot import status_snapshot
 
 
 # Try to import RPi.GPIO, use mock if not available
@@ -25,24 +37,59 @@ except ImportError:
     print("⚠️ RPi.GPIO not found - using mock GPIO")
 
 
+# GPIO.setmode() is board-wide; the first tap to initialize sets it
+_gpio_mode_lock = threading.Lock()
+_gpio_mode_set = False
+
+
+def _ensure_gpio_mode():
+    global _gpio_mode_set
+    with _gpio_mode_lock:
+        if not _gpio_mode_set:
+            GPIO.setmode(GPIO.BCM)
+            GPIO.setwarnings(False)
+            _gpio_mode_set = True
+
+
 @dataclass
 class FlowReading:
     """Flow sensor reading data"""
     pulse_count: int
     volume_ml: float
     duration_seconds: float
-    flow_rate_ml_s: float
+    flow_rate_ml_s: float  # average since the pour started
     timestamp: datetime
+    window_flow_ml_s: float = 0.0  # recent flow (see FlowStats.current_flow_ml_s)
+    seconds_since_pulse: Optional[float] = None
+
+
+@dataclass
+class CutoffState:
+    """Pulse cutoff of the current pour (times from the controller's clock)"""
+    target_pulses: Optional[int]       # once fired, the target it fired against
+    fired: bool
+    cutoff_pulses: Optional[int]       # pulse count when the pump was switched off
+    cutoff_latency_s: Optional[float]  # target pulse -> pump off
+    cutoff_at: Optional[float]
+    last_pulse_at: Optional[float]
+    cutoff_flow_ml_s: Optional[float] = None  # window flow when the pump was switched off
+    lead_pulses: int = 0                      # how many pulses before the target it fired
 
 
 class GPIOController:
     """
-    Controls GPIO for pump and flow sensor
+    Controls GPIO for one tap's pump and flow sensor
     
-    On non-Pi systems, simulates GPIO behavior for testing
+    Each tap has its own controller (pins, pulse counter, lock), so taps
+    pour independently. On non-Pi systems, simulates GPIO behavior for testing
     """
     
-    def __init__(self):
+    def __init__(self, tap_id: int = 1, pump_pin: Optional[int] = None,
+                 flow_sensor_pin: Optional[int] = None,
+                 pulses_per_liter: Optional[float] = None,
+                 clock: Optional[Clock] = None):
+        self.tap_id = tap_id
+        self.clock = clock or system_clock
         self._initialized = False
         self._pump_on = False
         self._pulse_count = 0
@@ -52,15 +99,58 @@ class GPIOController:
         # Callback for flow pulses
         self._pulse_callback: Optional[Callable[[int], None]] = None
         
+        # Pulse cutoff (armed per pour by the dispenser)
+        self._cutoff_target: Optional[int] = None
+        self._cutoff_volume_ml: Optional[float] = None  # set when the target follows the flow band
+        self._cutoff_callback: Optional[Callable[[], None]] = None
+        self._cutoff_pulses: Optional[int] = None
+        self._cutoff_latency: Optional[float] = None
+        self._cutoff_at: Optional[float] = None
+        self._last_pulse_at: Optional[float] = None
+        self._cutoff_leads: List[Tuple[Optional[float], int]] = []
+        self._cutoff_check_from: Optional[int] = None
+        self._cutoff_fired_target: Optional[int] = None
+        self._cutoff_flow: Optional[float] = None
+        self._cutoff_lead = 0
+        
         # Mock settings for development
         self._mock_flow_rate = 100.0  # ml/s simulated flow rate
         self._mock_thread: Optional[threading.Thread] = None
         self._mock_running = False
         
-        # GPIO pins from config
-        self.pump_pin = config.gpio.PUMP_PIN
-        self.flow_sensor_pin = config.gpio.FLOW_SENSOR_PIN
-        self.pulses_per_liter = config.gpio.PULSES_PER_LITER
+        # Simulated flow sensor (replaces hardware and the mock thread)
+        self.flow_simulator = None
+        
+        # GPIO pins (defaults from config.gpio)
+        self.pump_pin = pump_pin if pump_pin is not None else config.gpio.PUMP_PIN
+        self.flow_sensor_pin = flow_sensor_pin if flow_sensor_pin is not None else config.gpio.FLOW_SENSOR_PIN
+        self.pulses_per_liter = pulses_per_liter or config.gpio.PULSES_PER_LITER
+        
+        # Fitted calibration (calibration.py) overrides pulses_per_liter between pours
+        self.nominal_pulses_per_liter = self.pulses_per_liter
+        self.calibrations = calibration_store
+        self.calibration: Optional[TapCalibration] = None
+        
+        # Pulse-timestamp ring buffer for rolling flow statistics
+        self.flow = FlowEstimator(1000 / self.pulses_per_liter, window=config.gpio.FLOW_WINDOW_PULSES)
+        
+        # Per-pour pulse trace: inter-arrival times in microseconds
+        self._trace: Optional[array] = None
+        self._trace_last: Optional[float] = None
+        self.trace_max_pulses = config.telemetry.MAX_PULSES_PER_TRACE
+    
+    @property
+    def _uses_hardware(self) -> bool:
+        return not MOCK_GPIO and self.flow_simulator is None
+    
+    @property
+    def pulse_driven(self) -> bool:
+        """True when pulses come from a real or simulated flow sensor"""
+        return not MOCK_GPIO or self.flow_simulator is not None
+    
+    def attach_simulator(self, simulator):
+        """Drive this controller from a simulated flow sensor (see simulator.py)"""
+        self.flow_simulator = simulator
     
     def initialize(self) -> bool:
         """Initialize GPIO pins"""
@@ -68,10 +158,9 @@ class GPIOController:
             return True
         
         try:
-            if not MOCK_GPIO:
+            if self._uses_hardware:
                 # Real GPIO setup
-                GPIO.setmode(GPIO.BCM)
-                GPIO.setwarnings(False)
+                _ensure_gpio_mode()
                 
                 # Pump relay (output, active high)
                 GPIO.setup(self.pump_pin, GPIO.OUT, initial=GPIO.LOW)
@@ -88,7 +177,8 @@ class GPIOController:
                 )
             
             self._initialized = True
-            print(f"✅ GPIO initialized (mock={MOCK_GPIO})")
+            print(f"✅ GPIO initialized for tap {self.tap_id} (mock={MOCK_GPIO})")
+            self.publish_status()
             return True
             
         except Exception as e:
@@ -100,32 +190,190 @@ class GPIOController:
         try:
             self.pump_off()
             
-            if not MOCK_GPIO:
-                GPIO.cleanup()
+            if self._uses_hardware and self._initialized:
+                GPIO.remove_event_detect(self.flow_sensor_pin)
+                GPIO.cleanup([self.pump_pin, self.flow_sensor_pin])
             
             self._initialized = False
-            print("🧹 GPIO cleaned up")
+            print(f"🧹 GPIO cleaned up for tap {self.tap_id}")
+            self.publish_status()
             
         except Exception as e:
             print(f"⚠️ GPIO cleanup warning: {e}")
     
     def _on_flow_pulse(self, channel=None):
         """Callback for flow sensor pulse (interrupt)"""
+        now = self.clock.monotonic()
+        fired = None
+        
         with self._lock:
             self._pulse_count += 1
+            self._last_pulse_at = now
+            self.flow.add_pulse(now)
+            
+            if self._trace is not None and len(self._trace) < self.trace_max_pulses:
+                self._trace.append(min(int((now - self._trace_last) * 1e6 + 0.5), 0xFFFFFFFF))
+                self._trace_last = now
+            
+            # Target (less the learned overrun) reached: switch the pump off right here
+            if self._cutoff_target is not None and self._pulse_count >= self._cutoff_check_from:
+                if self._cutoff_volume_ml is not None:
+                    # Same band coefficient get_flow_reading() will use for this pour
+                    duration = now - self._start_time if self._start_time else 0
+                    self._cutoff_target = self._pulses_for(self._cutoff_volume_ml, duration)
+                flow_ml_s = self.flow.stats(now).window_flow_ml_s
+                lead = self._lead_for(flow_ml_s)
+                if self._pulse_count >= self._cutoff_target - lead:
+                    self._pump_off_locked()
+                    self._cutoff_at = self.clock.monotonic()
+                    self._cutoff_latency = self._cutoff_at - now
+                    self._cutoff_pulses = self._pulse_count
+                    self._cutoff_flow = flow_ml_s
+                    self._cutoff_lead = lead
+                    self._cutoff_fired_target = self._cutoff_target
+                    self._cutoff_target = None
+                    fired = self._cutoff_callback
             
             if self._pulse_callback:
                 self._pulse_callback(self._pulse_count)
+        
+        if fired:
+            fired()
     
     def set_pulse_callback(self, callback: Callable[[int], None]):
         """Set callback for pulse events"""
         self._pulse_callback = callback
     
     def reset_pulse_count(self):
-        """Reset pulse counter and start time"""
+        """Reset pulse counter (the start time is set again on pump on)"""
         with self._lock:
             self._pulse_count = 0
-            self._start_time = time.time()
+            self._start_time = None
+            self._last_pulse_at = None
+            self.flow.reset()
+    
+    def refresh_calibration(self):
+        """Apply a new or removed calibration fit (only while no pour is in progress)"""
+        if self.calibrations is None or self._pump_on or self._pulse_count:
+            return
+        calibration = self.calibrations.get(self.tap_id)
+        if calibration is self.calibration:
+            return
+        
+        with self._lock:
+            if self._pump_on or self._pulse_count:
+                return
+            self.calibration = calibration
+            self.pulses_per_liter = calibration.pulses_per_liter if calibration else self.nominal_pulses_per_liter
+            self.flow.ml_per_pulse = 1000 / self.pulses_per_liter
+        print(f"📐 Tap {self.tap_id} calibration: {self.pulses_per_liter:.2f} pulses/L")
+    
+    def _pulses_per_liter_for(self, duration: float) -> float:
+        """Coefficient for the current pour (flow band by average pulse rate)"""
+        if self.calibration is None or not self.calibration.bands or duration <= 0:
+            return self.pulses_per_liter
+        return self.calibration.pulses_per_liter_at(self._pulse_count / duration)
+    
+    def _pulses_for(self, volume_ml: float, duration: float) -> int:
+        """Pulse count that reads as volume_ml after duration seconds (caller holds self._lock)"""
+        return max(1, math.ceil(volume_ml * self._pulses_per_liter_for(duration) / 1000))
+    
+    def current_pulses_per_liter(self) -> float:
+        """Coefficient get_flow_reading() applies to the current pour"""
+        with self._lock:
+            duration = self.clock.monotonic() - self._start_time if self._start_time else 0
+            return self._pulses_per_liter_for(duration)
+    
+    # ==================== Pulse Trace ====================
+    
+    def start_trace(self):
+        """Start recording pulse inter-arrival times (first delta is from now)"""
+        with self._lock:
+            self._trace = array('I')
+            self._trace_last = self.clock.monotonic()
+    
+    def take_trace(self) -> Optional[array]:
+        """Stop recording and return the trace (uint32 microseconds)"""
+        with self._lock:
+            trace, self._trace = self._trace, None
+            return trace
+    
+    # ==================== Pulse Cutoff ====================
+    
+    def arm_cutoff(self, target_ml: float, on_cutoff: Optional[Callable[[], None]] = None,
+                   leads: Optional[List[Tuple[Optional[float], int]]] = None) -> int:
+        """
+        Switch the pump off from the interrupt once the pulses read as target_ml
+        
+        With flow bands the pulse target is recomputed near the end with
+        the band of the pour's average pulse rate, the same coefficient
+        get_flow_reading() uses. Returns the target for the base
+        coefficient (what the pour aims for before any band applies).
+        
+        on_cutoff runs on the interrupt thread right after the pump is
+        off, so it must be quick (e.g. setting an Event).
+        
+        leads is a flow-band table of (upper ml/s or None, pulses): the
+        pump goes off that many pulses early for the flow at that moment
+        (see overshoot.py). Pulses before the largest lead skip the lookup.
+        """
+        with self._lock:
+            target_pulses = self._pulses_for(target_ml, 0)
+            banded = self.calibration is not None and bool(self.calibration.bands)
+            self._cutoff_target = target_pulses
+            self._cutoff_volume_ml = target_ml if banded else None
+            self._cutoff_fired_target = None
+            self._cutoff_callback = on_cutoff
+            self._cutoff_pulses = None
+            self._cutoff_latency = None
+            self._cutoff_at = None
+            self._cutoff_flow = None
+            self._cutoff_lead = 0
+            self._cutoff_leads = list(leads or [])
+            max_lead = max((lead for _, lead in self._cutoff_leads), default=0)
+            lowest = target_pulses
+            if banded:
+                lowest_ppl = min([self.pulses_per_liter] + [ppl for _, ppl in self.calibration.bands])
+                lowest = max(1, math.ceil(target_ml * lowest_ppl / 1000))
+            self._cutoff_check_from = max(lowest - max_lead, 1)
+        return target_pulses
+    
+    def _lead_for(self, flow_ml_s: float) -> int:
+        for upper, lead in self._cutoff_leads:
+            if upper is None or flow_ml_s < upper:
+                return lead
+        return 0
+    
+    def disarm_cutoff(self):
+        """Cancel a pending cutoff (pour ended some other way)"""
+        with self._lock:
+            self._cutoff_target = None
+            self._cutoff_volume_ml = None
+            self._cutoff_callback = None
+    
+    def get_cutoff_state(self) -> CutoffState:
+        with self._lock:
+            return CutoffState(
+                target_pulses=self._cutoff_target if self._cutoff_pulses is None else self._cutoff_fired_target,
+                fired=self._cutoff_pulses is not None,
+                cutoff_pulses=self._cutoff_pulses,
+                cutoff_latency_s=self._cutoff_latency,
+                cutoff_at=self._cutoff_at,
+                last_pulse_at=self._last_pulse_at,
+                cutoff_flow_ml_s=self._cutoff_flow,
+                lead_pulses=self._cutoff_lead
+            )
+    
+    def _pump_off_locked(self):
+        """Drive the pump output low (caller holds self._lock)"""
+        if self._uses_hardware and self._initialized:
+            GPIO.output(self.pump_pin, GPIO.LOW)
+        elif self.flow_simulator is not None:
+            self.flow_simulator.pump_off()
+        else:
+            # Called from the mock flow thread itself: only signal it to stop
+            self._mock_running = False
+        self._pump_on = False
     
     def pump_on(self) -> bool:
         """Turn on the pump"""
@@ -135,36 +383,52 @@ class GPIOController:
         
         try:
             with self._lock:
-                if not MOCK_GPIO:
+                if self._uses_hardware:
                     GPIO.output(self.pump_pin, GPIO.HIGH)
+                elif self.flow_simulator is not None:
+                    self.flow_simulator.pump_on()
                 else:
                     # Start mock flow simulation
                     self._start_mock_flow()
                 
                 self._pump_on = True
                 if self._start_time is None:
-                    self._start_time = time.time()
+                    self._start_time = self.clock.monotonic()
             
-            print("🍺 Pump ON")
+            print(f"🍺 Pump ON (tap {self.tap_id})")
+            self.publish_status()
             return True
             
         except Exception as e:
             print(f"❌ Pump ON failed: {e}")
             return False
     
-    def pump_off(self) -> bool:
-        """Turn off the pump"""
+    def pump_off(self, quiet: bool = False) -> bool:
+        """
+        Turn off the pump
+        
+        quiet skips the log line (the watchdog must not block on stdout).
+        """
         try:
+            mock_thread = None
             with self._lock:
-                if not MOCK_GPIO and self._initialized:
+                if self._uses_hardware and self._initialized:
                     GPIO.output(self.pump_pin, GPIO.LOW)
+                elif self.flow_simulator is not None:
+                    if self._pump_on:
+                        self.flow_simulator.pump_off()
                 else:
                     # Stop mock flow simulation
-                    self._stop_mock_flow()
+                    mock_thread = self._stop_mock_flow()
                 
                 self._pump_on = False
             
-            print("🛑 Pump OFF")
+            if mock_thread is not None and mock_thread is not threading.current_thread():
+                mock_thread.join(timeout=1)
+            
+            if not quiet:
+                print(f"🛑 Pump OFF (tap {self.tap_id})")
+            self.publish_status()
             return True
             
         except Exception as e:
@@ -182,12 +446,13 @@ class GPIOController:
     
     def get_flow_reading(self) -> FlowReading:
         """Get current flow sensor reading"""
+        self.refresh_calibration()
         with self._lock:
-            now = time.time()
+            now = self.clock.monotonic()
             duration = now - self._start_time if self._start_time else 0
             
             # Calculate volume from pulses
-            volume_ml = (self._pulse_count / self.pulses_per_liter) * 1000
+            volume_ml = (self._pulse_count / self._pulses_per_liter_for(duration)) * 1000
             
             # Calculate flow rate
             if duration > 0:
@@ -195,14 +460,23 @@ class GPIOController:
             else:
                 flow_rate = 0.0
             
+            stats = self.flow.stats(now)
+            
             return FlowReading(
                 pulse_count=self._pulse_count,
                 volume_ml=volume_ml,
                 duration_seconds=duration,
                 flow_rate_ml_s=flow_rate,
-                timestamp=datetime.utcnow()
+                timestamp=datetime.utcnow(),
+                window_flow_ml_s=stats.current_flow_ml_s,
+                seconds_since_pulse=stats.seconds_since_pulse
             )
     
+    def get_flow_stats(self) -> FlowStats:
+        """Rolling flow statistics (instantaneous, windowed, variance, stall time)"""
+        with self._lock:
+            return self.flow.stats(self.clock.monotonic())
+    
     # ==================== Mock Flow Simulation ====================
     
     def _start_mock_flow(self):
@@ -214,12 +488,16 @@ class GPIOController:
         self._mock_thread = threading.Thread(target=self._mock_flow_loop, daemon=True)
         self._mock_thread.start()
     
-    def _stop_mock_flow(self):
-        """Stop mock flow simulation"""
+    def _stop_mock_flow(self) -> Optional[threading.Thread]:
+        """
+        Signal the mock flow thread to stop (caller holds self._lock)
+        
+        Returns the thread so the caller can join it after releasing the
+        lock; the thread takes that lock on every pulse.
+        """
         self._mock_running = False
-        if self._mock_thread:
-            self._mock_thread.join(timeout=1)
-            self._mock_thread = None
+        thread, self._mock_thread = self._mock_thread, None
+        return thread
     
     def _mock_flow_loop(self):
         """Simulates flow sensor pulses"""
@@ -231,7 +509,7 @@ class GPIOController:
         
         while self._mock_running:
             self._on_flow_pulse()
-            time.sleep(interval)
+            self.clock.sleep(interval)
     
     def set_mock_flow_rate(self, ml_per_second: float):
         """Set mock flow rate (for testing)"""
@@ -241,22 +519,45 @@ class GPIOController:
         """Get GPIO status summary"""
         reading = self.get_flow_reading()
         return {
+            "tap_id": self.tap_id,
             "initialized": self._initialized,
             "mock_mode": MOCK_GPIO,
+            "simulated": self.flow_simulator is not None,
             "pump_state": "on" if self._pump_on else "off",
             "pulse_count": reading.pulse_count,
             "volume_ml": round(reading.volume_ml, 1),
-            "flow_rate_ml_s": round(reading.flow_rate_ml_s, 1)
+            "flow_rate_ml_s": round(reading.flow_rate_ml_s, 1),
+            "window_flow_ml_s": round(reading.window_flow_ml_s, 1),
+            "pulses_per_liter": round(self.pulses_per_liter, 2),
+            "calibrated": self.calibration is not None
         }
+    
+    def publish_status(self):
+        """Publish this tap's GPIO state to the status snapshot (gpio.<tap_id>)"""
+        status_snapshot.merge("gpio", **{str(self.tap_id): self.get_status()})
+
+
+def _build_controllers() -> Dict[int, GPIOController]:
+    """One controller per tap in config.TAPS"""
+    return {
+        tap_id: GPIOController(
+            tap_id=tap_id,
+            pump_pin=tap.get("gpio_pump"),
+            flow_sensor_pin=tap.get("gpio_sensor"),
+            pulses_per_liter=tap.get("pulses_per_liter")
+        )
+        for tap_id, tap in config.TAPS.items()
+    }
 
 
-# Global GPIO controller instance
-gpio_controller = GPIOController()
+# Global GPIO controllers, keyed by tap_id
+gpio_controllers = _build_controllers()
 
 
 # Testing
 if __name__ == "__main__":
     print("\n--- Testing GPIO Controller ---")
+    gpio_controller = gpio_controllers[config.DEFAULT_TAP_ID]
     
     # Initialize
     gpio_controller.initialize()
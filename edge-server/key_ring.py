@@ -0,0 +1,119 @@
+"""
+HMAC Key Ring for EDGE Server
+Per-machine token keys synced from the SaaS, selected by key ID (kid)
+
+Each key keeps a prebuilt HMAC-SHA256 context; signing and verifying
+copy that context instead of re-keying, so there is no per-token key
+setup. During a rotation the SaaS publishes the new key before it signs
+with it and keeps the old key valid for an overlap window, so tokens of
+either key validate with no downtime.
+
+Tokens without a kid use the legacy shared secret (config.security.HMAC_SECRET).
+"""
+import hmac
+import hashlib
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Optional, Dict, Any, List
+
+
+class HMACKey:
+    """One key of the ring with its prebuilt MAC context"""
+    
+    def __init__(self, kid: Optional[int], secret: str,
+                 valid_from: Optional[float] = None, valid_until: Optional[float] = None):
+        self.kid = kid
+        self.secret = secret
+        self.valid_from = valid_from    # unix seconds, None = no lower bound
+        self.valid_until = valid_until  # unix seconds, None = no expiry
+        self._context = hmac.new(secret.encode('utf-8'), digestmod=hashlib.sha256)
+    
+    def digest(self, data: bytes) -> bytes:
+        """HMAC-SHA256 of data (copies the keyed context)"""
+        mac = self._context.copy()
+        mac.update(data)
+        return mac.digest()
+    
+    def is_valid_at(self, timestamp: float, tolerance: float = 0) -> bool:
+        """True if a token issued at timestamp may use this key"""
+        if self.valid_from is not None and timestamp < self.valid_from - tolerance:
+            return False
+        if self.valid_until is not None and timestamp > self.valid_until + tolerance:
+            return False
+        return True
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "kid": self.kid,
+            "valid_from": self.valid_from,
+            "valid_until": self.valid_until
+        }
+
+
+def _to_unix(value) -> Optional[float]:
+    """Accept unix seconds or ISO-8601 strings (as returned by the SaaS)"""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)  # SaaS datetimes are naive UTC
+    return parsed.timestamp()
+
+
+class KeyRing:
+    """Thread-safe kid -> HMACKey map plus the legacy key"""
+    
+    def __init__(self, legacy_secret: str):
+        self._lock = Lock()
+        self.legacy = HMACKey(None, legacy_secret)
+        self._keys: Dict[int, HMACKey] = {}
+        self.current_kid: Optional[int] = None
+    
+    def get(self, kid: Optional[int]) -> Optional[HMACKey]:
+        """Key for a token's kid (None -> legacy key)"""
+        if kid is None:
+            return self.legacy
+        return self._keys.get(kid)
+    
+    def signing_key(self) -> HMACKey:
+        """Key used to sign new tokens on the edge (test tokens)"""
+        return self._keys.get(self.current_kid) or self.legacy
+    
+    def load(self, keys: List[Dict[str, Any]], current_kid: Optional[int] = None):
+        """
+        Replace the ring with keys from the SaaS or the local database
+        
+        Contexts of unchanged keys are kept; the swap itself is a single
+        reference assignment, so concurrent validations never see a
+        half-loaded ring.
+        """
+        with self._lock:
+            ring = {}
+            for entry in keys:
+                kid = int(entry["kid"])
+                existing = self._keys.get(kid)
+                valid_from = _to_unix(entry.get("valid_from"))
+                valid_until = _to_unix(entry.get("valid_until"))
+                if existing and existing.secret == entry["secret"]:
+                    existing.valid_from = valid_from
+                    existing.valid_until = valid_until
+                    ring[kid] = existing
+                else:
+                    ring[kid] = HMACKey(kid, entry["secret"], valid_from, valid_until)
+            
+            self._keys = ring
+            self.current_kid = current_kid if current_kid in ring else None
+    
+    def export(self) -> List[Dict[str, Any]]:
+        """Keys as dicts (for persistence)"""
+        return [
+            {"kid": key.kid, "secret": key.secret,
+             "valid_from": key.valid_from, "valid_until": key.valid_until}
+            for key in self._keys.values()
+        ]
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "current_kid": self.current_kid,
+            "keys": [key.to_dict() for key in sorted(self._keys.values(), key=lambda k: k.kid)]
+        }
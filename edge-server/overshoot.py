@@ -0,0 +1,141 @@
+"""
+Overshoot Compensation for EDGE Server
+Learns how far each tap keeps pouring after pump off and stops early by that much
+
+After every pour cut off at its target, the pulses that still arrive
+(valve and pump inertia) update an exponentially weighted estimate for
+the tap and the flow band the pour was in at cutoff. The next pour's
+cutoff fires that many pulses before the target, chosen from the flow
+rate at that moment, so the trailing flow lands on the target.
+
+Estimates are kept in pulses, so a new flow calibration does not
+invalidate them, and persisted in the overshoot_model table.
+"""
+import math
+import bisect
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Tuple
+
+from config import config
+from database import database
+
+
+@dataclass
+class OverrunEstimate:
+    """EWMA of post-cutoff pulses for one tap and flow band"""
+    tap_id: int
+    band: int
+    trailing_pulses: float
+    samples: int
+    updated_at: Optional[str] = None
+
+
+class OvershootModel:
+    """
+    Per tap and flow band overrun estimates
+    
+    Band b holds pours whose flow at cutoff was below BANDS_ML_S[b] (the
+    last band is everything faster). A band compensates once it has
+    MIN_SAMPLES pours; its lead is floor(estimate), so pours end on or
+    just above the target, and never more than MAX_LEAD of it.
+    """
+    
+    def __init__(self, persist: bool = True):
+        self.settings = config.overshoot
+        self.persist = persist
+        self.band_edges: List[float] = sorted(self.settings.BANDS_ML_S)
+        self._estimates: Dict[Tuple[int, int], OverrunEstimate] = {}
+        self._lock = threading.Lock()
+        self._loaded = not persist
+    
+    @property
+    def enabled(self) -> bool:
+        return self.settings.ENABLED
+    
+    def load(self):
+        """Read persisted estimates (at startup, or on the first pour)"""
+        try:
+            rows = database.get_overshoot_estimates()
+        except Exception as e:
+            print(f"⚠️ Failed to load overshoot model: {e}")
+            return
+        with self._lock:
+            for row in rows:
+                if row["band"] <= len(self.band_edges):
+                    self._estimates[(row["tap_id"], row["band"])] = OverrunEstimate(**row)
+            self._loaded = True
+    
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+    
+    def band_for(self, flow_ml_s: float) -> int:
+        return bisect.bisect_right(self.band_edges, flow_ml_s)
+    
+    def lead_table(self, tap_id: int, target_pulses: int) -> List[Tuple[Optional[float], int]]:
+        """
+        (upper flow in ml/s or None, lead pulses) per band, for GPIOController.arm_cutoff
+        
+        Empty when compensation is off or nothing has been learned yet.
+        """
+        if not self.enabled:
+            return []
+        self._ensure_loaded()
+        
+        max_lead = int(target_pulses * self.settings.MAX_LEAD)
+        uppers = self.band_edges + [None]
+        table = []
+        with self._lock:
+            for band, upper in enumerate(uppers):
+                estimate = self._estimates.get((tap_id, band))
+                lead = 0
+                if estimate and estimate.samples >= self.settings.MIN_SAMPLES:
+                    lead = min(max(math.floor(estimate.trailing_pulses), 0), max_lead)
+                table.append((upper, lead))
+        return table if any(lead for _, lead in table) else []
+    
+    def observe(self, tap_id: int, flow_ml_s: float, trailing_pulses: int) -> OverrunEstimate:
+        """Fold one pour's post-cutoff pulses into its band's estimate"""
+        self._ensure_loaded()
+        band = self.band_for(flow_ml_s)
+        alpha = self.settings.ALPHA
+        
+        with self._lock:
+            estimate = self._estimates.get((tap_id, band))
+            if estimate is None:
+                estimate = OverrunEstimate(tap_id, band, float(trailing_pulses), 0)
+                self._estimates[(tap_id, band)] = estimate
+            else:
+                estimate.trailing_pulses += alpha * (trailing_pulses - estimate.trailing_pulses)
+            estimate.samples += 1
+            estimate.updated_at = datetime.utcnow().isoformat()
+            return OverrunEstimate(**vars(estimate))
+    
+    def save(self, estimate: OverrunEstimate):
+        if self.persist:
+            database.save_overshoot_estimate(estimate.tap_id, estimate.band, estimate.trailing_pulses,
+                                             estimate.samples, estimate.updated_at)
+    
+    def get_status(self, tap_id: int, pulses_per_liter: float) -> Dict[str, Any]:
+        """Learned overrun of a tap for /edge/status"""
+        ml_per_pulse = 1000 / pulses_per_liter
+        uppers = self.band_edges + [None]
+        bands = []
+        with self._lock:
+            for band, upper in enumerate(uppers):
+                estimate = self._estimates.get((tap_id, band))
+                if estimate is None:
+                    continue
+                bands.append({
+                    "max_flow_ml_s": upper,
+                    "trailing_pulses": round(estimate.trailing_pulses, 2),
+                    "trailing_ml": round(estimate.trailing_pulses * ml_per_pulse, 1),
+                    "samples": estimate.samples
+                })
+        return {"enabled": self.enabled, "alpha": self.settings.ALPHA, "bands": bands}
+
+
+# Global overshoot model (shared by every tap)
+overshoot_model = OvershootModel()
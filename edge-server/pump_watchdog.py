@@ -0,0 +1,156 @@
+"""
+Pump Watchdog for EDGE Server
+Hard per-pour deadline that switches the pump off independently of the dispense loop
+
+The dispense loop checks its own timeout, but only while it is running:
+a slow database write, a blocked print to a full stdout pipe or an
+exception path can keep it from ever getting there. Each pour therefore
+also arms a deadline here. One watchdog thread (on time.monotonic, not
+the dispenser's clock) forces the pump off when a deadline passes
+without a disarm, then records the event.
+
+arm() is one heap push per pour and disarm() only clears a flag, so the
+watchdog costs nothing per pulse or per supervisor step. Both the flag
+and the pump-off happen under the watchdog lock: once disarm() returns,
+a late deadline can no longer cut the next pour on that tap.
+"""
+import time
+import heapq
+import itertools
+import threading
+from datetime import datetime
+from typing import Optional, Callable, Dict, Any, List, Tuple
+
+from database import database
+from status_snapshot import status_snapshot
+
+
+class WatchdogHandle:
+    """One armed pour (returned by PumpWatchdog.arm)"""
+    __slots__ = ("gpio", "tap_id", "sale_id", "timeout_s", "armed_at", "deadline",
+                 "on_fire", "active", "fired")
+    
+    def __init__(self, gpio, sale_id: Optional[str], timeout_s: float,
+                 on_fire: Optional[Callable[[Dict[str, Any]], None]]):
+        self.gpio = gpio
+        self.tap_id = gpio.tap_id
+        self.sale_id = sale_id
+        self.timeout_s = timeout_s
+        self.armed_at = time.monotonic()
+        self.deadline = self.armed_at + timeout_s
+        self.on_fire = on_fire
+        self.active = True
+        self.fired = False
+
+
+class PumpWatchdog:
+    """
+    Deadlines of every tap's pour in one background thread
+    
+    Expired pumps are all switched off before any event is recorded, so
+    a slow database or callback never delays another tap's pump-off.
+    """
+    
+    def __init__(self):
+        self._heap: List[Tuple[float, int, WatchdogHandle]] = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.fired_count = 0
+        self.last_event: Optional[Dict[str, Any]] = None
+    
+    def arm(self, gpio, timeout_s: float, sale_id: Optional[str] = None,
+            on_fire: Optional[Callable[[Dict[str, Any]], None]] = None) -> WatchdogHandle:
+        """
+        Force gpio's pump off timeout_s from now unless disarmed first
+        
+        on_fire(event) runs on the watchdog thread after the pump is off.
+        """
+        handle = WatchdogHandle(gpio, sale_id, timeout_s, on_fire)
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="pump-watchdog", daemon=True)
+                self._thread.start()
+            heapq.heappush(self._heap, (handle.deadline, next(self._order), handle))
+            if self._heap[0][2] is handle:
+                self._cond.notify()
+        return handle
+    
+    def disarm(self, handle: Optional[WatchdogHandle]):
+        """Cancel a deadline (the heap entry is dropped when it comes due)"""
+        if handle is not None:
+            with self._cond:
+                handle.active = False
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    while self._heap and not self._heap[0][2].active:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    delay = self._heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                
+                # Pumps first, still under the lock so a disarm (and the
+                # next pour's pump on) cannot slip in before the cut
+                now = time.monotonic()
+                expired = []
+                while self._heap and self._heap[0][0] <= now:
+                    handle = heapq.heappop(self._heap)[2]
+                    if handle.active:
+                        handle.fired = True
+                        handle.active = False
+                        handle.gpio.pump_off(quiet=True)
+                        expired.append(handle)
+            
+            # Bookkeeping after, outside the lock
+            for handle in expired:
+                self._record(handle, now)
+    
+    def _record(self, handle: WatchdogHandle, now: float):
+        try:
+            pulse_count = handle.gpio.get_pulse_count()
+        except Exception:
+            pulse_count = None
+        event = {
+            "tap_id": handle.tap_id,
+            "sale_id": handle.sale_id,
+            "deadline_s": round(handle.timeout_s, 2),
+            "elapsed_s": round(now - handle.armed_at, 2),
+            "pulse_count": pulse_count,
+            "fired_at": datetime.utcnow().isoformat()
+        }
+        self.fired_count += 1
+        self.last_event = event
+        print(f"🚨 Watchdog forced pump off on tap {handle.tap_id} after {event['elapsed_s']:.1f}s "
+              f"(sale {handle.sale_id})")
+        self.publish_status()
+        
+        try:
+            database.save_watchdog_event(event)
+        except Exception as e:
+            print(f"⚠️ Failed to save watchdog event: {e}")
+        
+        if handle.on_fire:
+            try:
+                handle.on_fire(event)
+            except Exception as e:
+                print(f"⚠️ Watchdog callback failed: {e}")
+    
+    def get_status(self) -> Dict[str, Any]:
+        with self._cond:
+            armed = sum(1 for _, _, handle in self._heap if handle.active)
+        return {"armed": armed, "fired": self.fired_count, "last_event": self.last_event}
+    
+    def publish_status(self):
+        """Publish the watchdog section of the status snapshot"""
+        status_snapshot.update("watchdog", self.get_status())
+
+
+# Global pump watchdog (shared by every tap)
+pump_watchdog = PumpWatchdog()
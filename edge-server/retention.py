@@ -0,0 +1,252 @@
+"""
+Retention Manager for EDGE Server
+Keeps the local database bounded on long-running kiosks
+
+Each run (background thread, off the dispense/sync hot paths):
+1. Archives synced consumptions outside the retention window to a
+   compressed NDJSON segment, rolls them up into daily per-tap summaries
+   and deletes them (with their sync_log rows)
+2. Archives and deletes sync_log rows older than the log window
+3. Removes expired used_tokens and pulse traces beyond the telemetry cap
+4. Releases free pages with an incremental VACUUM
+
+Pending and failed consumptions are never pruned. Databases created
+before auto_vacuum=INCREMENTAL need a one-time full VACUUM, which the
+scheduled job never runs; convert them with the server stopped:
+
+    python retention.py --convert-vacuum
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+import threading
+from pathlib import Path
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List
+
+from config import config
+from database import database
+from status_snapshot import status_snapshot
+from telemetry import telemetry_store
+
+
+class ArchiveSegment:
+    """
+    One gzip-compressed NDJSON file of pruned rows
+    
+    Rows are flushed and fsynced before the caller deletes them, so a
+    crash can at worst archive a row twice, never lose it.
+    """
+    
+    def __init__(self, directory: str, table: str):
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        self.path = os.path.join(directory, f"{table}-{stamp}.ndjson.gz")
+        self._raw = None
+        self._gzip = None
+        self.rows = 0
+    
+    def write(self, rows: List[Dict[str, Any]]):
+        if not rows:
+            return
+        if self._gzip is None:
+            self._raw = open(self.path, "ab")
+            self._gzip = gzip.GzipFile(fileobj=self._raw, mode="wb")
+        for row in rows:
+            line = json.dumps(row, default=str, separators=(",", ":")) + "\n"
+            self._gzip.write(line.encode("utf-8"))
+        self._gzip.flush()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self.rows += len(rows)
+    
+    def close(self):
+        if self._gzip is not None:
+            self._gzip.close()
+            self._raw.close()
+            self._gzip = None
+            self._raw = None
+
+
+class RetentionManager:
+    """
+    Scheduled retention job
+    
+    Runs every INTERVAL_SECONDS on its own thread; run_once() can also be
+    called directly (e.g. from a maintenance script).
+    """
+    
+    def __init__(self):
+        self.settings = config.retention
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._run_lock = threading.Lock()
+        self._last_run: Optional[Dict[str, Any]] = None
+    
+    # ==================== Scheduling ====================
+    
+    def start(self):
+        """Start the background retention thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._retention_loop, name="retention", daemon=True)
+        self._thread.start()
+        print(f"🧹 Retention manager started (interval: {self.settings.INTERVAL_SECONDS}s)")
+    
+    def stop(self):
+        """Stop the background retention thread"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=30)
+            self._thread = None
+    
+    def _retention_loop(self):
+        # Let startup (sync, first dispenses) settle before the first run
+        if self._stop_event.wait(60):
+            return
+        
+        while not self._stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"❌ Retention run failed: {e}")
+            
+            self._stop_event.wait(self.settings.INTERVAL_SECONDS)
+    
+    # ==================== Retention Run ====================
+    
+    def run_once(self) -> Dict[str, Any]:
+        """Run every retention step once and return a summary"""
+        with self._run_lock:
+            started = time.monotonic()
+            now = datetime.utcnow()
+            
+            summary = {
+                "started_at": now.isoformat(),
+                "consumptions_pruned": self._prune_consumptions(now),
+                "sync_log_pruned": self._prune_sync_log(now),
+                "tokens_expired": database.cleanup_expired_tokens(),
+                "pulse_traces_pruned": telemetry_store.prune(),
+                "archives_removed": self._prune_archives(now),
+                "vacuum": database.vacuum_step(
+                    self.settings.VACUUM_MIN_FREE_PAGES,
+                    self.settings.VACUUM_MAX_PAGES
+                ),
+            }
+            summary["duration_seconds"] = round(time.monotonic() - started, 3)
+            
+            self._last_run = summary
+            status_snapshot.update("retention", summary)
+            print(f"🧹 Retention: {summary['consumptions_pruned']} consumptions, "
+                  f"{summary['sync_log_pruned']} sync_log rows pruned "
+                  f"in {summary['duration_seconds']}s")
+            if summary["vacuum"]["mode"] == "needs_conversion":
+                print("⚠️ Free pages are not released until the database is converted "
+                      "(stop the server, then: python retention.py --convert-vacuum)")
+            return summary
+    
+    def _segment(self, table: str) -> Optional[ArchiveSegment]:
+        if not self.settings.ARCHIVE_DIR:
+            return None
+        return ArchiveSegment(self.settings.ARCHIVE_DIR, table)
+    
+    def _prune_consumptions(self, now: datetime) -> int:
+        cutoff = (now - timedelta(days=self.settings.SYNCED_MAX_AGE_DAYS)).isoformat()
+        consumptions_segment = self._segment("consumptions")
+        sync_log_segment = self._segment("sync_log")
+        pruned = 0
+        
+        try:
+            while not self._stop_event.is_set():
+                rows = database.get_prunable_consumptions(
+                    cutoff, self.settings.SYNCED_MAX_ROWS, self.settings.BATCH_SIZE
+                )
+                if not rows:
+                    break
+                
+                ids = [row["id"] for row in rows]
+                if consumptions_segment:
+                    consumptions_segment.write(rows)
+                    sync_log_segment.write(database.get_sync_log_for(ids))
+                
+                removed = database.prune_consumptions(ids)
+                pruned += removed
+                if removed == 0:
+                    break
+        finally:
+            for segment in (consumptions_segment, sync_log_segment):
+                if segment:
+                    segment.close()
+        
+        return pruned
+    
+    def _prune_sync_log(self, now: datetime) -> int:
+        cutoff = (now - timedelta(days=self.settings.SYNC_LOG_MAX_AGE_DAYS)).isoformat()
+        segment = self._segment("sync_log")
+        pruned = 0
+        
+        try:
+            while not self._stop_event.is_set():
+                rows = database.get_expired_sync_log(cutoff, self.settings.BATCH_SIZE)
+                if not rows:
+                    break
+                if segment:
+                    segment.write(rows)
+                pruned += database.delete_sync_log([row["id"] for row in rows])
+        finally:
+            if segment:
+                segment.close()
+        
+        return pruned
+    
+    def _prune_archives(self, now: datetime) -> int:
+        """Delete archive segments older than ARCHIVE_MAX_AGE_DAYS"""
+        directory = self.settings.ARCHIVE_DIR
+        if not directory or not os.path.isdir(directory):
+            return 0
+        
+        cutoff = (now - timedelta(days=self.settings.ARCHIVE_MAX_AGE_DAYS)).timestamp()
+        removed = 0
+        for path in Path(directory).glob("*.ndjson.gz"):
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        return removed
+    
+    def get_status(self) -> Dict[str, Any]:
+        """Get retention status summary"""
+        return {
+            "running": self._thread is not None and self._thread.is_alive(),
+            "interval_seconds": self.settings.INTERVAL_SECONDS,
+            "last_run": self._last_run
+        }
+
+
+# Global retention manager instance
+retention_manager = RetentionManager()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EDGE retention and maintenance")
+    parser.add_argument("--convert-vacuum", action="store_true",
+                        help="one-time full VACUUM to incremental auto_vacuum (stop the server first)")
+    args = parser.parse_args(argv)
+    database.initialize()
+    
+    if args.convert_vacuum:
+        if database.convert_incremental_vacuum():
+            print("✅ Database converted to incremental auto_vacuum")
+        else:
+            print("ℹ️ Database already uses incremental auto_vacuum")
+        return 0
+    
+    print(json.dumps(retention_manager.run_once(), indent=2, default=str))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
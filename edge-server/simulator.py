@@ -0,0 +1,249 @@
+"""
+Hardware Simulator for EDGE Server
+Runs complete dispenses on a VirtualClock with a simulated flow sensor
+
+The real Dispenser, GPIOController and TokenValidator are used; only the
+flow sensor and time are simulated, so thousands of pours (including
+empty-keg and slow-flow cases) finish in seconds with repeatable timing.
+Consumption records, metrics and token claims are kept in memory; the
+rest runs against a scratch database (EDGE_DB_PATH, a temp file unless
+set), never the real edge_data.db.
+
+build_tap() returns the wired-up pieces of one simulated tap, for tests
+that need more than the summary of simulate().
+
+Usage:
+    python simulator.py [--pours 1000] [--scenario normal] [--volume 300] [--seed 1]
+    python simulator.py --scenario empty-keg --pours 20 --verbose
+"""
+import os
+import sys
+import time
+import atexit
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any, List
+
+# Scratch database (read at import by config)
+if "EDGE_DB_PATH" not in os.environ:
+    _scratch_dir = tempfile.mkdtemp(prefix="edge-sim-")
+    atexit.register(shutil.rmtree, _scratch_dir, True)
+    os.environ["EDGE_DB_PATH"] = os.path.join(_scratch_dir, "edge_data.db")
+
+from config import config
+from database import database, ConsumptionRecord
+database.initialize()  # before gpio_controller, whose taps read the calibration table on import
+from clock import VirtualClock
+from gpio_controller import GPIOController
+from dispenser import Dispenser, DispenseEventBus, DispenseStatus
+from overshoot import OvershootModel
+from token_validator import TokenValidator
+from telemetry import encode_deltas
+
+
+# Named flow conditions for --scenario
+SCENARIOS: Dict[str, Dict[str, Any]] = {
+    "normal": {"flow_rate_ml_s": 25.0, "spin_down_s": 0.1, "jitter": 0.05},
+    "slow-flow": {"flow_rate_ml_s": 2.0, "spin_down_s": 0.05, "jitter": 0.05},
+    "spin-down": {"flow_rate_ml_s": 25.0, "spin_down_s": 0.4, "jitter": 0.05},
+    # Keg sized for about half of the requested pours; flow fades (foams) over its last 200 ml
+    "empty-keg": {"flow_rate_ml_s": 25.0, "spin_down_s": 0.05, "jitter": 0.05,
+                  "keg_fraction": 0.5, "taper_ml": 200.0},
+}
+
+# Fixed wall-clock origin so runs are repeatable (2023-11-14T22:13:20Z)
+SIMULATION_EPOCH = 1_700_000_000.0
+
+
+class SimulatedFlowSensor:
+    """
+    Flow-sensor pulses scheduled on a VirtualClock
+    
+    While the pump is on, pulses arrive at flow_rate_ml_s (with optional
+    relative jitter). After pump off, flow continues for spin_down_s,
+    which is what the cutoff's overshoot measures. A keg holding keg_ml
+    runs dry and stops the pulses mid-pour; over its last taper_ml the
+    flow fades linearly, like a foaming keg.
+    """
+    
+    def __init__(self, clock: VirtualClock, flow_rate_ml_s: float = 25.0,
+                 spin_down_s: float = 0.0, jitter: float = 0.0,
+                 keg_ml: Optional[float] = None, taper_ml: float = 0.0, seed: int = 0):
+        self.clock = clock
+        self.flow_rate_ml_s = flow_rate_ml_s
+        self.spin_down_s = spin_down_s
+        self.jitter = jitter
+        self.keg_ml = keg_ml
+        self.taper_ml = taper_ml
+        self.gpio: Optional[GPIOController] = None
+        self._rng = random.Random(seed)
+        self._generation = 0
+        self._stop_at: Optional[float] = None
+    
+    def attach(self, gpio: GPIOController):
+        self.gpio = gpio
+        gpio.attach_simulator(self)
+    
+    @property
+    def ml_per_pulse(self) -> float:
+        return 1000 / self.gpio.pulses_per_liter
+    
+    def pump_on(self):
+        # A new generation invalidates pulses still scheduled from the last pour
+        self._generation += 1
+        self._stop_at = None
+        self._schedule(self._generation)
+    
+    def pump_off(self):
+        self._stop_at = self.clock.monotonic() + self.spin_down_s
+    
+    def _schedule(self, generation: int):
+        rate = self.flow_rate_ml_s
+        if self.keg_ml is not None and self.keg_ml < self.taper_ml:
+            rate *= max(self.keg_ml / self.taper_ml, 0.02)
+        interval = self.ml_per_pulse / rate
+        if self.jitter:
+            interval *= 1 + self._rng.uniform(-self.jitter, self.jitter)
+        self.clock.call_later(interval, lambda: self._pulse(generation))
+    
+    def _pulse(self, generation: int):
+        if generation != self._generation:
+            return
+        if self._stop_at is not None and self.clock.monotonic() > self._stop_at:
+            return
+        if self.keg_ml is not None:
+            if self.keg_ml < self.ml_per_pulse:
+                return  # keg empty: no more pulses
+            self.keg_ml -= self.ml_per_pulse
+        
+        self.gpio._on_flow_pulse()
+        self._schedule(generation)
+
+
+class _MemoryWriter:
+    """Stands in for the consumption writer; keeps records in memory"""
+    
+    def __init__(self):
+        self.records: List[ConsumptionRecord] = []
+    
+    def submit(self, record: ConsumptionRecord, side_writes=()) -> Future:
+        self.records.append(record)
+        for side_write in side_writes:
+            side_write()
+        future: Future = Future()
+        future.set_result(record)
+        return future
+
+
+@dataclass
+class SimulatedTap:
+    """One simulated tap: the real Dispenser on a VirtualClock and a SimulatedFlowSensor"""
+    clock: VirtualClock
+    gpio: GPIOController
+    sensor: SimulatedFlowSensor
+    dispenser: Dispenser
+    validator: TokenValidator
+    writer: _MemoryWriter
+    metrics: List[Dict[str, Any]] = field(default_factory=list)
+    trace_bytes: List[int] = field(default_factory=list)
+    
+    def pour(self, volume_ml: int, sale_id: str, binary: bool = False):
+        """Issue, validate and dispense one token"""
+        token = self.validator.generate_token(
+            sale_id=sale_id,
+            beverage_id=config.TAPS[self.dispenser.tap_id]["beverage_id"],
+            volume_ml=volume_ml,
+            tap_id=self.dispenser.tap_id,
+            binary=binary
+        )
+        is_valid, payload, error = self.validator.validate_token(token)
+        if not is_valid:
+            raise RuntimeError(f"Simulated token rejected: {error}")
+        return self.dispenser.dispense(payload)
+
+
+def build_tap(scenario: str = "normal", keg_ml: Optional[float] = None, seed: int = 1) -> SimulatedTap:
+    """Fresh simulated tap for a SCENARIOS entry (keg_ml overrides keg_fraction)"""
+    settings = dict(SCENARIOS[scenario])
+    settings.pop("keg_fraction", None)
+    
+    clock = VirtualClock(epoch=SIMULATION_EPOCH)
+    gpio = GPIOController(tap_id=config.DEFAULT_TAP_ID, clock=clock)
+    gpio.calibrations = None  # nominal coefficient, no database reads
+    sensor = SimulatedFlowSensor(clock, keg_ml=keg_ml, seed=seed, **settings)
+    sensor.attach(gpio)
+    
+    writer = _MemoryWriter()
+    dispenser = Dispenser(config.DEFAULT_TAP_ID, gpio, DispenseEventBus(), clock=clock, writer=writer)
+    tap = SimulatedTap(clock, gpio, sensor, dispenser, TokenValidator(clock=clock), writer)
+    dispenser.metrics_sink = tap.metrics.append
+    dispenser.overshoot = OvershootModel(persist=False)
+    dispenser.trace_sink = lambda consumption_id, tap_id, trace: tap.trace_bytes.append(len(encode_deltas(trace)[1]))
+    claimed_nonces = set()
+    dispenser.token_claim = lambda nonce, ttl: not (nonce in claimed_nonces or claimed_nonces.add(nonce))
+    tap.validator.persist_used_tokens = False
+    return tap
+
+
+def simulate(pours: int, scenario: str = "normal", volume_ml: int = 300,
+             seed: int = 1, verbose: bool = False) -> Dict[str, Any]:
+    """Run `pours` dispenses of volume_ml on a fresh simulated tap and summarize them"""
+    keg_fraction = SCENARIOS[scenario].get("keg_fraction")
+    tap = build_tap(scenario, keg_ml=pours * volume_ml * keg_fraction if keg_fraction else None, seed=seed)
+    
+    results = []
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        quiet = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(devnull)
+        with quiet:
+            for i in range(pours):
+                results.append(tap.pour(volume_ml, f"SIM-{seed}-{i:06d}"))
+    wall_seconds = time.perf_counter() - started
+    
+    completed = [r for r in results if r.status == DispenseStatus.COMPLETED]
+    interrupted: Dict[str, int] = {}
+    for r in results:
+        if r.status != DispenseStatus.COMPLETED:
+            interrupted[r.error_message] = interrupted.get(r.error_message, 0) + 1
+    overshoot = [m["overshoot_ml"] for m in tap.metrics if m["cutoff_reason"] == "target"]
+    
+    return {
+        "scenario": scenario,
+        "pours": pours,
+        "completed": len(completed),
+        "interrupted": interrupted,
+        "volume_dispensed_ml": round(sum(r.volume_dispensed_ml for r in results), 1),
+        "overshoot_ml_avg": round(sum(overshoot) / len(overshoot), 2) if overshoot else None,
+        "overshoot_ml_max": round(max(overshoot), 2) if overshoot else None,
+        "records": len(tap.writer.records),
+        "trace_bytes_avg": round(sum(tap.trace_bytes) / len(tap.trace_bytes)) if tap.trace_bytes else None,
+        "simulated_seconds": round(tap.clock.monotonic(), 1),
+        "wall_seconds": round(wall_seconds, 3),
+        "pours_per_second": round(pours / wall_seconds) if wall_seconds > 0 else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EDGE hardware simulator")
+    parser.add_argument("--pours", type=int, default=1000)
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="normal")
+    parser.add_argument("--volume", type=int, default=300, help="ml per pour")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="show dispenser logs")
+    args = parser.parse_args(argv)
+    
+    summary = simulate(args.pours, args.scenario, args.volume, args.seed, args.verbose)
+    
+    print(f"\n🧪 Simulation: {summary['scenario']}, {summary['pours']} x {args.volume}ml")
+    for key, value in summary.items():
+        if key not in ("scenario", "pours"):
+            print(f"  {key:<22} {value}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
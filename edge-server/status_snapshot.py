@@ -0,0 +1,65 @@
+"""
+Status Snapshot for EDGE Server
+In-memory, event-updated status served by GET /edge/status
+
+Components (dispenser, sync service, database, GPIO) publish their
+section whenever their state changes. Readers only copy the cached
+sections, so the status endpoint never does network or SQL work.
+"""
+import time
+import threading
+from typing import Optional, Dict, Any
+
+
+class StatusSnapshot:
+    """
+    Versioned snapshot of the EDGE status
+
+    Each section is replaced as a whole (never mutated in place), so a
+    shallow copy of the section map is a consistent view for readers.
+    Every update bumps the version number.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sections: Dict[str, Dict[str, Any]] = {}
+        self._version = 0
+        self._updated_at: Optional[float] = None
+
+    @property
+    def version(self) -> int:
+        """Current snapshot version (increments on every update)"""
+        return self._version
+
+    def update(self, section: str, data: Dict[str, Any]):
+        """Replace a whole section"""
+        with self._lock:
+            self._sections[section] = dict(data)
+            self._version += 1
+            self._updated_at = time.time()
+
+    def merge(self, section: str, **fields):
+        """Update some fields of a section, keeping the others"""
+        with self._lock:
+            current = dict(self._sections.get(section, {}))
+            current.update(fields)
+            self._sections[section] = current
+            self._version += 1
+            self._updated_at = time.time()
+
+    def get_section(self, section: str) -> Dict[str, Any]:
+        """Get a copy of a single section"""
+        with self._lock:
+            return dict(self._sections.get(section, {}))
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Get the full snapshot with its version"""
+        with self._lock:
+            result: Dict[str, Any] = dict(self._sections)
+            result["version"] = self._version
+            result["updated_at"] = self._updated_at
+        return result
+
+
+# Global status snapshot instance
+status_snapshot = StatusSnapshot()
@@ -5,11 +5,18 @@ Background synchronization of consumption records with SaaS backend
 import time
 import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Dict, Any, List
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from config import config
+from clock import Clock, system_clock
 from database import database, ConsumptionRecord, SyncStatus
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from token_validator import token_validator
+from status_snapshot import status_snapshot
 
 
 class SyncService:
@@ -17,26 +24,98 @@ class SyncService:
     Background service to sync consumption records with SaaS backend
     
     Features:
-    - Periodic sync of pending records
+    - Periodic sync of pending records (batched uploads)
+    - Pooled keep-alive HTTP session with retry adapter
+    - Optional concurrent upload workers (ordering kept per sale)
     - Retry logic for failed syncs
     - Exponential backoff
-    - Connection health monitoring
+    - Circuit breaker around all SaaS calls
+    - Background reachability prober (get_status only reads cached state)
     """
     
-    def __init__(self):
+    def __init__(self, clock: Optional[Clock] = None):
+        self.clock = clock or system_clock
         self.base_url = config.saas.BASE_URL
         self.api_key = config.saas.API_KEY
         self.machine_id = config.saas.MACHINE_ID
         self.sync_interval = config.saas.SYNC_INTERVAL
         self.timeout = config.saas.TIMEOUT
         self.max_retries = config.saas.MAX_RETRIES
+        self.batch_size = config.saas.SYNC_BATCH_SIZE
+        self.max_batches_per_sync = config.saas.MAX_BATCHES_PER_SYNC
+        
+        # Per-record uploads until this monotonic time after the batch
+        # endpoint answered 404/405 (a proxy error must not latch it off)
+        self.batch_reprobe_interval = config.saas.BATCH_REPROBE_INTERVAL
+        self._batch_retry_at: Optional[float] = None
+        
+        # Keep-alive connection pool shared by all SaaS calls
+        self.session = self._create_session()
+        
+        # Concurrent upload workers (created lazily)
+        self.sync_workers = max(1, config.saas.SYNC_WORKERS)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        
+        # Circuit breaker fed by both real traffic and health probes
+        self.breaker = CircuitBreaker(
+            failure_threshold=config.saas.BREAKER_FAILURE_THRESHOLD,
+            reset_timeout=config.saas.BREAKER_RESET_TIMEOUT,
+            clock=self.clock
+        )
+        self.probe_interval = config.saas.PROBE_INTERVAL
+        self._probe_thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._last_traffic_at: Optional[float] = None
+        
+        # HMAC key ring refresh
+        self.key_refresh_interval = config.saas.KEY_REFRESH_INTERVAL
+        self._keys_refreshed_at: Optional[float] = None
+        
+        # Throughput of uploads (records/sec)
+        self._throughput_lock = threading.Lock()
+        self._total_uploaded = 0
+        self._total_upload_seconds = 0.0
+        self._last_records_per_sec: Optional[float] = None
         
         self._running = False
         self._thread: Optional[threading.Thread] = None
         self._last_sync_time: Optional[datetime] = None
         self._last_sync_success = True
         self._consecutive_failures = 0
+        self._saas_reachable: Optional[bool] = None
+        
+        self.publish_status()
+        
+    def _create_session(self) -> requests.Session:
+        """
+        HTTP session with a keep-alive pool and retry adapter
         
+        Connection failures are retried for every method (nothing was
+        sent). 502/503/504 responses are retried for GET only: a gateway
+        error can still hide a POST the SaaS processed, and POST
+        /consumptions is not idempotent. Read timeouts are not retried.
+        Failed uploads stay pending for the next sync cycle.
+        """
+        retry = Retry(
+            total=config.saas.HTTP_RETRIES,
+            connect=config.saas.HTTP_RETRIES,
+            read=0,
+            status=config.saas.HTTP_RETRIES,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET"}),
+            backoff_factor=config.saas.HTTP_RETRY_BACKOFF,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=config.saas.HTTP_POOL_SIZE,
+            max_retries=retry
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+    
     @property
     def headers(self) -> Dict[str, str]:
         """Request headers with API key"""
@@ -45,14 +124,99 @@ class SyncService:
             "X-API-Key": self.api_key
         }
     
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Call the SaaS through the circuit breaker
+        
+        Raises CircuitOpenError without touching the network while the
+        circuit is open. Connection errors, timeouts and 5xx responses
+        count as failures; any other response proves the SaaS is up.
+        """
+        if not self.breaker.allow_request():
+            raise CircuitOpenError("SaaS circuit is open")
+        
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self._record_outcome(False)
+            raise
+        
+        self._record_outcome(response.status_code < 500)
+        return response
+    
+    def _record_outcome(self, success: bool):
+        """Feed a call outcome to the breaker and the cached reachability"""
+        self._last_traffic_at = self.clock.monotonic()
+        self._saas_reachable = success
+        if success:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+    
     def check_connection(self) -> bool:
-        """Check if SaaS backend is reachable"""
+        """Check if SaaS backend is reachable (result is cached for get_status)"""
         try:
             url = f"{self.base_url}/api/v1/health"
-            response = requests.get(url, timeout=5)
-            return response.status_code == 200
+            response = self._request("GET", url, timeout=5)
+            reachable = response.status_code == 200
+        except CircuitOpenError:
+            return False
         except Exception:
+            reachable = False
+        
+        self._saas_reachable = reachable
+        return reachable
+    
+    def refresh_keys(self) -> bool:
+        """
+        Fetch this machine's HMAC key ring from the SaaS
+        
+        Installs it in the token validator and stores it locally so
+        kid tokens keep validating across offline restarts.
+        """
+        url = f"{self.base_url}/api/v1/machines/me/keys"
+        try:
+            response = self._request("GET", url, headers=self.headers, timeout=self.timeout)
+        except CircuitOpenError:
             return False
+        except Exception as e:
+            print(f"⚠️ Key ring refresh failed: {e}")
+            return False
+        
+        if response.status_code != 200:
+            print(f"⚠️ Key ring refresh failed - HTTP {response.status_code}")
+            return False
+        
+        data = response.json()
+        token_validator.load_keys(data.get("keys", []), data.get("current_kid"))
+        database.save_hmac_keys(token_validator.key_ring.export(), token_validator.key_ring.current_kid)
+        self._keys_refreshed_at = self.clock.monotonic()
+        return True
+    
+    def fetch_refills(self, since: Optional[str] = None) -> Optional[List[Dict[str, Any]]]:
+        """Keg refills of this machine's taps from the SaaS (None if unavailable)"""
+        url = f"{self.base_url}/api/v1/machines/me/refills"
+        try:
+            response = self._request("GET", url, headers=self.headers, timeout=self.timeout,
+                                     params={"since": since} if since else None)
+        except CircuitOpenError:
+            return None
+        except Exception as e:
+            print(f"⚠️ Refill fetch failed: {e}")
+            return None
+        
+        if response.status_code != 200:
+            print(f"⚠️ Refill fetch failed - HTTP {response.status_code}")
+            return None
+        return response.json()
+    
+    def _keys_due(self) -> bool:
+        return (self._keys_refreshed_at is None
+                or self.clock.monotonic() - self._keys_refreshed_at >= self.key_refresh_interval)
+    
+    def is_saas_available(self) -> bool:
+        """Cached view: circuit not open and last call/probe succeeded"""
+        return not self.breaker.is_open() and self._saas_reachable is not False
     
     def _format_datetime(self, dt_str: str) -> Optional[str]:
         """
@@ -66,14 +230,8 @@ class SyncService:
             return dt_str + "Z"
         return dt_str
     
-    def sync_consumption(self, record: ConsumptionRecord) -> bool:
-        """
-        Sync a single consumption record to SaaS
-        
-        Returns True if sync successful
-        """
-        url = f"{self.base_url}/api/v1/consumptions"
-        
+    def _build_payload(self, record: ConsumptionRecord) -> Dict[str, Any]:
+        """Consumption payload in the format expected by the SaaS"""
         # Mapeamento de status EDGE -> SaaS
         STATUS_MAP = {
             "completed": "OK",
@@ -95,10 +253,21 @@ class SyncService:
         }
         
         # Remove campos None para evitar problemas de validação
-        payload = {k: v for k, v in payload.items() if v is not None}
+        return {k: v for k, v in payload.items() if v is not None}
+    
+    def _upload_one(self, record: ConsumptionRecord) -> Optional[tuple]:
+        """
+        POST a single record to the SaaS without touching the database
+        
+        Returns a (record_id, success, response_code, message) outcome for
+        Database.apply_sync_outcomes, or None if the circuit is open.
+        """
+        url = f"{self.base_url}/api/v1/consumptions"
+        payload = self._build_payload(record)
         
         try:
-            response = requests.post(
+            response = self._request(
+                "POST",
                 url,
                 json=payload,
                 headers=self.headers,
@@ -106,39 +275,216 @@ class SyncService:
             )
             
             if response.status_code in (200, 201):
-                database.mark_synced(
-                    record.id,
-                    response_code=response.status_code,
-                    response_body=response.text[:500]
-                )
                 print(f"✅ Synced: {record.id} ({record.volume_dispensed_ml:.0f}ml)")
-                return True
+                return (record.id, True, response.status_code, response.text[:500])
+            
+            if response.status_code == 404:
+                print(f"⚠️ Sync failed: {record.id} - HTTP {response.status_code} (Machine/Sale not found in SaaS - expected in MVP)")
             else:
-                database.mark_sync_failed(
-                    record.id,
-                    error_message=f"HTTP {response.status_code}: {response.text[:200]}",
-                    response_code=response.status_code
-                )
-                if response.status_code == 404:
-                    print(f"⚠️ Sync failed: {record.id} - HTTP {response.status_code} (Machine/Sale not found in SaaS - expected in MVP)")
-                else:
-                    print(f"❌ Sync failed: {record.id} - HTTP {response.status_code}")
-                return False
+                print(f"❌ Sync failed: {record.id} - HTTP {response.status_code}")
+            return (record.id, False, response.status_code,
+                    f"HTTP {response.status_code}: {response.text[:200]}")
                 
+        except CircuitOpenError:
+            # Not attempted - the record stays in its current state
+            return None
+            
         except requests.exceptions.Timeout:
-            database.mark_sync_failed(record.id, "Connection timeout")
             print(f"⏱️ Sync timeout: {record.id}")
-            return False
+            return (record.id, False, None, "Connection timeout")
             
         except requests.exceptions.ConnectionError:
-            database.mark_sync_failed(record.id, "Connection error - SaaS unreachable")
             print(f"🔌 Connection error: {record.id}")
-            return False
+            return (record.id, False, None, "Connection error - SaaS unreachable")
             
         except Exception as e:
-            database.mark_sync_failed(record.id, str(e))
             print(f"❌ Sync error: {record.id} - {e}")
+            return (record.id, False, None, str(e))
+    
+    def sync_consumption(self, record: ConsumptionRecord) -> bool:
+        """
+        Sync a single consumption record to SaaS
+        
+        Returns True if sync successful
+        """
+        outcome = self._upload_one(record)
+        if outcome is None:
             return False
+        
+        database.apply_sync_outcomes([outcome])
+        return outcome[1]
+    
+    def sync_batch(self, records: List[ConsumptionRecord]) -> Dict[str, int]:
+        """
+        Sync a batch of records with one POST /api/v1/consumptions/batch
+        
+        Per-record results are written back in a single transaction.
+        Falls back to one request per record if the SaaS has no batch
+        endpoint, and tries the batch route again after
+        BATCH_REPROBE_INTERVAL.
+        
+        Returns dict with counts: synced, failed, skipped (circuit open)
+        """
+        if self._batch_retry_at is not None and self.clock.monotonic() >= self._batch_retry_at:
+            self._batch_retry_at = None
+        
+        if self._batch_retry_at is not None:
+            return self._sync_each(records)
+        
+        url = f"{self.base_url}/api/v1/consumptions/batch"
+        body = {"records": [self._build_payload(record) for record in records]}
+        
+        try:
+            response = self._request(
+                "POST",
+                url,
+                json=body,
+                headers=self.headers,
+                timeout=self.timeout
+            )
+        except CircuitOpenError:
+            return {"synced": 0, "failed": 0, "skipped": len(records)}
+        except requests.exceptions.Timeout:
+            error_message = "Connection timeout"
+            print(f"⏱️ Batch sync timeout ({len(records)} records)")
+            response = None
+        except requests.exceptions.ConnectionError:
+            error_message = "Connection error - SaaS unreachable"
+            print(f"🔌 Connection error ({len(records)} records)")
+            response = None
+        except Exception as e:
+            error_message = str(e)
+            print(f"❌ Batch sync error: {e}")
+            response = None
+        
+        if response is None:
+            database.apply_sync_outcomes([(record.id, False, None, error_message) for record in records])
+            return {"synced": 0, "failed": len(records), "skipped": 0}
+        
+        if response.status_code in (404, 405):
+            # Older SaaS without the batch endpoint (or a proxy error)
+            print(f"⚠️ SaaS batch endpoint answered {response.status_code} - per-record sync "
+                  f"for {self.batch_reprobe_interval}s")
+            self._batch_retry_at = self.clock.monotonic() + self.batch_reprobe_interval
+            return self._sync_each(records)
+        
+        if response.status_code != 200:
+            error_message = f"HTTP {response.status_code}: {response.text[:200]}"
+            database.apply_sync_outcomes(
+                [(record.id, False, response.status_code, error_message) for record in records]
+            )
+            print(f"❌ Batch sync failed - HTTP {response.status_code}")
+            return {"synced": 0, "failed": len(records), "skipped": 0}
+        
+        results = response.json().get("results", [])
+        outcomes = {result.get("index"): result for result in results}
+        
+        sync_outcomes = []
+        for index, record in enumerate(records):
+            result = outcomes.get(index)
+            if result and result.get("status") in ("OK", "DUPLICATE"):
+                sync_outcomes.append((record.id, True, response.status_code, None))
+            else:
+                code = result.get("http_status") if result else None
+                error = result.get("error") if result else "Missing result in batch response"
+                sync_outcomes.append((record.id, False, code, f"HTTP {code}: {error}" if code else error))
+        
+        database.apply_sync_outcomes(sync_outcomes)
+        synced = sum(1 for outcome in sync_outcomes if outcome[1])
+        print(f"✅ Batch synced: {synced} ok, {len(sync_outcomes) - synced} rejected")
+        
+        return {"synced": synced, "failed": len(sync_outcomes) - synced, "skipped": 0}
+    
+    def _sync_each(self, records: List[ConsumptionRecord]) -> Dict[str, int]:
+        """Per-record uploads, results still written in one transaction"""
+        outcomes = []
+        for record in records:
+            outcome = self._upload_one(record)
+            if outcome is None:
+                break
+            outcomes.append(outcome)
+        
+        database.apply_sync_outcomes(outcomes)
+        synced = sum(1 for outcome in outcomes if outcome[1])
+        return {"synced": synced, "failed": len(outcomes) - synced, "skipped": len(records) - len(outcomes)}
+    
+    def _sync_lane(self, records: List[ConsumptionRecord]) -> Dict[str, int]:
+        """Upload records in order, in batches, stopping if a whole batch fails"""
+        synced = 0
+        failed = 0
+        
+        for start in range(0, len(records), self.batch_size):
+            result = self.sync_batch(records[start:start + self.batch_size])
+            synced += result["synced"]
+            failed += result["failed"]
+            
+            # Stop when nothing in a batch got through (likely connection issue)
+            if result["synced"] == 0 and (result["failed"] > 0 or result["skipped"] > 0):
+                print("⚠️ Batch failed - stopping sync")
+                break
+        
+        return {"synced": synced, "failed": failed}
+    
+    def _sync_records(self, records: List[ConsumptionRecord]) -> Dict[str, int]:
+        """
+        Upload records, concurrently when SYNC_WORKERS > 1
+        
+        Records are split into one lane per worker by sale_id, so all
+        records of a sale go through the same worker in their original
+        order. Lanes upload in parallel over the shared connection pool.
+        """
+        started = time.perf_counter()
+        
+        if self.sync_workers <= 1 or len(records) <= self.batch_size:
+            result = self._sync_lane(records)
+        else:
+            lanes: List[List[ConsumptionRecord]] = [[] for _ in range(self.sync_workers)]
+            for record in records:
+                lanes[hash(record.sale_id) % self.sync_workers].append(record)
+            
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.sync_workers,
+                    thread_name_prefix="sync-worker"
+                )
+            
+            futures = [self._executor.submit(self._sync_lane, lane) for lane in lanes if lane]
+            result = {"synced": 0, "failed": 0}
+            for future in futures:
+                lane_result = future.result()
+                result["synced"] += lane_result["synced"]
+                result["failed"] += lane_result["failed"]
+        
+        self._record_throughput(result["synced"] + result["failed"], time.perf_counter() - started)
+        return result
+    
+    def _record_throughput(self, records: int, seconds: float):
+        """Accumulate upload throughput for get_status()"""
+        if records <= 0 or seconds <= 0:
+            return
+        
+        rate = records / seconds
+        with self._throughput_lock:
+            self._total_uploaded += records
+            self._total_upload_seconds += seconds
+            self._last_records_per_sec = rate
+        
+        print(f"📈 Uploaded {records} records in {seconds:.2f}s ({rate:.1f} records/s)")
+    
+    def get_throughput(self) -> Dict[str, Any]:
+        """Upload throughput: last run and running average (records/sec)"""
+        with self._throughput_lock:
+            average = (
+                self._total_uploaded / self._total_upload_seconds
+                if self._total_upload_seconds > 0 else None
+            )
+            return {
+                "workers": self.sync_workers,
+                "batch_size": self.batch_size,
+                "total_records": self._total_uploaded,
+                "last_records_per_sec": round(self._last_records_per_sec, 1) if self._last_records_per_sec else None,
+                "avg_records_per_sec": round(average, 1) if average else None
+            }
     
     def sync_pending(self) -> Dict[str, int]:
         """
@@ -146,28 +492,21 @@ class SyncService:
         
         Returns dict with counts: synced, failed, pending
         """
-        pending = database.get_pending_consumptions()
+        pending = database.get_pending_consumptions(
+            limit=self.batch_size * self.max_batches_per_sync
+        )
         
         if not pending:
             return {"synced": 0, "failed": 0, "pending": 0}
         
         print(f"📤 Syncing {len(pending)} pending records...")
         
-        synced = 0
-        failed = 0
-        
-        for record in pending:
-            if self.sync_consumption(record):
-                synced += 1
-            else:
-                failed += 1
-                # Stop on consecutive failures (likely connection issue)
-                if failed >= 3:
-                    print("⚠️ Multiple failures - stopping sync batch")
-                    break
+        result = self._sync_records(pending)
+        synced = result["synced"]
+        failed = result["failed"]
         
         # Get updated pending count
-        remaining = len(database.get_pending_consumptions())
+        remaining = database.count_pending()
         
         return {"synced": synced, "failed": failed, "pending": remaining}
     
@@ -184,16 +523,11 @@ class SyncService:
         
         print(f"🔄 Retrying {len(failed)} failed records...")
         
-        synced = 0
-        still_failed = 0
+        result = self._sync_records(failed)
+        synced = result["synced"]
+        still_failed = result["failed"]
         
-        for record in failed:
-            if self.sync_consumption(record):
-                synced += 1
-            else:
-                still_failed += 1
-        
-        remaining = len(database.get_failed_consumptions(max_attempts=self.max_retries))
+        remaining = database.count_retryable(max_attempts=self.max_retries)
         
         return {"synced": synced, "failed": still_failed, "remaining": remaining}
     
@@ -203,12 +537,16 @@ class SyncService:
         
         while self._running:
             try:
-                # Check connection first
-                if not self.check_connection():
+                # Cached reachability (prober + breaker) - no network call here
+                if not self.is_saas_available():
                     print("⚠️ SaaS unreachable - skipping sync")
                     self._last_sync_success = False
                     self._consecutive_failures += 1
                 else:
+                    # Keep the key ring current (rotations publish keys ahead of use)
+                    if self._keys_due():
+                        self.refresh_keys()
+                    
                     # Sync pending records
                     result = self.sync_pending()
                     
@@ -231,15 +569,35 @@ class SyncService:
                 self._last_sync_success = False
                 self._consecutive_failures += 1
             
+            self.publish_status()
+            
             # Calculate backoff based on failures
             if self._consecutive_failures > 0:
                 backoff = min(60, self.sync_interval * (2 ** min(self._consecutive_failures - 1, 4)))
-                time.sleep(backoff)
+                self.clock.wait(self._stop_event, backoff)
             else:
-                time.sleep(self.sync_interval)
+                self.clock.wait(self._stop_event, self.sync_interval)
         
         print("🛑 Sync service stopped")
     
+    def _probe_loop(self):
+        """
+        Background reachability prober
+        
+        Hits the health endpoint only when no real traffic happened during
+        the last probe interval and the circuit is not open (a half-open
+        circuit is probed as its trial call).
+        """
+        while self._running:
+            idle = (self.clock.monotonic() - self._last_traffic_at
+                    if self._last_traffic_at is not None else None)
+            
+            if (idle is None or idle >= self.probe_interval) and not self.breaker.is_open():
+                self.check_connection()
+                self.publish_status()
+            
+            self.clock.wait(self._stop_event, self.probe_interval)
+    
     def start(self):
         """Start the background sync service"""
         if self._running:
@@ -252,34 +610,56 @@ class SyncService:
             return
         
         self._running = True
+        self._stop_event.clear()
+        self._probe_thread = threading.Thread(target=self._probe_loop, daemon=True)
+        self._probe_thread.start()
         self._thread = threading.Thread(target=self._sync_loop, daemon=True)
         self._thread.start()
+        self.publish_status()
     
     def stop(self):
         """Stop the background sync service"""
         self._running = False
+        self._stop_event.set()
+        if self._probe_thread:
+            self._probe_thread.join(timeout=5)
+            self._probe_thread = None
         if self._thread:
             self._thread.join(timeout=5)
             self._thread = None
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self.session.close()
+        self.publish_status()
     
     def get_status(self) -> Dict[str, Any]:
-        """Get sync service status"""
-        stats = database.get_consumption_stats()
-        
+        """
+        Get sync service status
+        Only reads cached state - no network or SQL work
+        """
         return {
             "running": self._running,
             "last_sync": self._last_sync_time.isoformat() if self._last_sync_time else None,
             "last_success": self._last_sync_success,
             "consecutive_failures": self._consecutive_failures,
-            "saas_reachable": self.check_connection(),
-            "records": stats
+            "saas_reachable": self._saas_reachable,
+            "circuit": self.breaker.get_status(),
+            "key_ring": token_validator.key_ring.get_status(),
+            "throughput": self.get_throughput(),
+            "records": status_snapshot.get_section("database")
         }
     
+    def publish_status(self):
+        """Publish sync state to the status snapshot"""
+        status_snapshot.update("sync", self.get_status())
+    
     def force_sync(self) -> Dict[str, Any]:
         """Force immediate sync (blocking)"""
         print("⚡ Force sync requested")
         result = self.sync_pending()
         retry_result = self.retry_failed()
+        self.publish_status()
         
         return {
             "synced": result["synced"] + retry_result["synced"],
@@ -0,0 +1,144 @@
+"""
+Pulse Telemetry for EDGE Server
+Per-dispense pulse traces for calibration and foaming diagnosis
+
+Each pour's flow-sensor pulse inter-arrival times (microseconds, the
+first one measured from pump on) are stored delta-encoded in the
+pulse_traces side table, keyed by consumption id: uint16 samples when
+every delta fits, uint32 otherwise, little-endian. A 300 ml pour on a
+450 pulses/L sensor is ~135 pulses, so a few hundred bytes.
+
+get_trace() returns the deltas as a NumPy array when NumPy is installed
+(array.array otherwise).
+"""
+import sys
+from array import array
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, Tuple, Union
+
+from config import config
+from database import database
+
+# NumPy is optional (not needed on the kiosk itself)
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    np = None
+    HAS_NUMPY = False
+
+
+MAX_DELTA_US = 0xFFFFFFFF
+
+
+def encode_deltas(deltas_us: array) -> Tuple[int, bytes]:
+    """Pack microsecond deltas as (sample_width, little-endian bytes)"""
+    width = 2 if not deltas_us or max(deltas_us) <= 0xFFFF else 4
+    packed = array('H' if width == 2 else 'I', deltas_us)
+    if packed.itemsize != width:  # 'I' is 4 bytes on every supported platform
+        raise ValueError(f"Unsupported array item size {packed.itemsize}")
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return width, packed.tobytes()
+
+
+def decode_deltas(width: int, blob: bytes) -> array:
+    """Inverse of encode_deltas (always returns uint32 samples)"""
+    packed = array('H' if width == 2 else 'I')
+    packed.frombytes(blob)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed if width == 4 else array('I', packed)
+
+
+@dataclass
+class PulseTrace:
+    """One stored pour trace"""
+    consumption_id: str
+    tap_id: int
+    pulse_count: int
+    sample_width: int
+    deltas_us: Union[array, "np.ndarray"]
+    created_at: str
+    
+    def summary(self, pulses_per_liter: Optional[float] = None) -> Dict[str, Any]:
+        """Pour duration and interval statistics (flow needs pulses_per_liter)"""
+        deltas = [int(d) for d in self.deltas_us]
+        if not deltas:
+            return {"pulses": 0}
+        
+        intervals = deltas[1:]  # deltas[0] is pump on -> first pulse
+        result = {
+            "pulses": len(deltas),
+            "first_pulse_s": deltas[0] / 1e6,
+            "duration_s": sum(deltas) / 1e6,
+            "interval_min_ms": min(intervals) / 1000 if intervals else None,
+            "interval_max_ms": max(intervals) / 1000 if intervals else None,
+            "interval_mean_ms": sum(intervals) / len(intervals) / 1000 if intervals else None,
+        }
+        if pulses_per_liter and intervals:
+            ml_per_pulse = 1000 / pulses_per_liter
+            result["flow_ml_s_avg"] = len(intervals) * ml_per_pulse / (sum(intervals) / 1e6)
+        return result
+    
+    def to_dict(self, pulses_per_liter: Optional[float] = None) -> Dict[str, Any]:
+        return {
+            "consumption_id": self.consumption_id,
+            "tap_id": self.tap_id,
+            "pulse_count": self.pulse_count,
+            "sample_width": self.sample_width,
+            "unit": "us",
+            "created_at": self.created_at,
+            "summary": self.summary(pulses_per_liter),
+            "deltas_us": [int(d) for d in self.deltas_us]
+        }
+
+
+class TelemetryStore:
+    """Writes and reads pulse traces"""
+    
+    def __init__(self):
+        self.settings = config.telemetry
+    
+    @property
+    def enabled(self) -> bool:
+        return self.settings.ENABLED
+    
+    def save_trace(self, consumption_id: str, tap_id: int, deltas_us: array):
+        """Store a pour's trace (a side write of its consumption's transaction)"""
+        if not self.enabled or deltas_us is None:
+            return
+        width, blob = encode_deltas(deltas_us)
+        database.save_pulse_trace(consumption_id, tap_id, len(deltas_us), width, blob)
+    
+    def get_trace(self, consumption_id: str, as_numpy: bool = True) -> Optional[PulseTrace]:
+        """Stored trace, deltas as a NumPy uint32 array when available"""
+        row = database.get_pulse_trace(consumption_id)
+        if row is None:
+            return None
+        
+        deltas = decode_deltas(row["sample_width"], row["deltas"])
+        if as_numpy and HAS_NUMPY:
+            deltas = np.frombuffer(deltas.tobytes(), dtype=np.uint32).copy()
+        
+        return PulseTrace(
+            consumption_id=row["consumption_id"],
+            tap_id=row["tap_id"],
+            pulse_count=row["pulse_count"],
+            sample_width=row["sample_width"],
+            deltas_us=deltas,
+            created_at=row["created_at"]
+        )
+    
+    @staticmethod
+    def encode(trace: PulseTrace) -> Tuple[int, bytes]:
+        """Stored (sample_width, bytes) form of a trace"""
+        return encode_deltas(array('I', (int(d) for d in trace.deltas_us)))
+    
+    def prune(self) -> int:
+        """Keep only the newest MAX_TRACES traces"""
+        return database.prune_pulse_traces(self.settings.MAX_TRACES)
+
+
+# Global telemetry store instance
+telemetry_store = TelemetryStore()
@@ -0,0 +1,27 @@
+"""
+Shared setup for the EDGE server tests
+
+Puts edge-server on sys.path and points EDGE_DB_PATH at a scratch
+database before any module reads config.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+EDGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, EDGE_DIR)
+
+os.environ["EDGE_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="edge-tests-"), "edge_data.db")
+
+from database import Database  # noqa: E402
+
+
+@pytest.fixture
+def scratch_db(tmp_path):
+    """Empty database of its own (the shared EDGE_DB_PATH one keeps other tests' rows)"""
+    db = Database(str(tmp_path / "scratch.db"))
+    db.initialize()
+    yield db
+    db.close()
@@ -0,0 +1,112 @@
+"""
+Write-behind consumption writer: group commit, journal and retries
+"""
+import os
+import uuid
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from database import database
+from consumption_writer import ConsumptionWriter
+
+
+@pytest.fixture
+def writer():
+    database.initialize()
+    writer = ConsumptionWriter()
+    writer.retry_interval = 0.05
+    writer.start()
+    yield writer
+    writer.stop()
+
+
+def _record():
+    now = datetime.utcnow()
+    return database.build_consumption(
+        sale_id=f"SALE-{uuid.uuid4()}", token_id=None, beverage_id="beer", tap_id=1,
+        volume_authorized_ml=300, volume_dispensed_ml=300.0,
+        started_at=now, finished_at=now, pulse_count=135, flow_rate_avg=25.0
+    )
+
+
+def _journal_size():
+    return os.path.getsize(f"{database.db_path}.pending")
+
+
+def _lock_inserts(monkeypatch):
+    def locked(records):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(database, "insert_consumptions", locked)
+
+
+def test_group_commit_runs_side_writes_and_empties_journal(writer):
+    side_rows = []
+    records = [_record() for _ in range(5)]
+    
+    futures = [writer.submit(record, [lambda r=record: side_rows.append(r.id)]) for record in records]
+    assert writer.wait_idle(5)
+    
+    assert [future.result().id for future in futures] == [record.id for record in records]
+    assert side_rows == [record.id for record in records]
+    assert all(database.get_consumption(record.id) for record in records)
+    assert _journal_size() == 0
+
+
+def test_failing_side_write_does_not_lose_the_record(writer):
+    def broken():
+        raise ValueError("bad metrics row")
+    record = _record()
+    
+    future = writer.submit(record, [broken])
+    
+    assert future.result(5).id == record.id
+    assert database.get_consumption(record.id)
+
+
+def test_transient_failure_stays_journaled_and_is_retried(writer, monkeypatch):
+    _lock_inserts(monkeypatch)
+    record = _record()
+    
+    future = writer.submit(record)
+    assert writer.wait_idle(5)
+    
+    assert not future.done()
+    assert _journal_size() > 0
+    assert writer.get_status()["retrying"] == 1
+    
+    monkeypatch.undo()
+    assert future.result(5).id == record.id
+    assert database.get_consumption(record.id)
+    assert writer.wait_idle(5)
+    assert _journal_size() == 0
+
+
+def test_journal_is_replayed_by_the_next_writer(writer, monkeypatch):
+    _lock_inserts(monkeypatch)
+    record = _record()
+    writer.submit(record)
+    assert writer.wait_idle(5)
+    writer.stop()  # still locked: the record is left in the journal
+    monkeypatch.undo()
+    
+    restarted = ConsumptionWriter()
+    restarted.start()
+    try:
+        assert database.get_consumption(record.id)
+        assert _journal_size() == 0
+    finally:
+        restarted.stop()
+
+
+def test_permanent_failure_fails_the_future(writer):
+    record = _record()
+    assert writer.submit(record).result(5)
+    
+    duplicate = writer.submit(record)  # same id: IntegrityError is not retried
+    
+    with pytest.raises(sqlite3.IntegrityError):
+        duplicate.result(5)
+    assert writer.get_status()["retrying"] == 0
+    assert writer.write_errors == 1
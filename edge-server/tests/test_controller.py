@@ -0,0 +1,113 @@
+"""
+Controller process: shared-memory status block and command/reply round trips
+"""
+import time
+import uuid
+
+import pytest
+
+from dispenser import DispenseStatus
+from token_validator import TokenPayload
+from controller import StatusBlock, RemoteDispenserRegistry
+
+
+@pytest.fixture
+def block():
+    block = StatusBlock.create(2)
+    yield block
+    block.close()
+
+
+def _write(block, slot, volume_ml=150.0, sale_id="SALE-1"):
+    block.write(slot, tap_id=slot + 1, status=DispenseStatus.DISPENSING, volume_ml=volume_ml,
+                duration_s=1.5, flow_ml_s=100.0, pulses_per_liter=450.0,
+                completion_seq=3, sale_id=sale_id)
+
+
+def test_block_round_trip_between_attachments(block):
+    assert block.read(0) is None
+    _write(block, 1)
+    
+    reader = StatusBlock.attach(block.name)
+    try:
+        live = reader.read(1)
+        assert live["tap_id"] == 2
+        assert live["status"] == DispenseStatus.DISPENSING
+        assert live["volume_dispensed_ml"] == 150.0
+        assert live["completion_seq"] == 3
+        assert live["current_sale_id"] == "SALE-1"
+        assert live["seq"] % 2 == 0
+        assert reader.read(0) is None
+    finally:
+        reader.close()
+
+
+def test_block_rejects_out_of_range_slots(block):
+    for slot in (-1, 2):
+        with pytest.raises(IndexError):
+            block.read(slot)
+        with pytest.raises(IndexError):
+            _write(block, slot)
+
+
+def test_block_never_returns_a_torn_slot(block):
+    _write(block, 0)
+    offset = block._offset(0)
+    
+    # Writer stopped mid-update: seq stays odd
+    seq = block.SEQ.unpack_from(block.shm.buf, offset)[0]
+    block.SEQ.pack_into(block.shm.buf, offset, seq + 1)
+    assert block.read(0, retries=5) is None
+    
+    # Even seq but a body that does not match its crc
+    block.SEQ.pack_into(block.shm.buf, offset, seq)
+    start = offset + block.BODY_OFFSET + 16
+    block.shm.buf[start] ^= 0xFF
+    assert block.read(0, retries=5) is None
+    
+    _write(block, 0, volume_ml=200.0)
+    assert block.read(0)["volume_dispensed_ml"] == 200.0
+
+
+def test_block_rejects_foreign_segment(block):
+    block.shm.buf[0:4] = b"XXXX"
+    with pytest.raises(ValueError):
+        StatusBlock.attach(block.name)
+
+
+@pytest.fixture
+def registry():
+    registry = RemoteDispenserRegistry()
+    registry.initialize()
+    yield registry
+    registry.cleanup()
+
+
+def test_registry_dispense_and_cancel_round_trip(registry):
+    dispenser = registry.get()
+    assert not dispenser.is_busy
+    assert dispenser.cancel() is False
+    
+    payload = TokenPayload(
+        sale_id=f"SALE-{uuid.uuid4()}", beverage_id="beer", volume_ml=20,
+        tap_id=dispenser.tap_id, timestamp=time.time(), nonce=uuid.uuid4().hex
+    )
+    result = dispenser.dispense(payload)
+    
+    assert result.success
+    assert result.sale_id == payload.sale_id
+    assert result.volume_dispensed_ml > 0
+    assert registry.block.read(dispenser.slot)["status"] == DispenseStatus.IDLE
+    
+    # The outcome reaches the parent's completion log as an event
+    deadline = time.monotonic() + 5
+    while registry.completions.get(payload.sale_id) is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+    completion = registry.completions.get(payload.sale_id)
+    assert completion.result["volume_dispensed_ml"] == result.volume_dispensed_ml
+
+
+def test_registry_fails_calls_once_stopped(registry):
+    registry.cleanup()
+    with pytest.raises(RuntimeError):
+        registry.call("cancel", 1, timeout=1)
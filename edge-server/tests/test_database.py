@@ -0,0 +1,79 @@
+"""
+Consumption counters (triggers, check_counters) and bulk sync outcomes
+"""
+import uuid
+from datetime import datetime, timedelta
+
+from database import SyncStatus
+
+
+def _insert(db, count, volume_ml=300.0, started_at=None):
+    started_at = started_at or datetime.utcnow()
+    records = [
+        db.build_consumption(
+            sale_id=f"SALE-{uuid.uuid4()}", token_id=None, beverage_id="beer", tap_id=1,
+            volume_authorized_ml=300, volume_dispensed_ml=volume_ml,
+            started_at=started_at, finished_at=started_at + timedelta(seconds=10),
+            pulse_count=135, flow_rate_avg=30.0
+        )
+        for _ in range(count)
+    ]
+    return db.insert_consumptions(records)
+
+
+def _counters(db):
+    stats = db.get_consumption_stats()
+    return (stats["total_records"], stats["pending_sync"], stats["synced"],
+            stats["failed"], stats["total_volume_ml"])
+
+
+def test_counters_follow_inserts_and_sync_outcomes(scratch_db):
+    assert _counters(scratch_db) == (0, 0, 0, 0, 0)
+    records = _insert(scratch_db, 4, volume_ml=250.0)
+    assert _counters(scratch_db) == (4, 4, 0, 0, 1000.0)
+    
+    scratch_db.apply_sync_outcomes([
+        (records[0].id, True, 201, None),
+        (records[1].id, True, 201, None),
+        (records[2].id, False, 500, "HTTP 500"),
+    ])
+    assert _counters(scratch_db) == (4, 1, 2, 1, 1000.0)
+    
+    # Retry of the failed one
+    scratch_db.apply_sync_outcomes([(records[2].id, True, 200, None)])
+    assert _counters(scratch_db) == (4, 1, 3, 0, 1000.0)
+    
+    assert scratch_db.prune_consumptions([records[0].id, records[3].id]) == 1
+    assert _counters(scratch_db) == (3, 1, 2, 0, 750.0)
+    assert scratch_db.check_counters(repair=False)["consistent"]
+
+
+def test_apply_sync_outcomes_records_attempts_and_log(scratch_db):
+    ok, failed = _insert(scratch_db, 2)
+    
+    scratch_db.apply_sync_outcomes([(ok.id, True, 201, '{"status": "OK"}'), (failed.id, False, 404, "HTTP 404")])
+    
+    ok, failed = scratch_db.get_consumption(ok.id), scratch_db.get_consumption(failed.id)
+    assert (ok.sync_status, ok.sync_attempts) == (SyncStatus.SYNCED.value, 1)
+    assert (failed.sync_status, failed.sync_attempts) == (SyncStatus.FAILED.value, 1)
+    assert failed.error_message == "HTTP 404"
+    
+    log = {row["consumption_id"]: row for row in scratch_db.get_sync_log_for([ok.id, failed.id])}
+    assert (log[ok.id]["success"], log[ok.id]["response_code"]) == (1, 201)
+    assert (log[failed.id]["success"], log[failed.id]["error_message"]) == (0, "HTTP 404")
+    assert [record.id for record in scratch_db.get_failed_consumptions()] == [failed.id]
+
+
+def test_check_counters_repairs_drift(scratch_db):
+    _insert(scratch_db, 3)
+    with scratch_db.get_connection() as conn:
+        conn.execute("UPDATE consumption_counters SET total_records = 7, pending_sync = 0 WHERE id = 1")
+    
+    check = scratch_db.check_counters(repair=False)
+    assert not check["consistent"]
+    assert check["stored"]["total_records"] == 7 and check["actual"]["total_records"] == 3
+    assert _counters(scratch_db)[0] == 7
+    
+    assert not scratch_db.check_counters()["consistent"]
+    assert _counters(scratch_db) == (3, 3, 0, 0, 900.0)
+    assert scratch_db.check_counters()["consistent"]
@@ -0,0 +1,119 @@
+"""
+Retention job: pruning, rollup, archives and VACUUM
+"""
+import copy
+import gzip
+import json
+import sqlite3
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import retention
+import telemetry
+from database import Database, SyncStatus
+from retention import RetentionManager
+
+
+def _legacy_database(path):
+    """File created before auto_vacuum=INCREMENTAL (auto_vacuum stays NONE)"""
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE legacy (id INTEGER PRIMARY KEY, payload TEXT)")
+    conn.executemany("INSERT INTO legacy (payload) VALUES (?)", [("x" * 500,)] * 200)
+    conn.commit()
+    conn.close()
+    return Database(str(path))
+
+
+def _auto_vacuum(db):
+    return db._writer.connection().execute("PRAGMA auto_vacuum").fetchone()[0]
+
+
+def test_vacuum_step_never_converts_a_legacy_database(tmp_path):
+    db = _legacy_database(tmp_path / "legacy.db")
+    
+    assert db.vacuum_step(0, 100) == {"mode": "needs_conversion", "freed_pages": 0}
+    assert _auto_vacuum(db) == 0
+
+
+def test_convert_incremental_vacuum(tmp_path):
+    db = _legacy_database(tmp_path / "legacy.db")
+    
+    assert db.convert_incremental_vacuum()
+    assert _auto_vacuum(db) == 2
+    assert not db.convert_incremental_vacuum()
+    assert db.vacuum_step(10 ** 6, 100)["mode"] == "skipped"
+
+
+def _stored(db, started_at, volume_ml, status="completed"):
+    record = db.build_consumption(
+        sale_id=f"SALE-{uuid.uuid4()}", token_id=None, beverage_id="beer", tap_id=1,
+        volume_authorized_ml=300, volume_dispensed_ml=volume_ml,
+        started_at=started_at, finished_at=started_at + timedelta(seconds=10),
+        pulse_count=100, flow_rate_avg=30.0, status=status
+    )
+    return db.insert_consumptions([record])[0]
+
+
+def _age(db, record, days):
+    created_at = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    with db.get_connection() as conn:
+        conn.execute("UPDATE consumptions SET created_at = ? WHERE id = ?", (created_at, record.id))
+
+
+@pytest.fixture
+def manager(scratch_db, monkeypatch):
+    """RetentionManager working on scratch_db, with settings of its own"""
+    monkeypatch.setattr(retention, "database", scratch_db)
+    monkeypatch.setattr(telemetry, "database", scratch_db)
+    manager = RetentionManager()
+    manager.settings = copy.copy(manager.settings)
+    return manager
+
+
+def test_run_once_rolls_up_and_prunes_only_old_synced_records(manager, scratch_db, tmp_path):
+    manager.settings.ARCHIVE_DIR = str(tmp_path / "archive")
+    
+    day = datetime(2026, 3, 1, 20, 0)
+    old = [_stored(scratch_db, day, 280.0), _stored(scratch_db, day, 150.0, status="interrupted")]
+    old_pending = _stored(scratch_db, day, 300.0)
+    recent = _stored(scratch_db, datetime.utcnow(), 300.0)
+    for record in (*old, old_pending):
+        _age(scratch_db, record, manager.settings.SYNCED_MAX_AGE_DAYS + 1)
+    scratch_db.apply_sync_outcomes([(record.id, True, 201, None) for record in (*old, recent)])
+    
+    summary = manager.run_once()
+    
+    assert summary["consumptions_pruned"] == 2
+    assert all(scratch_db.get_consumption(record.id) is None for record in old)
+    assert scratch_db.get_consumption(old_pending.id).sync_status == SyncStatus.PENDING.value
+    assert scratch_db.get_consumption(recent.id) is not None
+    assert scratch_db.get_sync_log_for([record.id for record in old]) == []
+    assert scratch_db.check_counters(repair=False)["consistent"]
+    
+    [rollup] = scratch_db.get_daily_rollups()
+    assert (rollup["day"], rollup["tap_id"], rollup["records"]) == ("2026-03-01", 1, 2)
+    assert (rollup["completed"], rollup["interrupted"]) == (1, 1)
+    assert rollup["volume_dispensed_ml"] == 430.0
+    
+    [segment] = (tmp_path / "archive").glob("consumptions-*.ndjson.gz")
+    with gzip.open(segment, "rt") as f:
+        assert {json.loads(line)["id"] for line in f} == {record.id for record in old}
+    
+    assert manager.run_once()["consumptions_pruned"] == 0
+    assert scratch_db.get_daily_rollups()[0]["records"] == 2
+
+
+def test_run_once_caps_synced_rows(manager, scratch_db):
+    manager.settings.ARCHIVE_DIR = ""
+    manager.settings.SYNCED_MAX_ROWS = 2
+    
+    records = [_stored(scratch_db, datetime.utcnow(), 300.0) for _ in range(5)]
+    for age, record in zip(range(5, 0, -1), records):
+        _age(scratch_db, record, age / 1000)
+    scratch_db.apply_sync_outcomes([(record.id, True, 201, None) for record in records[:4]])
+    
+    assert manager.run_once()["consumptions_pruned"] == 2
+    kept = [record for record in records if scratch_db.get_consumption(record.id)]
+    assert kept == records[2:]
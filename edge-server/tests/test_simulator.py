@@ -0,0 +1,177 @@
+"""
+Dispense path on the hardware simulator (VirtualClock + SimulatedFlowSensor)
+"""
+import math
+import time
+import uuid
+import threading
+
+import pytest
+
+from simulator import build_tap
+from config import config
+from database import database
+from dispenser import DispenseStatus
+from pump_watchdog import PumpWatchdog
+from token_validator import TokenValidator
+
+
+@pytest.fixture
+def tap():
+    return build_tap("normal")
+
+
+def _target_pulses(tap, volume_ml):
+    return math.ceil(volume_ml * tap.gpio.pulses_per_liter / 1000)
+
+
+# ==================== Interrupt cutoff ====================
+
+def test_cutoff_fires_on_target_pulse(tap):
+    tap.sensor.jitter = 0.0
+    tap.sensor.spin_down_s = 0.0
+    
+    result = tap.pour(300, "SIM-CUTOFF")
+    
+    metrics = tap.metrics[-1]
+    assert result.status == DispenseStatus.COMPLETED
+    assert metrics["cutoff_reason"] == "target"
+    assert metrics["target_pulses"] == _target_pulses(tap, 300)
+    assert metrics["cutoff_pulses"] == metrics["target_pulses"]
+    assert metrics["final_pulses"] == metrics["cutoff_pulses"]
+    assert 0 <= metrics["overshoot_ml"] < 1000 / tap.gpio.pulses_per_liter
+
+
+def test_trailing_flow_shows_up_as_overshoot(tap):
+    tap.sensor.jitter = 0.0
+    tap.sensor.spin_down_s = 0.2
+    
+    tap.pour(300, "SIM-SPIN")
+    
+    metrics = tap.metrics[-1]
+    expected_ml = tap.sensor.flow_rate_ml_s * 0.2
+    assert metrics["trailing_ml"] == pytest.approx(expected_ml, abs=2 * 1000 / tap.gpio.pulses_per_liter)
+    assert metrics["overshoot_ml"] == pytest.approx(metrics["trailing_ml"], abs=1e-6)
+
+
+# ==================== Falling flow ====================
+
+def test_falling_flow_stops_the_pour():
+    tap = build_tap("empty-keg", keg_ml=500)
+    
+    results = [tap.pour(300, f"SIM-KEG-{i}") for i in range(3)]
+    
+    assert results[0].status == DispenseStatus.COMPLETED
+    stopped = results[1]
+    assert stopped.status == DispenseStatus.INTERRUPTED
+    assert tap.metrics[1]["cutoff_reason"] in ("low_flow", "no_flow")
+    assert stopped.volume_dispensed_ml < 200
+    assert results[2].status == DispenseStatus.INTERRUPTED
+    assert stopped.volume_dispensed_ml + results[2].volume_dispensed_ml < 200  # stops before the keg runs out
+
+
+# ==================== Overshoot compensation ====================
+
+def test_overshoot_lead_converges():
+    tap = build_tap("spin-down")
+    
+    for i in range(30):
+        tap.pour(300, f"SIM-LEAD-{i}")
+    
+    overshoot = [m["overshoot_ml"] for m in tap.metrics]
+    ml_per_pulse = 1000 / tap.gpio.pulses_per_liter
+    assert overshoot[0] > 5.0  # nothing learned yet: the whole spin-down lands on top
+    assert tap.gpio.get_cutoff_state().lead_pulses > 0
+    recent = overshoot[-10:]
+    assert abs(sum(recent) / len(recent)) < 2 * ml_per_pulse
+
+
+# ==================== Watchdog ====================
+
+def test_watchdog_forces_pump_off_at_deadline(tap):
+    watchdog = PumpWatchdog()
+    fired = threading.Event()
+    events = []
+    tap.gpio.pump_on()
+    
+    started = time.monotonic()
+    handle = watchdog.arm(tap.gpio, 0.05, sale_id="SIM-WATCHDOG",
+                          on_fire=lambda event: (events.append(event), fired.set()))
+    
+    assert fired.wait(2.0)
+    assert time.monotonic() - started >= 0.05
+    assert handle.fired
+    assert not tap.gpio.is_pump_on()
+    assert events[0]["sale_id"] == "SIM-WATCHDOG"
+    assert database.get_watchdog_events(1)[0]["sale_id"] == "SIM-WATCHDOG"
+
+
+def test_disarmed_watchdog_leaves_the_next_pour_alone(tap):
+    watchdog = PumpWatchdog()
+    handle = watchdog.arm(tap.gpio, 0.05, sale_id="SIM-DISARMED")
+    watchdog.disarm(handle)
+    tap.gpio.pump_on()
+    
+    time.sleep(0.2)
+    
+    assert not handle.fired
+    assert tap.gpio.is_pump_on()
+    tap.gpio.pump_off()
+
+
+# ==================== Tokens ====================
+
+def test_replay_rejected_across_restart(monkeypatch):
+    monkeypatch.setattr(config.security, "PERSIST_USED_TOKENS", True)
+    tap = build_tap("normal")
+    tap.validator.persist_used_tokens = True
+    tap.dispenser.token_claim = database.claim_token
+    token = tap.validator.generate_token(
+        sale_id=f"SIM-REPLAY-{uuid.uuid4()}", beverage_id="beer", volume_ml=100, tap_id=tap.dispenser.tap_id
+    )
+    
+    is_valid, payload, _ = tap.validator.validate_token(token)
+    assert is_valid
+    assert not database.is_token_used(payload.nonce)  # validation does not write
+    assert tap.dispenser.dispense(payload).status == DispenseStatus.COMPLETED
+    assert database.is_token_used(payload.nonce)
+    
+    # Restart with the Bloom filter rebuilt: rejected at validation
+    restarted = TokenValidator(clock=tap.clock)
+    restarted.load_used_tokens()
+    assert restarted.validate_token(token) == (False, None, "Token already used")
+    
+    # Restart without the filter: validation passes, the claim at pour start refuses
+    cold = TokenValidator(clock=tap.clock)
+    is_valid, payload, _ = cold.validate_token(token)
+    assert is_valid
+    result = tap.dispenser.dispense(payload)
+    assert result.status == DispenseStatus.ERROR
+    assert result.error_message == "Token already used"
+    assert result.pulse_count == 0
+
+
+def test_binary_token_round_trip(tap):
+    sale_id = str(uuid.uuid4())
+    beverage_id = str(uuid.uuid4())
+    
+    token = tap.validator.generate_token(sale_id=sale_id, beverage_id=beverage_id,
+                                         volume_ml=473, tap_id=3, binary=True)
+    is_valid, payload, error = tap.validator.validate_token(token)
+    
+    assert "." not in token
+    assert is_valid, error
+    assert (payload.sale_id, payload.beverage_id, payload.volume_ml, payload.tap_id) == \
+        (sale_id, beverage_id, 473, 3)
+    assert tap.validator.validate_token(token) == (False, None, "Token already used")
+
+
+def test_tampered_binary_token_rejected(tap):
+    token = tap.validator.generate_token(sale_id=str(uuid.uuid4()), beverage_id=str(uuid.uuid4()),
+                                         volume_ml=300, tap_id=1, binary=True)
+    tampered = token[:-2] + ("AA" if token[-2:] != "AA" else "BB")
+    
+    is_valid, payload, _ = tap.validator.validate_token(tampered)
+    
+    assert not is_valid
+    assert payload is None
@@ -0,0 +1,120 @@
+"""
+Consumption upload to the SaaS (batch route, per-record fallback)
+"""
+import uuid
+from datetime import datetime
+
+import pytest
+
+from clock import VirtualClock
+from database import database, SyncStatus
+from sync_service import SyncService
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self._body = body or {}
+        self.text = str(self._body)
+    
+    def json(self):
+        return self._body
+
+
+class FakeSaaS:
+    """Stands in for the requests session; answers the consumptions routes"""
+    
+    def __init__(self, batch_status=200):
+        self.batch_status = batch_status
+        self.batch_results = None  # per-index (status, http_status), default all OK
+        self.calls = []
+    
+    def request(self, method, url, json=None, **kwargs):
+        route = url.split("/api/v1", 1)[1]
+        self.calls.append(route)
+        if route == "/consumptions/batch":
+            if self.batch_status != 200:
+                return FakeResponse(self.batch_status)
+            results = self.batch_results or [("OK", 201)] * len(json["records"])
+            return FakeResponse(200, {"results": [
+                {"index": i, "status": status, "http_status": code,
+                 "error": "Sale não encontrada" if status == "REJECTED" else None}
+                for i, (status, code) in enumerate(results)
+            ]})
+        return FakeResponse(201, {"status": "OK"})
+
+
+@pytest.fixture
+def saas():
+    return FakeSaaS()
+
+
+@pytest.fixture
+def service(saas):
+    database.initialize()
+    service = SyncService(clock=VirtualClock())
+    service.session = saas
+    return service
+
+
+def _stored_records(count):
+    now = datetime.utcnow()
+    records = [
+        database.build_consumption(
+            sale_id=f"SALE-{uuid.uuid4()}", token_id=None, beverage_id="beer", tap_id=1,
+            volume_authorized_ml=300, volume_dispensed_ml=300.0,
+            started_at=now, finished_at=now, pulse_count=135, flow_rate_avg=25.0
+        )
+        for _ in range(count)
+    ]
+    return database.insert_consumptions(records)
+
+
+def _status(record):
+    return database.get_consumption(record.id).sync_status
+
+
+def test_batch_outcomes_are_applied_per_record(service, saas):
+    records = _stored_records(4)
+    # Last result missing from the response
+    saas.batch_results = [("OK", 201), ("DUPLICATE", 200), ("REJECTED", 404)]
+    
+    assert service.sync_batch(records) == {"synced": 2, "failed": 2, "skipped": 0}
+    assert saas.calls == ["/consumptions/batch"]
+    assert [_status(record) for record in records] == [
+        SyncStatus.SYNCED.value, SyncStatus.SYNCED.value, SyncStatus.FAILED.value, SyncStatus.FAILED.value
+    ]
+    rejected = database.get_consumption(records[2].id)
+    assert rejected.error_message == "HTTP 404: Sale não encontrada"
+    assert database.get_consumption(records[3].id).error_message == "Missing result in batch response"
+
+
+def test_batch_server_error_fails_the_whole_batch(service, saas):
+    saas.batch_status = 500
+    records = _stored_records(2)
+    
+    assert service.sync_batch(records) == {"synced": 0, "failed": 2, "skipped": 0}
+    assert saas.calls == ["/consumptions/batch"]
+    assert all(_status(record) == SyncStatus.FAILED.value for record in records)
+
+
+@pytest.mark.parametrize("code", [404, 405])
+def test_batch_not_found_falls_back_then_reprobes(service, saas, code):
+    saas.batch_status = code
+    records = _stored_records(2)
+    
+    assert service.sync_batch(records)["synced"] == 2
+    assert saas.calls == ["/consumptions/batch", "/consumptions", "/consumptions"]
+    
+    # Within the interval: per record, no batch attempt
+    saas.batch_status = 200
+    saas.calls.clear()
+    service.sync_batch(_stored_records(1))
+    assert saas.calls == ["/consumptions"]
+    
+    # After it: the batch route is tried again
+    service.clock.advance(service.batch_reprobe_interval)
+    saas.calls.clear()
+    assert service.sync_batch(_stored_records(3))["synced"] == 3
+    assert saas.calls == ["/consumptions/batch"]
+    assert all(_status(record) == SyncStatus.SYNCED.value for record in records)
@@ -1,17 +1,52 @@
 """
 Token Validator for EDGE Server
 HMAC validation with expiry check and single-use enforcement
+
+Used nonces are checked in three layers: the in-memory cache of nonces
+claimed by this process, a rolling Bloom filter rebuilt from the
+used_tokens table at startup, and the table itself. Fresh nonces (the
+common case) are answered by the first two without touching SQLite.
+The persistent claim (an INSERT OR IGNORE) is written by the dispenser
+when the pour starts, so replay protection survives restarts without a
+write on the request path.
 """
 import hmac
-import hashlib
 import time
 import json
+import heapq
+import uuid
+import struct
+import sqlite3
+import secrets
 import base64
-from typing import Optional, Tuple, Dict, Any
+from typing import Optional, Tuple, Dict, Any, List
 from dataclasses import dataclass
 from threading import Lock
 
 from config import config
+from clock import Clock, system_clock
+from database import database
+from bloom_filter import RollingBloomFilter
+from key_ring import KeyRing, HMACKey
+
+
+# Binary token v1: version, sale UUID, beverage UUID, volume (uint16),
+# tap (uint8), timestamp (uint32 seconds), 12-byte nonce, then the first
+# BINARY_MAC_SIZE bytes of HMAC-SHA256 over everything before it.
+# v2 adds the key ID (uint16) right after the version byte.
+# Encoded as unpadded base64url; it never contains '.', which is how
+# validate_token tells it apart from the JSON format.
+BINARY_TOKEN_LAYOUTS = {
+    1: struct.Struct(">B16s16sHBI12s"),
+    2: struct.Struct(">BH16s16sHBI12s"),
+}
+BINARY_MAC_SIZE = 16
+
+
+def _format_uuid(raw: bytes) -> str:
+    """16 raw bytes -> canonical UUID string (cheaper than uuid.UUID)"""
+    h = raw.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
 
 
 @dataclass
@@ -25,9 +60,9 @@ class TokenPayload:
     nonce: str
     token_raw: str = ""  # Token original para rastreabilidade
     
-    def is_expired(self, tolerance_seconds: int = 30) -> bool:
-        """Check if token has expired"""
-        return time.time() > (self.timestamp + tolerance_seconds)
+    def is_expired(self, tolerance_seconds: int = 30, now: Optional[float] = None) -> bool:
+        """Check if token has expired (now: unix seconds, default time.time())"""
+        return (time.time() if now is None else now) > (self.timestamp + tolerance_seconds)
     
     def to_dict(self) -> Dict[str, Any]:
         return {
@@ -45,7 +80,9 @@ class TokenValidator:
     """
     Validates dispense authorization tokens using HMAC-SHA256
     
-    Token format: base64(json_payload).base64(hmac_signature)
+    Token formats:
+    - JSON:   base64(json_payload).base64(hmac_signature)
+    - Binary: base64url(fixed layout + truncated HMAC), see BINARY_TOKEN_LAYOUTS
     
     Payload structure:
     {
@@ -54,51 +91,149 @@ class TokenValidator:
         "volume_ml": 500,
         "tap_id": 1,
         "timestamp": 1703347200.123,
-        "nonce": "random_string"
+        "nonce": "random_string",
+        "kid": 2                      (optional, key ring ID)
     }
+    
+    Tokens with a kid are verified with that key of the ring (synced from
+    the SaaS); tokens without one use the shared HMAC_SECRET.
     """
     
-    def __init__(self, hmac_secret: str = None):
+    def __init__(self, hmac_secret: str = None, clock: Optional[Clock] = None):
+        self.clock = clock or system_clock
         self.hmac_secret = (hmac_secret or config.security.HMAC_SECRET).encode('utf-8')
+        self.key_ring = KeyRing(self.hmac_secret.decode('utf-8'))
         self.used_tokens: Dict[str, float] = {}  # nonce -> expiry_time
+        # Min-heap of (expiry_time, nonce) so cleanup only touches expired entries
+        self._expiry_heap: List[Tuple[float, str]] = []
         self._lock = Lock()
         
-    def _compute_hmac(self, payload_bytes: bytes) -> str:
-        """Compute HMAC-SHA256 signature"""
-        signature = hmac.new(
-            self.hmac_secret,
-            payload_bytes,
-            hashlib.sha256
-        ).digest()
+        # Persisted nonces (restart-safe) screened by a rolling Bloom filter
+        self.persist_used_tokens = config.security.PERSIST_USED_TOKENS
+        self.nonce_filter = RollingBloomFilter(
+            capacity=config.security.NONCE_BLOOM_CAPACITY,
+            error_rate=config.security.NONCE_BLOOM_ERROR_RATE,
+            window_seconds=config.security.USED_TOKENS_TTL,
+            clock=self.clock
+        )
+        
+    def _compute_hmac(self, payload_bytes: bytes, key: HMACKey = None) -> str:
+        """Compute HMAC-SHA256 signature (legacy key unless a ring key is given)"""
+        signature = (key or self.key_ring.legacy).digest(payload_bytes)
         return base64.urlsafe_b64encode(signature).decode('utf-8')
     
+    def load_keys(self, keys: List[Dict[str, Any]], current_kid: Optional[int] = None):
+        """Install the key ring (from the SaaS or the local database)"""
+        self.key_ring.load(keys, current_kid)
+    
+    def _key_for(self, kid: Optional[int], timestamp: float) -> Tuple[Optional[HMACKey], Optional[str]]:
+        """Ring key for a token, checked against the key's validity window"""
+        key = self.key_ring.get(kid)
+        if key is None:
+            return None, f"Unknown key id: {kid}"
+        if not key.is_valid_at(timestamp, config.security.TOKEN_EXPIRY_TOLERANCE):
+            return None, f"Key {kid} not valid for token time"
+        return key, None
+    
     def generate_token(self, 
                        sale_id: str,
                        beverage_id: str,
                        volume_ml: int,
                        tap_id: int,
-                       nonce: str = None) -> str:
+                       nonce: str = None,
+                       binary: bool = False,
+                       kid: int = None) -> str:
         """
         Generate a signed dispense token (for testing purposes)
         In production, tokens are generated by SaaS backend
+        
+        binary=True emits the compact format; it falls back to JSON when
+        the ids are not UUIDs or a custom nonce is given. kid signs with
+        that key of the ring instead of the shared secret.
         """
-        import secrets
+        key = self.key_ring.get(kid)
+        if key is None:
+            raise ValueError(f"Unknown key id: {kid}")
+        
+        if binary and nonce is None:
+            try:
+                return self._generate_binary_token(sale_id, beverage_id, volume_ml, tap_id, key)
+            except ValueError:
+                pass
         
         payload = {
             "sale_id": sale_id,
             "beverage_id": beverage_id,
             "volume_ml": volume_ml,
             "tap_id": tap_id,
-            "timestamp": time.time(),
+            "timestamp": self.clock.time(),
             "nonce": nonce or secrets.token_urlsafe(16)
         }
+        if kid is not None:
+            payload["kid"] = kid
         
         payload_json = json.dumps(payload, separators=(',', ':'))
         payload_b64 = base64.urlsafe_b64encode(payload_json.encode('utf-8')).decode('utf-8')
-        signature = self._compute_hmac(payload_json.encode('utf-8'))
+        signature = self._compute_hmac(payload_json.encode('utf-8'), key)
         
         return f"{payload_b64}.{signature}"
     
+    def _generate_binary_token(self, sale_id: str, beverage_id: str, volume_ml: int, tap_id: int,
+                               key: HMACKey) -> str:
+        """Pack and sign a binary token, v2 for ring keys (ValueError if a field does not fit)"""
+        header = (1,) if key.kid is None else (2, key.kid)
+        try:
+            body = BINARY_TOKEN_LAYOUTS[header[0]].pack(
+                *header,
+                uuid.UUID(sale_id).bytes,
+                uuid.UUID(beverage_id).bytes,
+                volume_ml,
+                tap_id,
+                int(self.clock.time()),
+                secrets.token_bytes(12)
+            )
+        except struct.error as e:
+            raise ValueError(str(e))
+        
+        mac = key.digest(body)[:BINARY_MAC_SIZE]
+        return base64.urlsafe_b64encode(body + mac).decode('ascii').rstrip('=')
+    
+    def _parse_binary_token(self, token: str) -> Tuple[Optional[TokenPayload], Optional[str]]:
+        """Decode and verify a binary token; returns (payload, error)"""
+        try:
+            raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        except Exception:
+            return None, "Token parsing failed"
+        
+        layout = BINARY_TOKEN_LAYOUTS.get(raw[0]) if raw else None
+        if layout is None:
+            return None, f"Unsupported token version: {raw[0] if raw else None}"
+        if len(raw) != layout.size + BINARY_MAC_SIZE:
+            return None, "Invalid token format"
+        
+        body, mac = raw[:layout.size], raw[layout.size:]
+        fields = layout.unpack(body)
+        kid = fields[1] if raw[0] == 2 else None
+        sale_id, beverage_id, volume_ml, tap_id, timestamp, nonce = fields[-6:]
+        
+        key, error = self._key_for(kid, timestamp)
+        if key is None:
+            return None, error
+        
+        expected = key.digest(body)[:BINARY_MAC_SIZE]
+        if not hmac.compare_digest(mac, expected):
+            return None, "Invalid signature"
+        
+        return TokenPayload(
+            sale_id=_format_uuid(sale_id),
+            beverage_id=_format_uuid(beverage_id),
+            volume_ml=volume_ml,
+            tap_id=tap_id,
+            timestamp=float(timestamp),
+            nonce=base64.urlsafe_b64encode(nonce).decode('ascii'),
+            token_raw=token
+        ), None
+    
     def validate_token(self, token: str) -> Tuple[bool, Optional[TokenPayload], Optional[str]]:
         """
         Validate a dispense token
@@ -109,6 +244,13 @@ class TokenValidator:
         # Clean expired tokens periodically
         self._cleanup_used_tokens()
         
+        # Binary tokens contain no '.'
+        if isinstance(token, str) and '.' not in token:
+            payload, error = self._parse_binary_token(token)
+            if payload is None:
+                return False, None, error
+            return self._check_payload(payload)
+        
         # Parse token format
         try:
             parts = token.split('.')
@@ -128,10 +270,20 @@ class TokenValidator:
         except Exception as e:
             return False, None, f"Payload decode failed: {str(e)}"
         
+        # Pick the signing key (key ring by kid, shared secret without one)
+        try:
+            kid = payload_dict.get('kid')
+            kid = int(kid) if kid is not None else None
+            key, error = self._key_for(kid, float(payload_dict.get('timestamp', 0)))
+        except (AttributeError, ValueError, TypeError) as e:
+            return False, None, f"Invalid field value: {e}"
+        if key is None:
+            return False, None, error
+        
         # Verify HMAC signature
         # O Python gera base64 com padding, mas JS remove padding
         # Compara removendo padding de ambos para compatibilidade
-        expected_signature = self._compute_hmac(payload_json.encode('utf-8'))
+        expected_signature = self._compute_hmac(payload_json.encode('utf-8'), key)
         # Remove padding for comparison (JS uses no padding)
         signature_received_clean = signature_received.rstrip('=')
         expected_signature_clean = expected_signature.rstrip('=')
@@ -154,8 +306,12 @@ class TokenValidator:
         except (ValueError, TypeError) as e:
             return False, None, f"Invalid field value: {e}"
         
+        return self._check_payload(payload)
+    
+    def _check_payload(self, payload: TokenPayload) -> Tuple[bool, Optional[TokenPayload], Optional[str]]:
+        """Expiry and single-use checks shared by both token formats"""
         # Check expiry
-        if payload.is_expired(config.security.TOKEN_EXPIRY_TOLERANCE):
+        if payload.is_expired(config.security.TOKEN_EXPIRY_TOLERANCE, self.clock.time()):
             return False, None, "Token expired"
         
         # Check single-use (if enabled)
@@ -165,19 +321,77 @@ class TokenValidator:
                     return False, None, "Token already used"
                 
                 # Mark token as used
-                expiry_time = time.time() + config.security.USED_TOKENS_TTL
+                expiry_time = self.clock.time() + config.security.USED_TOKENS_TTL
                 self.used_tokens[payload.nonce] = expiry_time
+                heapq.heappush(self._expiry_heap, (expiry_time, payload.nonce))
+            
+            if self.persist_used_tokens:
+                if self._seen_persisted(payload.nonce):
+                    return False, None, "Token already used"
+                self.nonce_filter.add(payload.nonce)
         
         return True, payload, None
     
+    def _seen_persisted(self, nonce: str) -> bool:
+        """
+        Whether a nonce is already in the used_tokens table
+        
+        Only a Bloom-filter hit (claimed by an earlier run, or a false
+        positive) costs a read; a miss answers without touching SQLite.
+        The claim itself is written by the dispenser when the pour starts.
+        If SQLite is unavailable, enforcement falls back to memory only.
+        """
+        if not self.nonce_filter.may_contain(nonce):
+            return False
+        
+        try:
+            return database.is_token_used(nonce)
+        except sqlite3.Error as e:
+            print(f"⚠️ Used-token store unavailable, single-use enforced in memory only: {e}")
+            return False
+    
+    def load_persisted_keys(self) -> int:
+        """
+        Restore the key ring saved by the last SaaS sync
+        Called at startup so kid tokens validate while offline
+        """
+        keys, current_kid = database.get_hmac_keys()
+        self.key_ring.load(keys, current_kid)
+        if keys:
+            print(f"🔑 Loaded {len(keys)} HMAC keys (current kid: {current_kid})")
+        return len(keys)
+    
+    def load_used_tokens(self) -> int:
+        """
+        Rebuild the Bloom filter from unexpired persisted nonces
+        Called at startup, after the database is initialized
+        """
+        if not self.persist_used_tokens:
+            return 0
+        
+        nonces = database.get_active_token_nonces()
+        self.nonce_filter.clear()
+        for nonce in nonces:
+            self.nonce_filter.add(nonce)
+        
+        print(f"🔐 Loaded {len(nonces)} used token nonces into the replay filter")
+        return len(nonces)
+    
     def _cleanup_used_tokens(self):
-        """Remove expired entries from used tokens cache"""
+        """
+        Remove expired entries from used tokens cache
+        
+        Pops from the expiry heap only while its head has expired, so the
+        cost is O(log n) per expired nonce instead of a scan of the cache.
+        Heap entries whose nonce was removed or re-marked are skipped.
+        """
         with self._lock:
-            current_time = time.time()
-            expired = [nonce for nonce, expiry in self.used_tokens.items() 
-                      if current_time > expiry]
-            for nonce in expired:
-                del self.used_tokens[nonce]
+            current_time = self.clock.time()
+            heap = self._expiry_heap
+            while heap and heap[0][0] < current_time:
+                expiry, nonce = heapq.heappop(heap)
+                if self.used_tokens.get(nonce) == expiry:
+                    del self.used_tokens[nonce]
     
     def mark_token_unused(self, nonce: str):
         """
@@ -185,6 +399,12 @@ class TokenValidator:
         """
         with self._lock:
             self.used_tokens.pop(nonce, None)
+        
+        if self.persist_used_tokens:
+            try:
+                database.release_token(nonce)
+            except sqlite3.Error as e:
+                print(f"⚠️ Failed to release used token: {e}")
 
 
 # Global validator instance
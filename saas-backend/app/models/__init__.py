@@ -1,9 +1,9 @@
 # Models
 from .organization import Organization
 from .user import User
-from .machine import Machine
+from .machine import Machine, MachineKey
 from .beverage import Beverage
-from .sale import Sale
+from .sale import Sale, SaleToken
 from .consumption import Consumption
 from .stock import MachineStock, StockRefill, StockMovement, StockAlert
 
@@ -11,8 +11,10 @@ __all__ = [
     "Organization",
     "User", 
     "Machine",
+    "MachineKey",
     "Beverage",
     "Sale",
+    "SaleToken",
     "Consumption",
     "MachineStock",
     "StockRefill",
@@ -5,7 +5,7 @@ Máquinas dispensadoras de bebidas
 import uuid
 import secrets
 from datetime import datetime
-from sqlalchemy import Column, String, Boolean, DateTime, ForeignKey, Text
+from sqlalchemy import Column, String, Boolean, DateTime, ForeignKey, Text, Integer, UniqueConstraint
 from sqlalchemy.orm import relationship
 from ..database import Base
 
@@ -53,6 +53,36 @@ class Machine(Base):
     sales = relationship("Sale", back_populates="machine", cascade="all, delete-orphan")
     consumptions = relationship("Consumption", back_populates="machine", cascade="all, delete-orphan")
     stocks = relationship("MachineStock", back_populates="machine", cascade="all, delete-orphan")
+    keys = relationship("MachineKey", back_populates="machine", cascade="all, delete-orphan")
     
     def __repr__(self):
         return f"<Machine {self.code}>"
+
+
+class MachineKey(Base):
+    """
+    Chave HMAC versionada da máquina (key ring)
+    
+    Tokens carregam o kid da chave que os assinou. Na rotação a chave
+    anterior continua válida até valid_until, então o EDGE aceita as duas
+    durante a janela de sobreposição.
+    """
+    __tablename__ = "machine_keys"
+    __table_args__ = (UniqueConstraint("machine_id", "kid", name="uq_machine_key_kid"),)
+    
+    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    machine_id = Column(String(36), ForeignKey("machines.id"), nullable=False, index=True)
+    
+    kid = Column(Integer, nullable=False)  # Sequencial por máquina (1, 2, ...)
+    secret = Column(String(100), nullable=False, default=generate_hmac_secret)
+    
+    # Janela de validade (valid_until None = chave atual, sem expiração)
+    valid_from = Column(DateTime, nullable=False, default=datetime.utcnow)
+    valid_until = Column(DateTime)
+    
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    machine = relationship("Machine", back_populates="keys")
+    
+    def __repr__(self):
+        return f"<MachineKey {self.machine_id}#{self.kid}>"
@@ -44,3 +44,25 @@ class Sale(Base):
     
     def __repr__(self):
         return f"<Sale {self.id[:8]} - {self.volume_ml}ml>"
+
+
+class SaleToken(Base):
+    """
+    Token de dispensa emitido para uma venda (no máximo um por venda)
+    
+    Pedir o token de novo devolve o mesmo enquanto ele é válido; depois
+    disso a venda não recebe outro, então uma venda paga vira um só copo.
+    """
+    __tablename__ = "sale_tokens"
+    
+    sale_id = Column(String(36), ForeignKey("sales.id"), primary_key=True)
+    machine_id = Column(String(36), ForeignKey("machines.id"), nullable=False, index=True)
+    token = Column(String(512), nullable=False)
+    kid = Column(Integer, nullable=False)
+    tap_id = Column(Integer, nullable=False)
+    format = Column(String(10), nullable=False)
+    issued_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    
+    def __repr__(self):
+        return f"<SaleToken {self.sale_id[:8]} kid={self.kid}>"
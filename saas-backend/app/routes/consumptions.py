@@ -1,12 +1,20 @@
 """
 Endpoints para consumptions (registros de dispensa)
 """
+import uuid
+
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
 
 from ..database import get_db
 from ..models import Consumption, Sale, Machine
-from ..schemas import ConsumptionCreate, ConsumptionResponse
+from ..schemas import (
+    ConsumptionCreate,
+    ConsumptionResponse,
+    ConsumptionBatchCreate,
+    ConsumptionBatchItemResult,
+    ConsumptionBatchResponse,
+)
 from ..utils.auth import get_machine_by_api_key
 
 router = APIRouter()
@@ -84,6 +92,129 @@ async def create_consumption(
         raise HTTPException(status_code=500, detail=f"Erro ao criar consumption: {str(e)}")
 
 
+def _sale_status_for(consumption_status: str) -> str:
+    """Status da sale conforme resultado do consumo"""
+    if consumption_status == "OK":
+        return "completed"
+    if consumption_status == "PARTIAL":
+        return "partial"
+    return "failed"
+
+
+def _rejected(index: int, data: ConsumptionCreate, http_status: int, error: str) -> ConsumptionBatchItemResult:
+    """Resultado de registro recusado no lote"""
+    return ConsumptionBatchItemResult(
+        index=index,
+        sale_id=data.sale_id,
+        status="REJECTED",
+        http_status=http_status,
+        error=error
+    )
+
+
+@router.post("/batch", response_model=ConsumptionBatchResponse)
+async def create_consumptions_batch(
+    batch: ConsumptionBatchCreate,
+    db: Session = Depends(get_db),
+    machine: Machine = Depends(get_machine_by_api_key)
+):
+    """
+    Registra um lote de dispensas (EDGE sincronizando fila offline)
+    
+    - Valida sales e duplicados em bloco (consultas IN)
+    - Insere tudo em uma única transação
+    - Retorna resultado por registro, na mesma ordem do pedido
+    
+    Registros cuja sale já possui consumption retornam DUPLICATE com o id
+    existente, para que reenvios após falha de rede sejam idempotentes.
+    """
+    records = batch.records
+    sale_ids = {r.sale_id for r in records if r.sale_id}
+    
+    sales = {}
+    existing = {}
+    if sale_ids:
+        sales = {
+            sale.id: sale
+            for sale in db.query(Sale).filter(Sale.id.in_(sale_ids)).all()
+        }
+        existing = {
+            sale_id: consumption_id
+            for sale_id, consumption_id in db.query(Consumption.sale_id, Consumption.id)
+            .filter(Consumption.sale_id.in_(sale_ids))
+            .all()
+        }
+    
+    results = []
+    new_consumptions = []
+    
+    for index, data in enumerate(records):
+        if not data.sale_id:
+            results.append(_rejected(index, data, 400, "sale_id é obrigatório"))
+            continue
+        
+        if data.machine_id != machine.id:
+            results.append(_rejected(
+                index, data, 403, "machine_id in payload does not match authenticated machine"
+            ))
+            continue
+        
+        sale = sales.get(data.sale_id)
+        if not sale:
+            results.append(_rejected(index, data, 404, "Sale não encontrada"))
+            continue
+        
+        if data.sale_id in existing:
+            results.append(ConsumptionBatchItemResult(
+                index=index,
+                sale_id=data.sale_id,
+                status="DUPLICATE",
+                http_status=200,
+                consumption_id=existing[data.sale_id]
+            ))
+            continue
+        
+        consumption = Consumption(
+            id=str(uuid.uuid4()),
+            organization_id=machine.organization_id,
+            sale_id=data.sale_id,
+            machine_id=machine.id,
+            token_id=data.token_id,
+            ml_served=data.ml_served,
+            ml_authorized=data.ml_authorized,
+            status=data.status or "OK",
+            error_message=data.error_message,
+            started_at=data.started_at,
+            finished_at=data.finished_at
+        )
+        new_consumptions.append(consumption)
+        existing[data.sale_id] = consumption.id
+        sale.status = _sale_status_for(data.status)
+        
+        results.append(ConsumptionBatchItemResult(
+            index=index,
+            sale_id=data.sale_id,
+            status="OK",
+            http_status=201,
+            consumption_id=consumption.id
+        ))
+    
+    try:
+        if new_consumptions:
+            db.add_all(new_consumptions)
+            db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Erro ao criar consumptions: {str(e)}")
+    
+    rejected = sum(1 for r in results if r.status == "REJECTED")
+    return ConsumptionBatchResponse(
+        accepted=len(results) - rejected,
+        rejected=rejected,
+        results=results
+    )
+
+
 @router.get("/{consumption_id}", response_model=ConsumptionResponse)
 async def get_consumption(
     consumption_id: int,
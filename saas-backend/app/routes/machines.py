@@ -2,14 +2,18 @@
 Rotas: Machines (Máquinas)
 CRUD para administradores
 """
+from datetime import datetime
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 
 from ..database import get_db
-from ..models import Machine, User
-from ..schemas import MachineCreate, MachineUpdate, MachineResponse
-from ..utils.auth import get_current_user
+from ..models import Machine, User, MachineStock, StockRefill
+from ..schemas import MachineCreate, MachineUpdate, MachineResponse, MachineKeyRingResponse
+from ..schemas.stock import MachineRefillResponse
+from ..utils.auth import get_current_user, get_machine_by_api_key
+from ..utils.key_ring import get_machine_keys, current_signing_key, rotate_machine_key
+from ..utils.token_signer import token_signer
 
 router = APIRouter(prefix="/machines", tags=["Machines"])
 
@@ -27,6 +31,57 @@ async def list_machines(
     return machines
 
 
+def _key_ring_response(machine: Machine, keys) -> MachineKeyRingResponse:
+    current = current_signing_key(keys)
+    return MachineKeyRingResponse(
+        machine_id=machine.id,
+        current_kid=current.kid if current else 0,
+        keys=keys,
+    )
+
+
+@router.get("/me/keys", response_model=MachineKeyRingResponse)
+async def get_my_keys(
+    db: Session = Depends(get_db),
+    machine: Machine = Depends(get_machine_by_api_key)
+):
+    """
+    Key ring HMAC da máquina autenticada (EDGE)
+    Inclui chaves ainda não ativas e chaves em sobreposição de rotação
+    """
+    return _key_ring_response(machine, get_machine_keys(db, machine))
+
+
+@router.get("/me/refills", response_model=List[MachineRefillResponse])
+async def get_my_refills(
+    since: Optional[datetime] = None,
+    db: Session = Depends(get_db),
+    machine: Machine = Depends(get_machine_by_api_key)
+):
+    """
+    Abastecimentos das torneiras da máquina autenticada (EDGE)
+    Usado pelo EDGE para calibrar o sensor de fluxo por barril esvaziado
+    """
+    query = db.query(StockRefill, MachineStock.tap_number).join(
+        MachineStock, StockRefill.machine_stock_id == MachineStock.id
+    ).filter(MachineStock.machine_id == machine.id)
+    if since:
+        query = query.filter(StockRefill.refilled_at >= since)
+    
+    return [
+        MachineRefillResponse(
+            id=refill.id,
+            tap_number=tap_number,
+            quantity_ml=refill.quantity_ml,
+            stock_before_ml=refill.stock_before_ml,
+            stock_after_ml=refill.stock_after_ml,
+            refill_type=refill.refill_type or "full",
+            refilled_at=refill.refilled_at,
+        )
+        for refill, tap_number in query.order_by(StockRefill.refilled_at).all()
+    ]
+
+
 @router.get("/{machine_id}", response_model=MachineResponse)
 async def get_machine(
     machine_id: str,
@@ -160,3 +215,27 @@ async def regenerate_api_key(
     db.refresh(machine)
     
     return machine
+
+
+@router.post("/{machine_id}/keys/rotate", response_model=MachineKeyRingResponse)
+async def rotate_machine_hmac_key(
+    machine_id: str,
+    overlap_hours: float = 24,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Rotaciona a chave HMAC da máquina sem downtime (admin)"""
+    machine = db.query(Machine).filter(
+        Machine.id == machine_id,
+        Machine.organization_id == current_user.organization_id
+    ).first()
+    
+    if not machine:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Machine not found"
+        )
+    
+    rotate_machine_key(db, machine, overlap_hours)
+    token_signer.invalidate(machine.id)
+    return _key_ring_response(machine, get_machine_keys(db, machine))
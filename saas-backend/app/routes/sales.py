@@ -1,17 +1,26 @@
 """
 Rotas: Sales (Vendas)
 - POST /sales - Registra venda (APP Kiosk via API Key)
+- POST /sales/{id}/token - Emite token de dispensa para o EDGE
+- POST /sales/tokens - Emite tokens em lote
 - GET /sales - Lista vendas (admin)
 """
+import uuid
 from datetime import datetime
 from typing import List, Optional
 from fastapi import APIRouter, Depends, HTTPException, status, Query
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 from ..database import get_db
-from ..models import Sale, Machine, Beverage, User
-from ..schemas import SaleCreate, SaleResponse, SaleDetailResponse
+from ..models import Sale, SaleToken, Machine, Beverage, User
+from ..schemas import (
+    SaleCreate, SaleResponse, SaleDetailResponse,
+    SaleTokenRequest, SaleTokenResponse,
+    SaleTokenBatchRequest, SaleTokenBatchItem, SaleTokenBatchResponse,
+)
 from ..utils.auth import get_machine_by_api_key, get_current_user, get_machine_optional
+from ..utils.token_signer import token_signer
 
 router = APIRouter(prefix="/sales", tags=["Sales"])
 
@@ -38,7 +47,17 @@ async def register_sale(
     }
     
     Retorna: { "sale_id": "...", "status": "REGISTERED" }
+    
+    issue_token=true exige X-API-Key válida (o token sai assinado com a
+    chave da máquina autenticada).
     """
+    if sale_data.issue_token and machine is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="API Key required to issue a dispense token",
+            headers={"X-API-Key": "Required"},
+        )
+    
     # Determina organização
     if machine:
         org_id = machine.organization_id
@@ -76,6 +95,7 @@ async def register_sale(
     
     # Cria venda
     sale = Sale(
+        id=str(uuid.uuid4()),
         organization_id=org_id,
         machine_id=machine_db.id,
         beverage_id=beverage.id,
@@ -91,11 +111,194 @@ async def register_sale(
         created_at=sale_data.created_at or datetime.utcnow(),
     )
     
+    # Token de dispensa na mesma resposta (evita uma segunda chamada).
+    # Assinado antes de a venda entrar na sessão e gravado no mesmo
+    # commit: se a assinatura falhar (400), nenhuma venda fica registrada
+    issued = None
+    if sale_data.issue_token:
+        issued = _mint_sale_token(db, machine, sale, sale_data.tap_id, sale_data.token_format)
+    
     db.add(sale)
+    if issued is not None:
+        db.add(issued)
     db.commit()
     db.refresh(sale)
     
-    return SaleResponse(sale_id=sale.id, status="REGISTERED")
+    if issued is None:
+        return SaleResponse(sale_id=sale.id, status="REGISTERED")
+    
+    return SaleResponse(
+        sale_id=sale.id,
+        status="REGISTERED",
+        token=issued.token,
+        kid=issued.kid,
+        token_expires_at=issued.expires_at,
+    )
+
+
+def _sale_for_token(db: Session, sale_id: str, machine: Machine) -> Sale:
+    """Venda pendente da máquina autenticada que pode receber token"""
+    sale = db.query(Sale).filter(
+        Sale.id == sale_id,
+        Sale.machine_id == machine.id
+    ).first()
+    
+    if not sale:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Sale {sale_id} not found"
+        )
+    
+    if sale.status != "pending":
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Sale {sale_id} is {sale.status}"
+        )
+    
+    return sale
+
+
+def _mint_sale_token(db: Session, machine: Machine, sale: Sale,
+                     tap_id: int, token_format: str) -> SaleToken:
+    """Assina um token novo para a venda (a linha ainda não é gravada)"""
+    try:
+        minted = token_signer.mint(
+            db, machine, sale.id, sale.beverage_id, sale.volume_ml,
+            tap_id, token_format
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    return SaleToken(
+        sale_id=sale.id,
+        machine_id=machine.id,
+        token=minted.token,
+        kid=minted.kid,
+        tap_id=tap_id,
+        format=token_format,
+        issued_at=datetime.utcnow(),
+        expires_at=datetime.utcfromtimestamp(minted.expires_at),
+    )
+
+
+def _issue_token_once(db: Session, machine: Machine, sale: Sale,
+                      tap_id: int, token_format: str) -> SaleToken:
+    """
+    Token único da venda
+    
+    Um novo pedido recebe o mesmo token enquanto ele é válido (retentativa
+    do kiosk); para outra torneira/formato nesse prazo, 409. Depois de
+    expirado o EDGE já recusa o antigo, então ele é substituído por um
+    novo (a venda paga nunca fica sem token).
+    """
+    issued = db.query(SaleToken).filter(SaleToken.sale_id == sale.id).first()
+    if issued is None:
+        issued = _mint_sale_token(db, machine, sale, tap_id, token_format)
+        db.add(issued)
+        try:
+            db.commit()
+            return issued
+        except IntegrityError:
+            # Pedido concorrente emitiu primeiro: vale o token dele
+            db.rollback()
+            issued = db.query(SaleToken).filter(SaleToken.sale_id == sale.id).first()
+    
+    elif issued.expires_at <= datetime.utcnow():
+        fresh = _mint_sale_token(db, machine, sale, tap_id, token_format)
+        # Só troca o token que leu; se outro pedido trocou antes, vale o dele
+        db.query(SaleToken).filter(
+            SaleToken.sale_id == sale.id,
+            SaleToken.token == issued.token
+        ).update({
+            SaleToken.token: fresh.token,
+            SaleToken.kid: fresh.kid,
+            SaleToken.tap_id: fresh.tap_id,
+            SaleToken.format: fresh.format,
+            SaleToken.issued_at: fresh.issued_at,
+            SaleToken.expires_at: fresh.expires_at,
+        }, synchronize_session=False)
+        db.commit()
+        db.refresh(issued)
+    
+    if (issued.tap_id != tap_id or issued.format != token_format
+            or issued.expires_at <= datetime.utcnow()):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Token already issued for sale {sale.id}"
+        )
+    return issued
+
+
+@router.post("/tokens", response_model=SaleTokenBatchResponse)
+async def issue_sale_tokens(
+    batch: SaleTokenBatchRequest,
+    db: Session = Depends(get_db),
+    machine: Machine = Depends(get_machine_by_api_key)
+):
+    """
+    Emite tokens de dispensa em lote (APP Kiosk / EDGE, via API Key)
+    Falhas são reportadas por item, sem abortar o lote
+    """
+    sales = {
+        sale.id: sale for sale in db.query(Sale).filter(
+            Sale.id.in_(batch.sale_ids),
+            Sale.machine_id == machine.id
+        ).all()
+    }
+    
+    items = []
+    for sale_id in batch.sale_ids:
+        sale = sales.get(sale_id)
+        if not sale:
+            items.append(SaleTokenBatchItem(sale_id=sale_id, error="Sale not found"))
+            continue
+        if sale.status != "pending":
+            items.append(SaleTokenBatchItem(sale_id=sale_id, error=f"Sale is {sale.status}"))
+            continue
+        
+        try:
+            issued = _issue_token_once(db, machine, sale, batch.tap_id, batch.format)
+        except HTTPException as e:
+            items.append(SaleTokenBatchItem(sale_id=sale_id, error=e.detail))
+            continue
+        
+        items.append(SaleTokenBatchItem(
+            sale_id=sale_id,
+            token=issued.token,
+            kid=issued.kid,
+            expires_at=issued.expires_at,
+        ))
+    
+    return SaleTokenBatchResponse(
+        issued=sum(1 for item in items if item.token),
+        tokens=items,
+    )
+
+
+@router.post("/{sale_id}/token", response_model=SaleTokenResponse)
+async def issue_sale_token(
+    sale_id: str,
+    token_request: Optional[SaleTokenRequest] = None,
+    db: Session = Depends(get_db),
+    machine: Machine = Depends(get_machine_by_api_key)
+):
+    """
+    Emite token de dispensa assinado com a chave HMAC atual da máquina
+    
+    O token é aceito pelo EDGE por TOKEN_TTL_SECONDS (tolerância de expiração).
+    Cada venda recebe um único token (ver _issue_token_once).
+    """
+    token_request = token_request or SaleTokenRequest()
+    sale = _sale_for_token(db, sale_id, machine)
+    issued = _issue_token_once(db, machine, sale, token_request.tap_id, token_request.format)
+    
+    return SaleTokenResponse(
+        sale_id=sale.id,
+        token=issued.token,
+        kid=issued.kid,
+        format=issued.format,
+        expires_at=issued.expires_at,
+    )
 
 
 @router.get("", response_model=List[SaleDetailResponse])
@@ -1,18 +1,32 @@
 # Schemas
 from .organization import OrganizationCreate, OrganizationUpdate, OrganizationResponse
 from .user import UserCreate, UserUpdate, UserResponse, UserLogin, Token
-from .machine import MachineCreate, MachineUpdate, MachineResponse
+from .machine import (
+    MachineCreate, MachineUpdate, MachineResponse,
+    MachineKeyResponse, MachineKeyRingResponse,
+)
 from .beverage import BeverageCreate, BeverageUpdate, BeverageResponse, BeverageListResponse
-from .sale import SaleCreate, SaleResponse, SaleDetailResponse
-from .consumption import ConsumptionCreate, ConsumptionResponse, ConsumptionDetailResponse
+from .sale import (
+    SaleCreate, SaleResponse, SaleDetailResponse,
+    SaleTokenRequest, SaleTokenResponse,
+    SaleTokenBatchRequest, SaleTokenBatchItem, SaleTokenBatchResponse,
+)
+from .consumption import (
+    ConsumptionCreate, ConsumptionResponse, ConsumptionDetailResponse,
+    ConsumptionBatchCreate, ConsumptionBatchItemResult, ConsumptionBatchResponse,
+)
 from .dashboard import DashboardMetrics, PeriodMetrics, BeverageMetrics, MachineMetrics
 
 __all__ = [
     "OrganizationCreate", "OrganizationUpdate", "OrganizationResponse",
     "UserCreate", "UserUpdate", "UserResponse", "UserLogin", "Token",
     "MachineCreate", "MachineUpdate", "MachineResponse",
+    "MachineKeyResponse", "MachineKeyRingResponse",
     "BeverageCreate", "BeverageUpdate", "BeverageResponse", "BeverageListResponse",
     "SaleCreate", "SaleResponse", "SaleDetailResponse",
+    "SaleTokenRequest", "SaleTokenResponse",
+    "SaleTokenBatchRequest", "SaleTokenBatchItem", "SaleTokenBatchResponse",
     "ConsumptionCreate", "ConsumptionResponse", "ConsumptionDetailResponse",
+    "ConsumptionBatchCreate", "ConsumptionBatchItemResult", "ConsumptionBatchResponse",
     "DashboardMetrics", "PeriodMetrics", "BeverageMetrics", "MachineMetrics",
 ]
@@ -3,8 +3,12 @@ Schemas: Consumption
 Compatível com o formato enviado pelo EDGE
 """
 from datetime import datetime
-from typing import Optional
-from pydantic import BaseModel
+from typing import List, Optional
+from pydantic import BaseModel, Field
+
+
+# Máximo de registros aceitos por POST /consumptions/batch
+MAX_CONSUMPTION_BATCH = 200
 
 
 class ConsumptionCreate(BaseModel):
@@ -52,6 +56,36 @@ class ConsumptionResponse(BaseModel):
     consumption_id: Optional[str] = None
 
 
+class ConsumptionBatchCreate(BaseModel):
+    """
+    Lote de consumptions enviado pelo EDGE após ficar offline:
+    {
+      "records": [ {ConsumptionCreate}, ... ]
+    }
+    """
+    records: List[ConsumptionCreate] = Field(..., min_length=1, max_length=MAX_CONSUMPTION_BATCH)
+
+
+class ConsumptionBatchItemResult(BaseModel):
+    """
+    Resultado de um registro do lote (mesma posição do pedido)
+    status: OK, DUPLICATE (já registrado antes) ou REJECTED
+    """
+    index: int
+    sale_id: Optional[str] = None
+    status: str
+    http_status: int
+    consumption_id: Optional[str] = None
+    error: Optional[str] = None
+
+
+class ConsumptionBatchResponse(BaseModel):
+    """Resposta do lote com resultado por registro"""
+    accepted: int
+    rejected: int
+    results: List[ConsumptionBatchItemResult]
+
+
 class ConsumptionDetailResponse(BaseModel):
     """Resposta detalhada para dashboard"""
     id: str
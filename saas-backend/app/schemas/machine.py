@@ -2,7 +2,7 @@
 Schemas: Machine
 """
 from datetime import datetime
-from typing import Optional
+from typing import Optional, List
 from pydantic import BaseModel
 
 
@@ -47,3 +47,20 @@ class MachinePublicResponse(MachineBase):
     
     class Config:
         from_attributes = True
+
+
+class MachineKeyResponse(BaseModel):
+    """Chave HMAC do key ring (somente para a própria máquina/admin)"""
+    kid: int
+    secret: str
+    valid_from: datetime
+    valid_until: Optional[datetime] = None
+    
+    class Config:
+        from_attributes = True
+
+
+class MachineKeyRingResponse(BaseModel):
+    machine_id: str
+    current_kid: int
+    keys: List[MachineKeyResponse]
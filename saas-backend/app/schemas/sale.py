@@ -3,7 +3,7 @@ Schemas: Sale
 Compatível com o formato enviado pelo APP Kiosk
 """
 from datetime import datetime
-from typing import Optional
+from typing import Optional, List, Literal
 from pydantic import BaseModel, Field
 
 
@@ -32,6 +32,11 @@ class SaleCreate(BaseModel):
     payment_card_brand: Optional[str] = None
     payment_card_last_digits: Optional[str] = None
     created_at: Optional[datetime] = None
+    
+    # Emissão do token de dispensa na mesma chamada (uma ida e volta)
+    issue_token: bool = False
+    tap_id: int = Field(1, ge=0, le=255)
+    token_format: Literal["json", "binary"] = "json"
 
 
 class SaleResponse(BaseModel):
@@ -44,6 +49,11 @@ class SaleResponse(BaseModel):
     """
     sale_id: str
     status: str = "REGISTERED"
+    
+    # Preenchidos quando issue_token=true
+    token: Optional[str] = None
+    kid: Optional[int] = None
+    token_expires_at: Optional[datetime] = None
 
 
 class SaleDetailResponse(BaseModel):
@@ -65,3 +75,39 @@ class SaleDetailResponse(BaseModel):
     
     class Config:
         from_attributes = True
+
+
+MAX_TOKEN_BATCH = 100
+
+
+class SaleTokenRequest(BaseModel):
+    """Pedido de token de dispensa para uma venda"""
+    tap_id: int = Field(1, ge=0, le=255)
+    format: Literal["json", "binary"] = "json"
+
+
+class SaleTokenResponse(BaseModel):
+    sale_id: str
+    token: str
+    kid: int
+    format: str
+    expires_at: datetime
+
+
+class SaleTokenBatchRequest(BaseModel):
+    sale_ids: List[str] = Field(..., min_length=1, max_length=MAX_TOKEN_BATCH)
+    tap_id: int = Field(1, ge=0, le=255)
+    format: Literal["json", "binary"] = "json"
+
+
+class SaleTokenBatchItem(BaseModel):
+    sale_id: str
+    token: Optional[str] = None
+    kid: Optional[int] = None
+    expires_at: Optional[datetime] = None
+    error: Optional[str] = None
+
+
+class SaleTokenBatchResponse(BaseModel):
+    issued: int
+    tokens: List[SaleTokenBatchItem]
@@ -93,6 +93,17 @@ class StockRefillResponse(BaseModel):
         from_attributes = True
 
 
+class MachineRefillResponse(BaseModel):
+    """Abastecimento visto pela máquina (calibração do EDGE)"""
+    id: str
+    tap_number: int
+    quantity_ml: int
+    stock_before_ml: Optional[int]
+    stock_after_ml: Optional[int]
+    refill_type: str
+    refilled_at: datetime
+
+
 # ========== StockMovement ==========
 
 class StockMovementResponse(BaseModel):
@@ -0,0 +1,84 @@
+"""
+Key ring HMAC das máquinas
+- Chave inicial (kid 1) semeada com Machine.hmac_secret
+- Rotação com ativação adiada e janela de sobreposição
+"""
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy.orm import Session
+
+from ..models import Machine, MachineKey
+from ..models.machine import generate_hmac_secret
+
+
+# Tempo entre criar uma chave e assinar com ela: o EDGE sincroniza o key
+# ring periodicamente e precisa conhecer a chave antes do primeiro token
+KEY_ACTIVATION_DELAY = timedelta(minutes=10)
+
+
+def get_machine_keys(db: Session, machine: Machine, now: Optional[datetime] = None) -> List[MachineKey]:
+    """
+    Chaves ainda não expiradas da máquina (ordenadas por kid)
+    Cria a chave inicial a partir de Machine.hmac_secret se o key ring estiver vazio
+    """
+    now = now or datetime.utcnow()
+    
+    keys = db.query(MachineKey).filter(
+        MachineKey.machine_id == machine.id
+    ).order_by(MachineKey.kid).all()
+    
+    if not keys:
+        key = MachineKey(
+            machine_id=machine.id,
+            kid=1,
+            secret=machine.hmac_secret,
+            valid_from=machine.created_at or now,
+        )
+        db.add(key)
+        db.commit()
+        db.refresh(key)
+        keys = [key]
+    
+    return [key for key in keys if key.valid_until is None or key.valid_until > now]
+
+
+def current_signing_key(keys: List[MachineKey], now: Optional[datetime] = None) -> Optional[MachineKey]:
+    """Chave mais nova já ativa (usada para assinar tokens)"""
+    now = now or datetime.utcnow()
+    active = [key for key in keys if key.valid_from <= now]
+    return max(active, key=lambda key: key.kid) if active else None
+
+
+def rotate_machine_key(db: Session, machine: Machine, overlap_hours: float = 24) -> MachineKey:
+    """
+    Cria uma nova chave para a máquina
+    
+    A nova chave passa a assinar após KEY_ACTIVATION_DELAY; as chaves
+    atuais continuam válidas por overlap_hours depois disso, para que
+    tokens já emitidos sigam sendo aceitos pelo EDGE.
+    """
+    now = datetime.utcnow()
+    activates_at = now + KEY_ACTIVATION_DELAY
+    expires_at = activates_at + timedelta(hours=overlap_hours)
+    
+    keys = get_machine_keys(db, machine, now)
+    for key in keys:
+        if key.valid_until is None or key.valid_until > expires_at:
+            key.valid_until = expires_at
+    
+    last_kid = db.query(MachineKey.kid).filter(
+        MachineKey.machine_id == machine.id
+    ).order_by(MachineKey.kid.desc()).first()
+    
+    new_key = MachineKey(
+        machine_id=machine.id,
+        kid=(last_kid[0] if last_kid else 0) + 1,
+        secret=generate_hmac_secret(),
+        valid_from=activates_at,
+    )
+    db.add(new_key)
+    db.commit()
+    db.refresh(new_key)
+    
+    return new_key
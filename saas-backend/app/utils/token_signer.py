@@ -0,0 +1,143 @@
+"""
+Emissão de tokens de dispensa para o EDGE
+- Formatos idênticos aos validados pelo EDGE (JSON e binário v2, com kid)
+- Chave atual de cada máquina em cache com contexto HMAC pré-computado
+"""
+import hmac
+import json
+import time
+import uuid
+import base64
+import struct
+import hashlib
+import secrets
+import threading
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from sqlalchemy.orm import Session
+
+from ..models import Machine
+from .key_ring import get_machine_keys, current_signing_key
+
+
+# Layout binário v2 (ver edge-server/token_validator.py): versão, kid,
+# UUIDs, volume, torneira, timestamp, nonce + HMAC truncado
+BINARY_TOKEN_V2 = struct.Struct(">BH16s16sHBI12s")
+BINARY_MAC_SIZE = 16
+
+# Tolerância de expiração aplicada pelo EDGE (TOKEN_EXPIRY_TOLERANCE)
+TOKEN_TTL_SECONDS = 30
+
+# Tempo que a chave de uma máquina fica em cache (pega rotações)
+KEY_CACHE_SECONDS = 60
+
+
+@dataclass
+class _SigningKey:
+    kid: int
+    context: "hmac.HMAC"
+    cached_at: float
+    
+    def digest(self, data: bytes) -> bytes:
+        mac = self.context.copy()
+        mac.update(data)
+        return mac.digest()
+
+
+@dataclass
+class MintedToken:
+    token: str
+    kid: int
+    expires_at: float  # unix seconds
+
+
+class TokenSigner:
+    """
+    Assina tokens de dispensa com a chave atual da máquina
+    
+    O contexto HMAC de cada chave é criado uma vez e copiado por token,
+    então emitir um token custa só o hash do payload.
+    """
+    
+    def __init__(self, cache_seconds: float = KEY_CACHE_SECONDS):
+        self.cache_seconds = cache_seconds
+        self._lock = threading.Lock()
+        self._keys: Dict[str, _SigningKey] = {}
+    
+    def _signing_key(self, db: Session, machine: Machine) -> _SigningKey:
+        now = time.monotonic()
+        cached = self._keys.get(machine.id)
+        if cached and now - cached.cached_at < self.cache_seconds:
+            return cached
+        
+        key = current_signing_key(get_machine_keys(db, machine))
+        if key is None:
+            raise ValueError(f"Machine {machine.id} has no active HMAC key")
+        
+        signing_key = _SigningKey(
+            kid=key.kid,
+            context=hmac.new(key.secret.encode('utf-8'), digestmod=hashlib.sha256),
+            cached_at=now,
+        )
+        with self._lock:
+            self._keys[machine.id] = signing_key
+        return signing_key
+    
+    def invalidate(self, machine_id: Optional[str] = None):
+        """Descarta chaves em cache (ex.: após rotação)"""
+        with self._lock:
+            if machine_id:
+                self._keys.pop(machine_id, None)
+            else:
+                self._keys.clear()
+    
+    def mint(self, db: Session, machine: Machine, sale_id: str, beverage_id: str,
+             volume_ml: int, tap_id: int = 1, token_format: str = "json") -> MintedToken:
+        """Emite um token para a venda"""
+        key = self._signing_key(db, machine)
+        timestamp = time.time()
+        
+        if token_format == "binary":
+            token = self._sign_binary(key, sale_id, beverage_id, volume_ml, tap_id, timestamp)
+        else:
+            token = self._sign_json(key, sale_id, beverage_id, volume_ml, tap_id, timestamp)
+        
+        return MintedToken(token=token, kid=key.kid, expires_at=timestamp + TOKEN_TTL_SECONDS)
+    
+    @staticmethod
+    def _sign_json(key: _SigningKey, sale_id: str, beverage_id: str,
+                   volume_ml: int, tap_id: int, timestamp: float) -> str:
+        payload = {
+            "sale_id": sale_id,
+            "beverage_id": beverage_id,
+            "volume_ml": volume_ml,
+            "tap_id": tap_id,
+            "timestamp": timestamp,
+            "nonce": secrets.token_urlsafe(16),
+            "kid": key.kid,
+        }
+        payload_json = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        payload_b64 = base64.urlsafe_b64encode(payload_json).decode('utf-8')
+        signature = base64.urlsafe_b64encode(key.digest(payload_json)).decode('utf-8')
+        return f"{payload_b64}.{signature}"
+    
+    @staticmethod
+    def _sign_binary(key: _SigningKey, sale_id: str, beverage_id: str,
+                     volume_ml: int, tap_id: int, timestamp: float) -> str:
+        body = BINARY_TOKEN_V2.pack(
+            2,
+            key.kid,
+            uuid.UUID(sale_id).bytes,
+            uuid.UUID(beverage_id).bytes,
+            volume_ml,
+            tap_id,
+            int(timestamp),
+            secrets.token_bytes(12),
+        )
+        mac = key.digest(body)[:BINARY_MAC_SIZE]
+        return base64.urlsafe_b64encode(body + mac).decode('ascii').rstrip('=')
+
+
+# Instância global (cache compartilhado entre requisições do worker)
+token_signer = TokenSigner()
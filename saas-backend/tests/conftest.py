@@ -0,0 +1,56 @@
+"""
+Setup compartilhado dos testes do SaaS
+
+Aponta DATABASE_URL para um SQLite temporário antes de importar o app
+e popula com o seed de desenvolvimento (máquina M001 e bebidas).
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="saas-tests-"), "bierpass.db")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app.main import app  # noqa: E402
+from app.database import SessionLocal  # noqa: E402
+from app.models import Machine, Beverage  # noqa: E402
+from seed import seed_database  # noqa: E402
+
+API = "/api/v1"
+
+seed_database()
+
+
+@pytest.fixture
+def client():
+    return TestClient(app)
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def machine(db):
+    return db.query(Machine).filter(Machine.code == "M001").first()
+
+
+@pytest.fixture
+def auth(machine):
+    return {"X-API-Key": machine.api_key}
+
+
+@pytest.fixture
+def beverage(db):
+    return db.query(Beverage).order_by(Beverage.display_order).first()
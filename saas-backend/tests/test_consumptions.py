@@ -0,0 +1,109 @@
+"""
+Registro de dispensas em lote (POST /consumptions/batch)
+"""
+import uuid
+
+from sqlalchemy import event
+
+from app.database import engine
+from app.models import Consumption, Sale
+from conftest import API
+
+
+def _new_sale(client, auth, beverage) -> str:
+    response = client.post(f"{API}/sales", json={
+        "machine_id": "M001",
+        "beverage_id": beverage.id,
+        "volume_ml": 300,
+        "total_value": 12.0,
+        "payment_method": "PIX",
+        "payment_transaction_id": f"SDK_{uuid.uuid4().hex[:12]}",
+    }, headers=auth)
+    assert response.status_code == 201
+    return response.json()["sale_id"]
+
+
+def _record(machine, sale_id, **extra):
+    record = {
+        "sale_id": sale_id,
+        "machine_id": machine.id,
+        "ml_served": 290,
+        "ml_authorized": 300,
+        "status": "OK",
+        "started_at": "2026-01-10T10:30:10",
+        "finished_at": "2026-01-10T10:30:40",
+    }
+    record.update(extra)
+    return record
+
+
+def test_batch_results_per_record(client, auth, machine, beverage, db):
+    ok, partial = _new_sale(client, auth, beverage), _new_sale(client, auth, beverage)
+    records = [
+        _record(machine, ok),
+        _record(machine, partial, status="PARTIAL"),
+        _record(machine, f"SALE-{uuid.uuid4()}"),
+        _record(machine, ok, machine_id="OTHER"),
+        _record(machine, None),
+    ]
+    
+    response = client.post(f"{API}/consumptions/batch", json={"records": records}, headers=auth)
+    
+    assert response.status_code == 200
+    data = response.json()
+    assert [(r["index"], r["status"], r["http_status"]) for r in data["results"]] == [
+        (0, "OK", 201), (1, "OK", 201), (2, "REJECTED", 404), (3, "REJECTED", 403), (4, "REJECTED", 400)
+    ]
+    assert (data["accepted"], data["rejected"]) == (2, 3)
+    assert db.get(Sale, ok).status == "completed"
+    assert db.get(Sale, partial).status == "partial"
+
+
+def test_batch_resend_is_idempotent(client, auth, machine, beverage, db):
+    sale_ids = [_new_sale(client, auth, beverage) for _ in range(2)]
+    body = {"records": [_record(machine, sale_id) for sale_id in sale_ids]}
+    
+    first = client.post(f"{API}/consumptions/batch", json=body, headers=auth).json()["results"]
+    again = client.post(f"{API}/consumptions/batch", json=body, headers=auth).json()["results"]
+    
+    assert [r["status"] for r in again] == ["DUPLICATE", "DUPLICATE"]
+    assert [r["http_status"] for r in again] == [200, 200]
+    assert [r["consumption_id"] for r in again] == [r["consumption_id"] for r in first]
+    assert db.query(Consumption).filter(Consumption.sale_id.in_(sale_ids)).count() == 2
+
+
+def test_batch_same_sale_twice_in_one_request(client, auth, machine, beverage, db):
+    sale_id = _new_sale(client, auth, beverage)
+    body = {"records": [_record(machine, sale_id), _record(machine, sale_id)]}
+    
+    results = client.post(f"{API}/consumptions/batch", json=body, headers=auth).json()["results"]
+    
+    assert [r["status"] for r in results] == ["OK", "DUPLICATE"]
+    assert results[1]["consumption_id"] == results[0]["consumption_id"]
+    assert db.query(Consumption).filter(Consumption.sale_id == sale_id).count() == 1
+
+
+def test_batch_validation_queries_do_not_grow_with_batch_size(client, auth, machine, beverage):
+    def batch_selects(size):
+        body = {"records": [_record(machine, _new_sale(client, auth, beverage)) for _ in range(size)]}
+        statements = []
+        
+        def count(conn, cursor, statement, *args):
+            if statement.lstrip().upper().startswith("SELECT"):
+                statements.append(statement)
+        
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            response = client.post(f"{API}/consumptions/batch", json=body, headers=auth)
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+        assert response.json()["accepted"] == size
+        return len(statements)
+    
+    assert batch_selects(2) == batch_selects(10)
+
+
+def test_batch_requires_api_key(client, machine, beverage):
+    response = client.post(f"{API}/consumptions/batch", json={"records": [_record(machine, "SALE-X")]})
+    
+    assert response.status_code == 401
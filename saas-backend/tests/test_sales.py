@@ -0,0 +1,88 @@
+"""
+Vendas e emissão de tokens de dispensa (POST /sales, /sales/{id}/token)
+"""
+import uuid
+from datetime import datetime, timedelta
+
+from app.models import Sale, SaleToken
+from app.utils.token_signer import token_signer
+from conftest import API
+
+
+def _sale_body(beverage, **extra):
+    body = {
+        "machine_id": "M001",
+        "beverage_id": beverage.id,
+        "volume_ml": 300,
+        "total_value": 12.0,
+        "payment_method": "PIX",
+        "payment_transaction_id": f"SDK_{uuid.uuid4().hex[:12]}",
+    }
+    body.update(extra)
+    return body
+
+
+def test_register_sale_with_token(client, auth, beverage):
+    response = client.post(f"{API}/sales", json=_sale_body(beverage, issue_token=True), headers=auth)
+    
+    assert response.status_code == 201
+    data = response.json()
+    assert data["token"] and data["kid"] == 1
+    
+    again = client.post(f"{API}/sales/{data['sale_id']}/token", json={}, headers=auth)
+    assert again.status_code == 200
+    assert again.json()["token"] == data["token"]
+
+
+def test_issue_token_requires_api_key(client, beverage):
+    response = client.post(f"{API}/sales", json=_sale_body(beverage, issue_token=True))
+    
+    assert response.status_code == 401
+
+
+def test_failed_mint_leaves_no_sale(client, auth, beverage, db, monkeypatch):
+    def no_key(*args, **kwargs):
+        raise ValueError("Machine has no active HMAC key")
+    monkeypatch.setattr(token_signer, "mint", no_key)
+    body = _sale_body(beverage, issue_token=True)
+    
+    response = client.post(f"{API}/sales", json=body, headers=auth)
+    
+    assert response.status_code == 400
+    assert db.query(Sale).filter(Sale.payment_transaction_id == body["payment_transaction_id"]).count() == 0
+
+
+def test_other_tap_conflicts_while_token_is_valid(client, auth, beverage):
+    sale_id = client.post(f"{API}/sales", json=_sale_body(beverage, issue_token=True), headers=auth).json()["sale_id"]
+    
+    response = client.post(f"{API}/sales/{sale_id}/token", json={"tap_id": 2}, headers=auth)
+    
+    assert response.status_code == 409
+
+
+def test_expired_token_is_replaced(client, auth, beverage, db):
+    first = client.post(f"{API}/sales", json=_sale_body(beverage, issue_token=True), headers=auth).json()
+    db.query(SaleToken).filter(SaleToken.sale_id == first["sale_id"]).update(
+        {SaleToken.expires_at: datetime.utcnow() - timedelta(seconds=1)}
+    )
+    db.commit()
+    
+    response = client.post(f"{API}/sales/{first['sale_id']}/token", json={}, headers=auth)
+    
+    assert response.status_code == 200
+    renewed = response.json()
+    assert renewed["token"] != first["token"]
+    assert datetime.fromisoformat(renewed["expires_at"].rstrip("Z")) > datetime.utcnow()
+    repeat = client.post(f"{API}/sales/{first['sale_id']}/token", json={}, headers=auth)
+    assert repeat.json()["token"] == renewed["token"]
+
+
+def test_token_batch_reports_per_sale(client, auth, beverage):
+    sale_id = client.post(f"{API}/sales", json=_sale_body(beverage), headers=auth).json()["sale_id"]
+    
+    response = client.post(f"{API}/sales/tokens", json={"sale_ids": [sale_id, "missing"]}, headers=auth)
+    
+    data = response.json()
+    assert response.status_code == 200
+    assert data["issued"] == 1
+    assert data["tokens"][1]["error"] == "Sale not found"